@@ -0,0 +1,99 @@
+import json
+
+### My modules
+import blogData
+import entityCache
+import storage
+
+from google.appengine.ext import db
+
+# adding or deleting a post writes to its own entity group and the archive's
+XG_OPTIONS = db.create_transaction_options(xg = True)
+
+
+### Per-month post counts
+#
+# The archive sidebar lists every month with its number of posts. The counts
+# are kept in one Archive entity as a JSON object of "YYYY-MM" to count,
+# changed by change() in the same transaction that stores or deletes a post,
+# so the sidebar is a single cached get and posts are never counted per
+# request. Posts are written rarely enough that the one entity is not a
+# write bottleneck.
+def archive_key():
+    """
+    archive_key: key of the Archive entity
+    Returns:
+        database Key of the Archive
+    """
+    return db.Key.from_path("Archive", "months")
+
+
+def load(archive):
+    """
+    load: the counts of an Archive entity
+    Args:
+        archive (object): Archive object, or None if it was never stored
+    Returns:
+        dict of "YYYY-MM" to number of posts
+    """
+    if not archive:
+        return {}
+    return json.loads(archive.counts)
+
+
+def change(created, delta):
+    """
+    change: add to the count of a post's month; call in the transaction that
+            stores or deletes the post, with XG_OPTIONS
+    Args:
+        created (datetime): creation time of the post
+        delta (int): 1 for a new post, -1 for a deleted one
+    Returns:
+        no return value
+    """
+    archive = db.get(archive_key())
+    counts = load(archive)
+    month = storage.month_of(created)
+    counts[month] = counts.get(month, 0) + delta
+    if counts[month] <= 0:
+        del counts[month]
+
+    archive = archive or blogData.Archive(key = archive_key())
+    archive.counts = json.dumps(counts)
+    archive.put()
+
+
+def counts():
+    """
+    counts: the months that have posts, through the entity cache
+    Returns:
+        list of (year, month, number of posts), newest first
+    """
+    months = load(entityCache.get(archive_key()))
+    return [(int(month[:4]), int(month[5:]), count)
+            for month, count in sorted(months.items(), reverse = True)]
+
+
+def invalidate():
+    """
+    invalidate: drop cached copies of the counts after a change
+    Returns:
+        no return value
+    """
+    entityCache.invalidate(archive_key())
+
+
+def rebuild():
+    """
+    rebuild: recount every month from the posts, for seeding the counts of
+             posts written before they were kept
+    Returns:
+        no return value
+    """
+    months = {}
+    for post in blogData.Post.all(projection = ("created",)):
+        month = storage.month_of(post.created)
+        months[month] = months.get(month, 0) + 1
+
+    blogData.Archive(key = archive_key(), counts = json.dumps(months)).put()
+    invalidate()
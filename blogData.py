@@ -1,13 +1,9 @@
 ﻿import validate
-import jinja2
-import os
+import blogViews
+import postDocument
 
 from google.appengine.ext import db
 
-template_dir = os.path.join(os.path.dirname(__file__), "templates")
-jinja_env = jinja2.Environment(loader = jinja2.FileSystemLoader(template_dir),
-                               autoescape = True)
-
 
 ### Database setup
 def users_key(group = "default"):
@@ -21,10 +17,26 @@ def users_key(group = "default"):
     return db.Key.from_path("users", group)
 
 
+# Only properties a query filters, sorts or projects on are indexed: each
+# indexed value costs two index rows on every put. Composite indexes are
+# declared in index.yaml. migrate.reindex() drops the rows entities stored
+# before a property was unindexed still have.
 class User(db.Model):
     name = db.StringProperty(required = True)
-    pw_hash = db.StringProperty(required = True)
-    email = db.StringProperty()
+    pw_hash = db.StringProperty(required = True, indexed = False)
+    email = db.StringProperty(indexed = False)
+
+
+    @property
+    def id(self):
+        """
+        id: the numeric ID of the entity, as used in URLs
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            the ID as an int
+        """
+        return self.key().id()
 
 
     @classmethod
@@ -90,22 +102,55 @@ class User(db.Model):
 
 
 class Likes(db.Model):
-    post_id = db.StringProperty(required = True)
+    post_id = db.StringProperty(required = True, indexed = False)
     username = db.StringProperty(required = True)
 
 
     @classmethod
-    def by_post(cls, post_id):
+    def key_for(cls, post_id, username):
+        """
+        key_for: get the key of a user's Like on a post
+        Args:
+            cls (self pointer): pointer to class object, does not need to be passed in
+            post_id (int): ID of the post
+            username (str): username of the user
+        Returns:
+            database Key of the Like, a child of the post keyed by username
+        """
+        return db.Key.from_path(cls.kind(), "user:%s" % username,
+                                parent = post_key(post_id))
+
+
+    @classmethod
+    def create(cls, post_id, username):
+        """
+        create: make a new Like for a post
+        Args:
+            cls (self pointer): pointer to class object, does not need to be passed in
+            post_id (int): ID of the post being liked
+            username (str): username of the user liking the post
+        Returns:
+            database object of the new Like, not yet stored
+        """
+        return cls(key = cls.key_for(post_id, username),
+                   post_id = str(post_id),
+                   username = username)
+
+
+    @classmethod
+    def by_post(cls, post_id, config = None):
         """
         by_post: get Likes by post_id
         Args:
             cls (self pointer): pointer to class object, does not need to be passed in
             post_id (int): ID of the post to look up
+            config (object): optional db configuration of the count query
         Returns:
             database object of the Likes for a post based on ID, and count of the Likes
         """
-        l = cls.all().filter("post_id =", str(post_id))
-        l_count = cls.all(keys_only=True).filter("post_id", str(post_id)).count(5000)
+        l = cls.all().ancestor(post_key(post_id))
+        l_count = cls.all(keys_only=True).ancestor(post_key(post_id)).count(
+            5000, config = config)
         return l, l_count
 
 
@@ -120,43 +165,27 @@ class Likes(db.Model):
         Returns:
             database object of the Like based on username and post ID, if it exists
         """
-        l = cls.all().filter("post_id =", str(post_id)).filter("username =", str(username)).get()
-        return l
+        return db.get(cls.key_for(post_id, username))
 
 
-class Comments(db.Model):
-    post_id = db.StringProperty(required = True)
+class Comments(blogViews.CommentView, db.Model):
+    post_id = db.StringProperty(required = True, indexed = False)
     content = db.TextProperty(required = True)
     author = db.StringProperty(required = True)
-    created = db.DateTimeProperty(auto_now_add = True)
-    last_modified = db.DateTimeProperty(auto_now = True)
-
-
-    def render_str(self, template, **params):
-        """
-        render_str: render a template
-        Args:
-            self (self pointer): pointer to class object, does not need to be passed in
-            template (str): the template file to be rendered
-            **params (varies): any extra parameteres to be passed to the rendered template
-        Returns:
-            rendered template and the parameters in **params
-        """
-        t = jinja_env.get_template(template)
-        return t.render(params)
+    created = db.DateTimeProperty(auto_now_add = True, indexed = False)
+    last_modified = db.DateTimeProperty(auto_now = True, indexed = False)
 
 
-    def render(self, username):
+    @property
+    def id(self):
         """
-        render: wrapper for rendering a template
+        id: the numeric ID of the entity, as used in URLs
         Args:
             self (self pointer): pointer to class object, does not need to be passed in
-            username (str): username of person viewing the page
         Returns:
-            rendered template file passed through render_str
+            the ID as an int
         """
-        self._render_text = self.content
-        return self.render_str("comment.html", c = self, username = username)
+        return self.key().id()
 
 
     @classmethod
@@ -169,44 +198,273 @@ class Comments(db.Model):
         Returns:
             database object of the Comments for the post, and the count of comments
         """
-        c = cls.all().filter("post_id =", str(post_id))
-        c_count = cls.all(keys_only=True).filter("post_id =", str(post_id)).count(5000)
+        c = cls.all().ancestor(post_key(post_id))
+        c_count = cls.all(keys_only=True).ancestor(post_key(post_id)).count(5000)
         return c, c_count
 
 
-class Post(db.Model):
-    title = db.StringProperty(required = True)
+    def edit(self, content):
+        """
+        edit: change the content, and the copy in the post's document, in one
+              transaction
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            content (str): the new content
+        Returns:
+            the updated comment
+        """
+        def txn():
+            comment, document = db.get([self.key(),
+                                        PostDocument.key_for(self.parent_key())])
+            comment.content = content
+            to_put = [comment]
+            if document and document.change(postDocument.edit_comment, comment):
+                to_put.append(document)
+            db.put(to_put)
+            return comment
+        return db.run_in_transaction(txn)
+
+
+class Post(blogViews.PostView, db.Model):
+    title = db.StringProperty(required = True, indexed = False)
     author = db.StringProperty(required = True)
     content = db.TextProperty(required = True)
     created = db.DateTimeProperty(auto_now_add = True)
-    last_modified = db.DateTimeProperty(auto_now = True)
+    last_modified = db.DateTimeProperty(auto_now = True, indexed = False)
+    like_count = db.IntegerProperty(indexed = False)
+    comment_count = db.IntegerProperty(indexed = False)
 
 
-    def render_str(self, template, **params):
+    @property
+    def id(self):
         """
-        render_str: render a template
+        id: the numeric ID of the entity, as used in URLs
         Args:
             self (self pointer): pointer to class object, does not need to be passed in
-            template (str): the template file to be rendered
-            **params (varies): any extra parameteres to be passed to the rendered template
         Returns:
-            rendered template and the parameters in **params
+            the ID as an int
         """
-        t = jinja_env.get_template(template)
-        return t.render(params)
+        return self.key().id()
 
 
-    def render(self, username):
+    def stored_comment_count(self):
         """
-        render: wrapper for rendering a template
+        stored_comment_count: the number of comments on the post
         Args:
             self (self pointer): pointer to class object, does not need to be passed in
-            username (str): username of person viewing the page
         Returns:
-            rendered template file passed through render_str
+            comment_count, or a count of the Comments for posts written before it existed
         """
-        self._render_text = self.content
-        return self.render_str("post.html", p = self, username = username)
+        if self.comment_count is not None:
+            return self.comment_count
+
+        c, c_count = Comments.by_post(self.key().id())
+        return c_count
+
+
+    def edit(self, title, content):
+        """
+        edit: change the title and content, re-reading the post in a transaction
+              so counters updated since it was loaded are kept
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            title (str): the new title
+            content (str): the new content
+        Returns:
+            the updated post
+        """
+        def txn():
+            post, document = db.get([self.key(),
+                                     PostDocument.key_for(self.key())])
+            post.title = title
+            post.content = content
+            to_put = [post]
+            if document:
+                document.change(postDocument.edit_post, post)
+                to_put.append(document)
+            db.put(to_put)
+            return post
+        return db.run_in_transaction(txn)
+
+
+    def add_comment(self, content, author):
+        """
+        add_comment: store a new comment and update comment_count in one transaction
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            content (str): text of the comment
+            author (str): username of the commenter
+        Returns:
+            tuple of the new comment and the updated post
+        """
+        def txn():
+            post, document = db.get([self.key(),
+                                     PostDocument.key_for(self.key())])
+            comment = Comments(parent = post.key(),
+                               post_id = str(post.key().id()),
+                               content = content,
+                               author = author)
+            post.comment_count = post.stored_comment_count() + 1
+            db.put([comment, post])
+            if document:
+                # the comment has its ID once it's put
+                document.change(postDocument.add_comment, comment)
+                document.put()
+            return comment, post
+        return db.run_in_transaction(txn)
+
+
+    def remove_comment(self, comment):
+        """
+        remove_comment: delete a comment and update comment_count in one transaction
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            comment (object): comment object to delete, a child of this post
+        Returns:
+            the updated post
+        """
+        return self.remove_comments([comment.key()])
+
+
+    def remove_comments(self, keys):
+        """
+        remove_comments: delete comments and update comment_count in one transaction
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            keys (list): database Keys of the comments, children of this post
+        Returns:
+            the updated post
+        """
+        def txn():
+            post, document = db.get([self.key(),
+                                     PostDocument.key_for(self.key())])
+            # only count comments that haven't been deleted already
+            keys_found = [c.key() for c in db.get(keys) if c]
+            post.comment_count = max(post.stored_comment_count() -
+                                     len(keys_found), 0)
+            to_put = [post]
+            doc = document and document.get_document()
+            if doc and any(postDocument.holds_comment(doc, key.id())
+                           for key in keys_found):
+                # the next older comments take the deleted ones' place
+                others = [c for c in Comments.all().ancestor(post)
+                          if c.key() not in keys_found]
+                document = PostDocument.create(post, others)
+                to_put.append(document)
+            elif document:
+                for key in keys_found:
+                    document.change(postDocument.remove_older_comment)
+                to_put.append(document)
+            db.delete(keys_found)
+            db.put(to_put)
+            return post
+        return db.run_in_transaction(txn)
+
+
+class PostDocument(db.Model):
+    data = db.TextProperty(required = True)
+
+
+    @classmethod
+    def key_for(cls, post):
+        """
+        key_for: get the key of a post's document
+        Args:
+            cls (self pointer): pointer to class object, does not need to be passed in
+            post (Key): database Key of the post
+        Returns:
+            database Key of the document, a child of the post so it's written
+            in the same transactions
+        """
+        return db.Key.from_path(cls.kind(), "document", parent = post)
+
+
+    @classmethod
+    def create(cls, post, comments):
+        """
+        create: make the document of a post
+        Args:
+            cls (self pointer): pointer to class object, does not need to be passed in
+            post (object): post object
+            comments (list): every comment of the post
+        Returns:
+            database object of the document, not yet stored
+        """
+        like_count = post.like_count
+        if like_count is None:
+            like, like_count = Likes.by_post(post.key().id())
+        doc = postDocument.build(post, comments, like_count)
+        return cls(key = cls.key_for(post.key()), data = postDocument.dumps(doc))
+
+
+    @classmethod
+    def build(cls, post_id):
+        """
+        build: store the document of a post from its post, comments and
+               likes, in a transaction so no write in between is missed
+        Args:
+            cls (self pointer): pointer to class object, does not need to be passed in
+            post_id (int): ID of the post
+        Returns:
+            database object of the document, or None if there is no such post
+        """
+        def txn():
+            post = db.get(post_key(post_id))
+            if not post:
+                return None
+            document = cls.create(post, Comments.all().ancestor(post).fetch(None))
+            document.put()
+            return document
+        return db.run_in_transaction(txn)
+
+
+    def get_document(self):
+        """
+        get_document: the stored document
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            the document dict
+        """
+        return postDocument.loads(self.data)
+
+
+    def change(self, function, *args):
+        """
+        change: apply one of the postDocument functions to the stored document
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            function (function): takes the document dict and *args, and
+                                 changes the document in place
+            *args (varies): more arguments of function
+        Returns:
+            what function returns
+        """
+        doc = self.get_document()
+        result = function(doc, *args)
+        self.data = postDocument.dumps(doc)
+        return result
+
+
+class Ranking(db.Model):
+    entries = db.TextProperty(default = "[]")
+
+
+class Archive(db.Model):
+    counts = db.TextProperty(default = "{}")
+
+
+class Purge(db.Model):
+    phase = db.StringProperty(required = True, indexed = False)
+    posts = db.IntegerProperty(default = 0, indexed = False)
+    comments = db.IntegerProperty(default = 0, indexed = False)
+    likes = db.IntegerProperty(default = 0, indexed = False)
+    started = db.DateTimeProperty(auto_now_add = True, indexed = False)
+    finished = db.DateTimeProperty(indexed = False)
+
+
+class Blob(db.Model):
+    data = db.BlobProperty()
 
 
 def blog_key(name = "default"):
@@ -215,6 +473,19 @@ def blog_key(name = "default"):
     Args:
         name (str): nae of datastore group
     Returns:
-        key of blogs datastore in the group
+        key of blogs datastore in the group, the parent of posts and comments
+        written before they moved into per-post entity groups
     """
     return db.Key.from_path("blogs" , name)
+
+
+def post_key(post_id):
+    """
+    post_key: key of a post; each post is the root of its own entity group,
+              with its Comments and Likes stored as children
+    Args:
+        post_id (int): ID of the post
+    Returns:
+        database Key of the post
+    """
+    return db.Key.from_path("Post", int(post_id))
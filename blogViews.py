@@ -0,0 +1,57 @@
+import jinja2
+import os
+
+### My modules
+import htmlOutput
+
+template_dir = os.path.join(os.path.dirname(__file__), "templates")
+jinja_env = jinja2.Environment(loader = jinja2.FileSystemLoader(template_dir),
+                               autoescape = True,
+                               extensions = [htmlOutput.MinifyExtension])
+
+
+### Rendering shared by every storage backend's post and comment objects
+class View(object):
+
+    def render_str(self, template, **params):
+        """
+        render_str: render a template
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            template (str): the template file to be rendered
+            **params (varies): any extra parameteres to be passed to the rendered template
+        Returns:
+            rendered template and the parameters in **params
+        """
+        t = jinja_env.get_template(template)
+        return t.render(params)
+
+
+class CommentView(View):
+
+    def render(self, username):
+        """
+        render: wrapper for rendering a template
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            username (str): username of person viewing the page
+        Returns:
+            rendered template file passed through render_str
+        """
+        self._render_text = self.content
+        return self.render_str("comment.html", c = self, username = username)
+
+
+class PostView(View):
+
+    def render(self, username):
+        """
+        render: wrapper for rendering a template
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            username (str): username of person viewing the page
+        Returns:
+            rendered template file passed through render_str
+        """
+        self._render_text = self.content
+        return self.render_str("post.html", p = self, username = username)
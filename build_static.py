@@ -0,0 +1,98 @@
+"""
+build_static: minify and fingerprint the files under static/
+
+Run before deploying:
+
+    python build_static.py
+
+Each asset is written to static/build/ with a hash of its contents in the
+name, and asset_manifest.json maps the original name to the hashed one. The
+manifest is kept next to main.py rather than in static/build/, because files
+under a static_dir handler are uploaded to the static file servers only and
+can't be opened by the app. Templates use the asset_url helper to link the hashed file, which
+app.yaml serves with a far-future expiration since its name changes
+whenever its contents do.
+"""
+import codecs
+import hashlib
+import json
+import os
+import re
+
+root = os.path.dirname(os.path.abspath(__file__))
+static_dir = os.path.join(root, "static")
+build_dir = os.path.join(static_dir, "build")
+manifest_path = os.path.join(root, "asset_manifest.json")
+
+
+def minify_css(text):
+    """
+    minify_css: strip comments and insignificant whitespace from a stylesheet
+    Args:
+        text (str): the stylesheet
+    Returns:
+        the minified stylesheet
+    """
+    text = re.sub(r"/\*.*?\*/", "", text, flags = re.S)
+    text = re.sub(r"\s+", " ", text)
+    text = re.sub(r"\s*([{};,>])\s*", r"\1", text)
+    text = re.sub(r":\s+", ":", text)
+    text = text.replace(";}", "}")
+    return text.strip()
+
+
+def minify_js(text):
+    """
+    minify_js: strip comment lines, indentation and blank lines from a script,
+               keeping line breaks so automatic semicolon insertion still holds
+    Args:
+        text (str): the script
+    Returns:
+        the minified script
+    """
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line and not line.startswith("//"):
+            lines.append(line)
+    return "\n".join(lines)
+
+
+MINIFIERS = {
+    ".css": minify_css,
+    ".js": minify_js,
+}
+
+
+def build():
+    """
+    build: minify and fingerprint every css and js file under static/
+    Returns:
+        the manifest dict of original name to hashed name
+    """
+    if not os.path.isdir(build_dir):
+        os.makedirs(build_dir)
+
+    manifest = {}
+    for name in sorted(os.listdir(static_dir)):
+        base, ext = os.path.splitext(name)
+        if ext not in MINIFIERS:
+            continue
+
+        with codecs.open(os.path.join(static_dir, name), "r", "utf-8-sig") as f:
+            text = MINIFIERS[ext](f.read()).encode("utf-8")
+
+        digest = hashlib.sha1(text).hexdigest()[:10]
+        hashed = "%s.%s%s" % (base, digest, ext)
+        with open(os.path.join(build_dir, hashed), "wb") as f:
+            f.write(text)
+        manifest[name] = "build/%s" % hashed
+
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent = 2, sort_keys = True)
+    return manifest
+
+
+if __name__ == "__main__":
+    for name, hashed in sorted(build().items()):
+        print("%s -> %s" % (name, hashed))
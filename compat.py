@@ -0,0 +1,20 @@
+### App Engine services, or local stand-ins when running outside App Engine
+#
+# memcache falls back to the in-process localMemcache; taskqueue is None,
+# and callers skip the work they would have queued or do it inline. db and
+# apiproxy_errors are None, as nothing outside App Engine uses the datastore.
+try:
+    from google.appengine.api import memcache
+    from google.appengine.api import namespace_manager
+    from google.appengine.api import taskqueue
+    from google.appengine.ext import db
+    from google.appengine.runtime import apiproxy_errors
+    ON_APP_ENGINE = True
+except ImportError:
+    import localMemcache as memcache
+    # localMemcache keeps the current namespace of each thread itself
+    namespace_manager = memcache
+    taskqueue = None
+    db = None
+    apiproxy_errors = None
+    ON_APP_ENGINE = False
@@ -0,0 +1,458 @@
+import logging
+
+### My modules
+import archive
+import blogData
+import entityCache
+import likeBuffer
+import postDocument
+import rankings
+import stalePages
+import storage
+import tenants
+
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+from google.appengine.runtime import apiproxy_errors
+
+# posts read by one RPC of recent_posts()
+RECENT_BATCH = 1000
+# entities under a deleted post removed by each datastore call, well under
+# the mutation limit of a commit
+DELETE_BATCH = 200
+
+
+def delete_children(post_key):
+    """
+    delete_children: delete everything stored under a deleted post, one
+                     batch at a time
+    Args:
+        post_key (Key): database Key of the post
+    Returns:
+        the number of entities deleted
+    """
+    # an ancestor query is strongly consistent, so each batch starts where
+    # the deleted one ended
+    query = db.Query(keys_only = True).ancestor(post_key)
+    removed = 0
+    while True:
+        keys = query.fetch(DELETE_BATCH)
+        if not keys:
+            return removed
+        db.delete(keys)
+        entityCache.invalidate(*keys)
+        removed += len(keys)
+
+
+### App Engine datastore backend
+class DatastoreStorage(storage.Storage):
+
+    def user_by_id(self, uid):
+        """
+        user_by_id: get User by ID, through the entity cache
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            uid (int): UID of the user to look up
+        Returns:
+            database object of the User, or None
+        """
+        return entityCache.get(db.Key.from_path("User", int(uid),
+                                                parent = blogData.users_key()))
+
+
+    def user_by_name(self, name):
+        """
+        user_by_name: get User by name
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            name (str): name of the user to look up
+        Returns:
+            database object of the User, or None
+        """
+        return blogData.User.by_name(name)
+
+
+    def register_user(self, name, pw, email = None):
+        """
+        register_user: store a new user
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            name (str): name of the user to add
+            pw (str): password of the user to add, unencrypted
+            email (str): optional email address of user
+        Returns:
+            database object of the new user
+        """
+        u = blogData.User.register(name, pw, email)
+        u.put()
+        return u
+
+
+    def usernames(self):
+        """
+        usernames: iterate over every username, with a projection query
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            generator of usernames
+        """
+        query = blogData.User.all(projection = ("name",))
+        for u in query.ancestor(blogData.users_key()).run(batch_size = 1000):
+            yield u.name
+
+
+    def get_post(self, post_id):
+        """
+        get_post: get a post by ID, through the entity cache
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post_id (int): ID of the post
+        Returns:
+            post object, or None
+        """
+        return entityCache.get(blogData.post_key(post_id))
+
+
+    def recent_posts(self):
+        """
+        recent_posts: all posts, newest first
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            list of the posts
+        """
+        query = blogData.Post.all().order("-created")
+        # one batch, so a longer front page isn't read with more RPCs
+        return list(query.run(config = stalePages.read_config(),
+                              batch_size = RECENT_BATCH))
+
+
+    def add_post(self, title, content, author):
+        """
+        add_post: store a new post
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            title (str): title of the post
+            content (str): content of the post
+            author (str): username of the author
+        Returns:
+            the new post object
+        """
+        post = blogData.Post(title = title, content = content, author = author)
+
+        def txn():
+            post.put()
+            archive.change(post.created, 1)
+        db.run_in_transaction_options(archive.XG_OPTIONS, txn)
+        archive.invalidate()
+        return post
+
+
+    def edit_post(self, post, title, content):
+        """
+        edit_post: change the title and content of a post
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post (object): post object to change
+            title (str): the new title
+            content (str): the new content
+        Returns:
+            the updated post object
+        """
+        post = post.edit(title, content)
+        entityCache.invalidate(post.key(),
+                               blogData.PostDocument.key_for(post.key()))
+        return post
+
+
+    def delete_post(self, post):
+        """
+        delete_post: delete a post together with its comments and likes
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post (object): post object to delete
+        Returns:
+            no return value
+        """
+        def txn():
+            # a repeated delete must not count the post out of its month twice
+            if db.get(post.key()) is not None:
+                db.delete(post.key())
+                archive.change(post.created, -1)
+        db.run_in_transaction_options(archive.XG_OPTIONS, txn)
+        archive.invalidate()
+        entityCache.invalidate(post.key())
+        likeBuffer.discard(post.id)
+        rankings.remove(post.id)
+
+        # the transactions that add comments, likes and documents read the
+        # post first, so nothing more can be added under it now
+        try:
+            delete_children(post.key())
+        except (db.Error, apiproxy_errors.Error):
+            logging.exception("could not delete what is under post %d, "
+                              "leaving it to a task", post.id)
+            deferred.defer(tenants.call, tenants.current()[0],
+                           delete_children, post.key())
+
+
+    def post_document(self, post_id):
+        """
+        post_document: the stored read document of a post, through the entity
+                       cache; built on first use, and rebuilt when its
+                       postDocument.VERSION is out of date
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post_id (int): ID of the post
+        Returns:
+            the document dict, or None if there is no such post
+        """
+        key = blogData.PostDocument.key_for(blogData.post_key(post_id))
+        document = entityCache.get(key)
+        doc = document and document.get_document()
+        if not doc or doc["version"] != postDocument.VERSION:
+            document = blogData.PostDocument.build(post_id)
+            if document is None:
+                return None
+            entityCache.invalidate(key)
+            doc = document.get_document()
+
+        # clicks still in the like buffer are counted from memcache
+        doc["like_count"] = max(doc["like_count"] +
+                                likeBuffer.pending_delta(post_id), 0)
+        return doc
+
+
+    def post_documents(self, post_ids):
+        """
+        post_documents: the read documents of several posts, with one entity
+                        cache lookup and one memcache read of buffered likes;
+                        only missing or outdated documents are built one by one
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post_ids (list): IDs of the posts
+        Returns:
+            list of document dicts, None for a post that doesn't exist
+        """
+        keys = [blogData.PostDocument.key_for(blogData.post_key(post_id))
+                for post_id in post_ids]
+        docs = []
+        for post_id, key, document in zip(post_ids, keys,
+                                          entityCache.get_multi(keys)):
+            doc = document and document.get_document()
+            if not doc or doc["version"] != postDocument.VERSION:
+                document = blogData.PostDocument.build(post_id)
+                if document is not None:
+                    entityCache.invalidate(key)
+                doc = document and document.get_document()
+            docs.append(doc)
+
+        deltas = likeBuffer.pending_deltas([post_id for post_id, doc
+                                            in zip(post_ids, docs) if doc])
+        for post_id, doc in zip(post_ids, docs):
+            if doc:
+                doc["like_count"] = max(doc["like_count"] + deltas[post_id], 0)
+        return docs
+
+
+    def get_comment(self, post_id, c_id):
+        """
+        get_comment: get a comment of a post, through the entity cache
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post_id (int): ID of the post the comment belongs to
+            c_id (int): ID of the comment
+        Returns:
+            comment object, or None
+        """
+        key = db.Key.from_path("Comments", int(c_id),
+                               parent = blogData.post_key(post_id))
+        return entityCache.get(key)
+
+
+    def comments_by_post(self, post_id):
+        """
+        comments_by_post: get the comments of a post
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post_id (int): ID of the post
+        Returns:
+            list of the comments, and the count of comments
+        """
+        # every comment is read, so they are counted without a count query
+        query = blogData.Comments.all().ancestor(blogData.post_key(post_id))
+        comments = list(query.run(config = stalePages.read_config()))
+        return comments, len(comments)
+
+
+    def add_comment(self, post, content, author):
+        """
+        add_comment: store a comment and update the post's comment count
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post (object): post object being commented on
+            content (str): text of the comment
+            author (str): username of the commenter
+        Returns:
+            tuple of the new comment and the updated post
+        """
+        comment, post = post.add_comment(content, author)
+        entityCache.invalidate(post.key(),
+                               blogData.PostDocument.key_for(post.key()))
+        rankings.mark("comments", post.id)
+        return comment, post
+
+
+    def edit_comment(self, comment, content):
+        """
+        edit_comment: change the content of a comment
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            comment (object): comment object to change
+            content (str): the new content
+        Returns:
+            the updated comment object
+        """
+        comment = comment.edit(content)
+        entityCache.invalidate(comment.key(), blogData.PostDocument.key_for(
+            comment.parent_key()))
+        return comment
+
+
+    def delete_comment(self, comment):
+        """
+        delete_comment: delete a comment and update the post's comment count
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            comment (object): comment object to delete
+        Returns:
+            the updated post object
+        """
+        post = db.get(comment.parent_key())
+        post = post.remove_comment(comment)
+        entityCache.invalidate(comment.key(), post.key(),
+                               blogData.PostDocument.key_for(post.key()))
+        rankings.mark("comments", post.id)
+        return post
+
+
+    def like_count(self, post):
+        """
+        like_count: the number of likes of a post, including buffered clicks
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post (object): post object
+        Returns:
+            the number of likes as an int
+        """
+        return likeBuffer.count(post)
+
+
+    def like_counts(self, posts):
+        """
+        like_counts: the like counts of several posts, with one memcache read
+                     of buffered clicks
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            posts (list): post objects
+        Returns:
+            list of the numbers of likes
+        """
+        return likeBuffer.counts(posts)
+
+
+    def toggle_like(self, post, username):
+        """
+        toggle_like: like a post, or remove the user's like, through the like buffer
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post (object): post object being liked
+            username (str): username of the user clicking like
+        Returns:
+            tuple of (True if the post is now liked by the user, new like count)
+        """
+        return likeBuffer.toggle(post, username)
+
+
+    def top_posts(self, metric, window = "all", limit = 20):
+        """
+        top_posts: the highest ranked posts, from the precomputed rankings
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            metric (str): one of storage.METRICS
+            window (str): a key of storage.WINDOWS
+            limit (int): maximum number of posts to return
+        Returns:
+            list of (post object, count) tuples, highest count first
+        """
+        return rankings.top(metric, window, limit)
+
+
+    def posts_in_month(self, year, month, cursor = None,
+                       limit = storage.ARCHIVE_PAGE_SIZE):
+        """
+        posts_in_month: a page of the posts created in a month, newest first,
+                        with a range query on created
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            year (int): the year
+            month (int): the month, 1 to 12
+            cursor (str): cursor returned with the previous page, or None
+            limit (int): maximum number of posts to return
+        Returns:
+            tuple of (list of post objects, cursor of the next page or None);
+            raises ValueError if the cursor is not valid
+        """
+        start, end = storage.month_range(year, month)
+        query = (blogData.Post.all().filter("created >=", start)
+                 .filter("created <", end).order("-created"))
+        try:
+            posts = query.with_cursor(cursor).fetch(limit)
+        except (db.BadValueError, db.BadRequestError):
+            raise ValueError("invalid cursor")
+        # a full page may be followed by an empty one
+        return posts, query.cursor() if len(posts) == limit else None
+
+
+    def archive_counts(self):
+        """
+        archive_counts: the months that have posts, from the stored counts
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            list of (year, month, number of posts), newest first
+        """
+        return archive.counts()
+
+
+    def get_blob(self, name):
+        """
+        get_blob: the bytes stored under a name
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            name (str): key name of the Blob
+        Returns:
+            the bytes, or None
+        """
+        blob = blogData.Blob.get_by_key_name(name)
+        return blob and blob.data
+
+
+    def update_blob(self, name, function):
+        """
+        update_blob: replace the bytes stored under a name in a transaction
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            name (str): key name of the Blob
+            function (function): takes the stored bytes, or None, and returns
+                                 the bytes to store
+        Returns:
+            the bytes stored
+        """
+        def txn():
+            blob = blogData.Blob.get_by_key_name(name)
+            data = function(blob and blob.data)
+            if data is not None:
+                blogData.Blob(key_name = name, data = db.Blob(data)).put()
+            return data
+        return db.run_in_transaction(txn)
@@ -0,0 +1,301 @@
+import collections
+import threading
+import time
+
+### My modules
+import stalePages
+
+from google.appengine.api import memcache
+from google.appengine.api import namespace_manager
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import db
+
+LOCAL_SIZE = 1000
+LOCAL_TTL = 5
+MEMCACHE_TTL = 600
+DATA_PREFIX = "entity:"
+VERSION_PREFIX = "entityver:"
+
+
+### Two-tier entity cache
+#
+# Lookups go to a small per-instance LRU first, then memcache, then the
+# datastore. Every key has a version stamp in memcache that writers bump
+# through invalidate(); a memcache entry is only used if it was stored under
+# the current version. Local entries are not checked against the version, so
+# LOCAL_TTL bounds how long another instance can serve an old copy.
+class LRUCache(object):
+
+    def __init__(self, size, ttl):
+        """
+        __init__: create an empty cache
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            size (int): maximum number of entries kept
+            ttl (int): seconds an entry stays valid
+        Returns:
+            no return value
+        """
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get(self, key):
+        """
+        get: look up a value, marking it as recently used
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            key (str): key of the entry
+        Returns:
+            the value, or None if missing or expired
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                return None
+            self.entries[key] = entry
+            return entry[1]
+
+
+    def set(self, key, value):
+        """
+        set: store a value, evicting the least recently used entries when full
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            key (str): key of the entry
+            value (varies): value to store
+        Returns:
+            no return value
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last = False)
+
+
+    def delete(self, key):
+        """
+        delete: drop an entry
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            key (str): key of the entry
+        Returns:
+            no return value
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+    def clear(self):
+        """
+        clear: drop every entry
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        with self.lock:
+            self.entries.clear()
+
+
+local_caches = {}
+local_caches_lock = threading.Lock()
+stats = collections.Counter()
+stats_lock = threading.Lock()
+
+
+def count(name):
+    """
+    count: add one to a hit/miss counter
+    Args:
+        name (str): name of the counter
+    Returns:
+        no return value
+    """
+    with stats_lock:
+        stats[name] += 1
+
+
+def get_stats():
+    """
+    get_stats: the hit/miss counters of this instance, for monitoring
+    Returns:
+        dict of counter name to value
+    """
+    with stats_lock:
+        return dict(stats, local_size = sum(len(cache.entries)
+                                            for cache in local_caches.values()))
+
+
+def encode(entity):
+    """
+    encode: serialize an entity, so cached copies are never shared between requests
+    Args:
+        entity (object): database object
+    Returns:
+        the serialized entity as a string
+    """
+    return db.model_to_protobuf(entity).Encode()
+
+
+def decode(data):
+    """
+    decode: rebuild an entity serialized by encode
+    Args:
+        data (str): the serialized entity
+    Returns:
+        a new database object
+    """
+    return db.model_from_protobuf(entity_pb.EntityProto(data))
+
+
+def new_version():
+    """
+    new_version: starting version stamp for a key whose stamp is not in memcache
+    Returns:
+        the version as an int, unique enough that it won't match an older stamp
+    """
+    return int(time.time() * 1000)
+
+
+def local_cache():
+    """
+    local_cache: this instance's LRU for the current namespace; each blog has
+                 its own, so a busy blog can't evict another's entries
+    Returns:
+        the LRUCache
+    """
+    namespace = namespace_manager.get_namespace()
+    with local_caches_lock:
+        if namespace not in local_caches:
+            local_caches[namespace] = LRUCache(LOCAL_SIZE, LOCAL_TTL)
+        return local_caches[namespace]
+
+
+def get(key):
+    """
+    get: get an entity through the local and memcache tiers
+    Args:
+        key (Key): database Key of the entity
+    Returns:
+        database object of the entity, or None if it doesn't exist
+    """
+    skey = str(key)
+    local = local_cache()
+    data = local.get(skey)
+    if data is not None:
+        count("local_hits")
+        return decode(data)
+
+    client = memcache.Client()
+    found = stalePages.read_cache([DATA_PREFIX + skey, VERSION_PREFIX + skey])
+    version = found.get(VERSION_PREFIX + skey)
+    cached = found.get(DATA_PREFIX + skey)
+    if version is not None and cached and cached[0] == version:
+        count("memcache_hits")
+        local.set(skey, cached[1])
+        return decode(cached[1])
+
+    count("misses")
+    if version is None:
+        # stamp the key before reading it, so a write after the read bumps
+        # the stamp this copy is stored under
+        client.add(VERSION_PREFIX + skey, new_version())
+        version = client.get(VERSION_PREFIX + skey)
+    entity = db.get(key, config = stalePages.read_config())
+    if entity is None:
+        return None
+
+    data = encode(entity)
+    # a write after the db.get bumped the version, so this copy is stored
+    # under a stamp that no longer matches and is never served
+    if version is not None:
+        client.set(DATA_PREFIX + skey, (version, data), time = MEMCACHE_TTL)
+    local.set(skey, data)
+    return entity
+
+
+def get_multi(keys):
+    """
+    get_multi: get several entities through the local and memcache tiers,
+               with one memcache read and one datastore get for the misses
+    Args:
+        keys (list): database Keys of the entities
+    Returns:
+        list of database objects, None where an entity doesn't exist
+    """
+    local = local_cache()
+    results = [None] * len(keys)
+    wanted = {}
+    for i, key in enumerate(keys):
+        data = local.get(str(key))
+        if data is not None:
+            count("local_hits")
+            results[i] = decode(data)
+        else:
+            wanted.setdefault(str(key), []).append(i)
+    if not wanted:
+        return results
+
+    client = memcache.Client()
+    found = stalePages.read_cache([prefix + skey for skey in wanted
+                                   for prefix in (DATA_PREFIX, VERSION_PREFIX)])
+    missed = []
+    for skey, positions in wanted.items():
+        version = found.get(VERSION_PREFIX + skey)
+        cached = found.get(DATA_PREFIX + skey)
+        if version is not None and cached and cached[0] == version:
+            count("memcache_hits")
+            local.set(skey, cached[1])
+            for i in positions:
+                results[i] = decode(cached[1])
+        else:
+            count("misses")
+            missed.append(skey)
+    if not missed:
+        return results
+
+    # as in get(), keys are stamped before they are read
+    unstamped = [VERSION_PREFIX + skey for skey in missed
+                 if found.get(VERSION_PREFIX + skey) is None]
+    if unstamped:
+        client.add_multi(dict((k, new_version()) for k in unstamped))
+        found.update(client.get_multi(unstamped))
+    entities = db.get([keys[wanted[skey][0]] for skey in missed],
+                      config = stalePages.read_config())
+    stored = dict((skey, entity) for skey, entity in zip(missed, entities)
+                  if entity is not None)
+
+    to_set = {}
+    for skey, entity in stored.items():
+        data = encode(entity)
+        version = found.get(VERSION_PREFIX + skey)
+        # as in get(), a copy stored under an outdated stamp is never served
+        if version is not None:
+            to_set[DATA_PREFIX + skey] = (version, data)
+        local.set(skey, data)
+        for i in wanted[skey]:
+            results[i] = decode(data)
+    client.set_multi(to_set, time = MEMCACHE_TTL)
+    return results
+
+
+def invalidate(*keys):
+    """
+    invalidate: drop cached copies of entities after they were written or deleted
+    Args:
+        *keys (Key): database Keys of the changed entities
+    Returns:
+        no return value
+    """
+    client = memcache.Client()
+    local = local_cache()
+    for key in keys:
+        skey = str(key)
+        local.delete(skey)
+        client.incr(VERSION_PREFIX + skey, initial_value = new_version())
+    client.delete_multi([DATA_PREFIX + str(key) for key in keys])
+    count("invalidations")
@@ -0,0 +1,323 @@
+"""
+export_static: render the whole blog into plain HTML files
+
+    python export_static.py [output directory]
+
+Writes every post's permalink, the front page in pages of PAGE_SIZE posts,
+a paged list of each author's posts and each month's archive page into
+the output directory (snapshot/ by default), as <url>/index.html, and
+copies static/ next to them. The pages are rendered through the same
+templates as the live site, from the storage backend BLOG_STORAGE selects
+(SQLite unless told otherwise, as with wsgi.py).
+
+Each page's inputs (the last_modified of its posts and comments, their
+like counts, the templates and the asset manifest) are hashed, and the
+hashes are kept in .snapshot.json in the output directory, so a rerun only
+renders the pages whose inputs changed and deletes the pages of removed
+posts. Pages are rendered and written by WORKERS threads, each replacing
+its file with a rename so a file server never sees half a page.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+from multiprocessing.pool import ThreadPool
+
+# the export reads the standalone database unless told otherwise
+os.environ.setdefault("BLOG_STORAGE", "sqlite")
+
+### My modules
+import main
+import postDocument
+import storage
+
+root = os.path.dirname(os.path.abspath(__file__))
+template_dir = os.path.join(root, "templates")
+static_dir = os.path.join(root, "static")
+STATE_FILE = ".snapshot.json"
+PAGE_SIZE = 10
+WORKERS = 8
+
+
+def fingerprint(*parts):
+    """
+    fingerprint: hash the inputs of a page
+    Args:
+        *parts (varies): JSON serializable inputs
+    Returns:
+        hex digest string
+    """
+    return hashlib.sha1(json.dumps(parts, sort_keys = True,
+                                   default = str).encode("utf-8")).hexdigest()
+
+
+def site_fingerprint():
+    """
+    site_fingerprint: hash of what every page depends on, so changing a
+                      template or rebuilding the assets re-renders them all
+    Returns:
+        hex digest string
+    """
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(template_dir)):
+        with open(os.path.join(template_dir, name), "rb") as f:
+            digest.update(name.encode("utf-8") + f.read())
+    digest.update(json.dumps(main.asset_manifest, sort_keys = True)
+                  .encode("utf-8"))
+    digest.update(str(postDocument.VERSION).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def read_blog(store):
+    """
+    read_blog: every post newest first, with its comments and like count
+    Args:
+        store (object): the storage backend
+    Returns:
+        list of dicts with the post, comments, like_count and the post's
+        fingerprint
+    """
+    entries = []
+    for post in store.recent_posts():
+        comments, c_count = store.comments_by_post(post.id)
+        comments = sorted(comments, key = lambda c: c.created)
+        like_count = store.like_count(post)
+        entries.append({
+            "post": post,
+            "comments": comments,
+            "like_count": like_count,
+            "fingerprint": fingerprint(post.id, post.last_modified, like_count,
+                                       [(c.id, c.last_modified)
+                                        for c in comments]),
+        })
+    return entries
+
+
+def full_document(entry):
+    """
+    full_document: a post's read document holding all its comments, for
+                   the permalink
+    Args:
+        entry (dict): the post's entry from read_blog
+    Returns:
+        the document dict
+    """
+    doc = postDocument.build(entry["post"], entry["comments"],
+                             entry["like_count"])
+    doc["comments"] = [postDocument.comment_entry(c)
+                       for c in entry["comments"]]
+    return doc
+
+
+def summary_document(entry):
+    """
+    summary_document: a post's read document as on the front page, with its
+                      newest comments
+    Args:
+        entry (dict): the post's entry from read_blog
+    Returns:
+        the document dict
+    """
+    return postDocument.build(entry["post"], entry["comments"],
+                              entry["like_count"])
+
+
+def paged(url, entries):
+    """
+    paged: split a list of posts into pages, newest first
+    Args:
+        url (str): URL of the first page, e.g. "/blog"
+        entries (list): entries from read_blog
+    Returns:
+        list of (url, entries on the page, newer page url, older page url)
+    """
+    chunks = [entries[i:i + PAGE_SIZE]
+              for i in range(0, len(entries), PAGE_SIZE)] or [[]]
+    urls = [url] + ["%s/page/%d" % (url, n) for n in range(2, len(chunks) + 1)]
+    return [(urls[i], chunk,
+             urls[i - 1] if i > 0 else None,
+             urls[i + 1] if i + 1 < len(urls) else None)
+            for i, chunk in enumerate(chunks)]
+
+
+def plan(entries, months, site):
+    """
+    plan: every page of the snapshot
+    Args:
+        entries (list): entries from read_blog
+        months (list): archive_counts() of the backend
+        site (str): site_fingerprint()
+    Returns:
+        dict of url to (fingerprint, function rendering the page)
+    """
+    pages = {}
+
+    def add(url, parts, render):
+        pages[url] = (fingerprint(site, parts), render)
+
+    for entry in entries:
+        add("/blog/%s" % entry["post"].id, entry["fingerprint"],
+            lambda entry = entry: main.render_str(
+                "permalink.html", doc = full_document(entry)))
+
+    def add_list(url, heading, listed):
+        for page_url, chunk, newer, older in paged(url, listed):
+            add(page_url, [heading, months, newer, older,
+                           [e["fingerprint"] for e in chunk]],
+                lambda chunk = chunk, newer = newer, older = older:
+                main.render_str("frontpage.html", heading = heading,
+                                docs = [summary_document(e) for e in chunk],
+                                months = months, newer_url = newer,
+                                older_url = older))
+
+    add_list("/blog", None, entries)
+    authors = sorted(set(e["post"].author for e in entries))
+    for author in authors:
+        add_list("/blog/author/%s" % author, "Posts by %s" % author,
+                 [e for e in entries if e["post"].author == author])
+
+    for year, month, count in months:
+        start, end = storage.month_range(year, month)
+        posts = [e["post"] for e in entries
+                 if start <= e["post"].created < end]
+        add("/blog/archive/%d/%d" % (year, month),
+            [months, [(p.id, p.title, p.author) for p in posts]],
+            lambda posts = posts, year = year, month = month:
+            main.render_str("archive.html", posts = posts, cursor = None,
+                            year = year, month = month, months = months))
+    return pages
+
+
+def page_path(output_dir, url):
+    """
+    page_path: the file a page is written to
+    Args:
+        output_dir (str): the snapshot directory
+        url (str): URL of the page
+    Returns:
+        path of <url>/index.html under output_dir
+    """
+    return os.path.join(output_dir, url.strip("/"), "index.html")
+
+
+def write_file(path, data):
+    """
+    write_file: replace a file in one step, creating its directory
+    Args:
+        path (str): path of the file
+        data (str): its contents
+    Returns:
+        no return value
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # another worker made it first
+            if not os.path.isdir(directory):
+                raise
+
+    temp = "%s.tmp%d" % (path, os.getpid())
+    with open(temp, "wb") as f:
+        f.write(data)
+    if os.name == "nt" and os.path.exists(path):
+        os.remove(path)
+    os.rename(temp, path)
+
+
+def copy_static(output_dir, state):
+    """
+    copy_static: copy the files under static/ that changed, and favicon.ico
+    Args:
+        output_dir (str): the snapshot directory
+        state (dict): fingerprints of the previous run, updated in place
+    Returns:
+        the number of files copied
+    """
+    files = [os.path.join(root, "favicon.ico")]
+    for directory, dirs, names in os.walk(static_dir):
+        files.extend(os.path.join(directory, name) for name in names)
+
+    copied = 0
+    for path in files:
+        if not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        name = os.path.relpath(path, root)
+        target = os.path.join(output_dir, name)
+        if state.get(name) != digest or not os.path.exists(target):
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            shutil.copyfile(path, target)
+            state[name] = digest
+            copied += 1
+    return copied
+
+
+def export(output_dir):
+    """
+    export: bring a snapshot directory up to date with the blog
+    Args:
+        output_dir (str): the snapshot directory
+    Returns:
+        dict of the number of pages written, unchanged and removed, and of
+        static files copied
+    """
+    state_path = os.path.join(output_dir, STATE_FILE)
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        state = {}
+
+    store = storage.get_backend()
+    pages = plan(read_blog(store), store.archive_counts(), site_fingerprint())
+    changed = [url for url, (fp, render) in pages.items()
+               if state.get(url) != fp or
+               not os.path.exists(page_path(output_dir, url))]
+
+    def build(url):
+        body = pages[url][1]()
+        write_file(page_path(output_dir, url), body.encode("utf-8"))
+
+    pool = ThreadPool(WORKERS)
+    try:
+        pool.map(build, changed)
+    finally:
+        pool.close()
+        pool.join()
+
+    removed = [url for url in state
+               if url.startswith("/") and url not in pages]
+    for url in removed:
+        path = page_path(output_dir, url)
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            # drops the page's directory if nothing else is left in it
+            os.removedirs(os.path.dirname(path))
+        except OSError:
+            pass
+
+    new_state = dict((url, fp) for url, (fp, render) in pages.items())
+    new_state.update((name, fp) for name, fp in state.items()
+                     if not name.startswith("/"))
+    copied = copy_static(output_dir, new_state)
+    write_file(state_path, json.dumps(new_state, indent = 2,
+                                      sort_keys = True).encode("utf-8"))
+    return {"written": len(changed),
+            "unchanged": len(pages) - len(changed),
+            "removed": len(removed),
+            "static": copied}
+
+
+if __name__ == "__main__":
+    output_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(root,
+                                                                    "snapshot")
+    result = export(os.path.abspath(output_dir))
+    print("%(written)d pages written, %(unchanged)d unchanged, "
+          "%(removed)d removed, %(static)d static files copied" % result)
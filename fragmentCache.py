@@ -0,0 +1,145 @@
+import time
+
+### My modules
+import stalePages
+
+from compat import memcache
+
+LEASE_SECONDS = 10
+WAIT_SECONDS = 2
+POLL_SECONDS = 0.05
+# how long an expired value is kept to serve while it is being recomputed
+STALE_SECONDS = 3600
+LEASE_PREFIX = "lease:"
+FRONT_PAGE_KEY = "page:/blog"
+
+
+### Single-flight cache for rendered pages and fragments
+#
+# Values are stored as (fresh_until, value) and kept in memcache past their
+# freshness. When one expires, the first request to take the lease (a
+# memcache add) recomputes it; everyone else keeps getting the previous
+# value, or waits briefly for the new one if there is none, so an expiry
+# costs one recomputation instead of one per concurrent request.
+def get_or_compute(key, compute, ttl):
+    """
+    get_or_compute: get a cached value, letting only one request recompute it
+    Args:
+        key (str): memcache key of the value
+        compute (function): builds the value when it is missing or expired
+        ttl (int): seconds the value stays fresh
+    Returns:
+        the cached or newly computed value
+    """
+    entry = stalePages.read_cache([key]).get(key)
+    if entry and entry[0] > time.time():
+        return entry[1]
+
+    if memcache.add(LEASE_PREFIX + key, 1, time = LEASE_SECONDS):
+        try:
+            value = compute()
+            memcache.set(key, (time.time() + ttl, value),
+                         time = ttl + STALE_SECONDS)
+        finally:
+            memcache.delete(LEASE_PREFIX + key)
+        return value
+
+    # another request holds the lease and is recomputing
+    if entry:
+        return entry[1]
+
+    deadline = time.time() + WAIT_SECONDS
+    while time.time() < deadline:
+        time.sleep(POLL_SECONDS)
+        entry = stalePages.read_cache([key]).get(key)
+        if entry:
+            return entry[1]
+    return compute()
+
+
+def get_or_compute_multi(keys, compute, ttl):
+    """
+    get_or_compute_multi: get_or_compute() for several values, with one
+                          memcache call for each step; a value whose lease
+                          another request holds is served from its previous
+                          copy, or computed here without being stored
+    Args:
+        keys (list): memcache keys of the values
+        compute (function): takes the keys of the missing or expired values
+                            and returns a dict of key to value
+        ttl (int): seconds the values stay fresh
+    Returns:
+        dict of key to the cached or newly computed value
+    """
+    entries = stalePages.read_cache(keys)
+    now = time.time()
+    values = dict((key, entry[1]) for key, entry in entries.items()
+                  if entry[0] > now)
+    expired = [key for key in keys if key not in values]
+    if not expired:
+        return values
+
+    held = memcache.add_multi(dict((LEASE_PREFIX + key, 1) for key in expired),
+                              time = LEASE_SECONDS)
+    leased = [key for key in expired if LEASE_PREFIX + key not in held]
+    missing = list(leased)
+    for key in expired:
+        if key in leased:
+            continue
+        if key in entries:
+            values[key] = entries[key][1]
+        else:
+            missing.append(key)
+    if not missing:
+        return values
+
+    try:
+        computed = compute(missing)
+        if leased:
+            fresh_until = time.time() + ttl
+            memcache.set_multi(dict((key, (fresh_until, computed[key]))
+                                    for key in leased),
+                               time = ttl + STALE_SECONDS)
+    finally:
+        if leased:
+            memcache.delete_multi([LEASE_PREFIX + key for key in leased])
+    values.update(computed)
+    return values
+
+
+def expire(*keys):
+    """
+    expire: mark cached values as out of date; the old value is still served
+            while the next request recomputes it
+    Args:
+        *keys (str): memcache keys of the values
+    Returns:
+        no return value
+    """
+    for key in keys:
+        entry = memcache.get(key)
+        if entry:
+            memcache.set(key, (0, entry[1]), time = STALE_SECONDS)
+
+
+def drop(*keys):
+    """
+    drop: remove cached values outright, for content that must not be served
+          again even while it is recomputed
+    Args:
+        *keys (str): memcache keys of the values
+    Returns:
+        no return value
+    """
+    memcache.delete_multi(list(keys))
+
+
+def summary_key(post_id):
+    """
+    summary_key: memcache key of a post's rendered comments and likes section
+    Args:
+        post_id (int): ID of the post
+    Returns:
+        the memcache key string
+    """
+    return "summary:%s" % post_id
@@ -0,0 +1,147 @@
+import collections
+import gzip
+import io
+import re
+import threading
+
+### My modules
+import compat
+
+from jinja2.ext import Extension
+from jinja2.lexer import Token
+
+# bodies smaller than this aren't worth compressing
+MIN_COMPRESS = 512
+COMPRESS_LEVEL = 6
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript")
+
+# elements whose whitespace is significant or not HTML
+PRESERVE_RE = re.compile(r"<(/?)(pre|textarea|script|style)\b", re.I)
+SPACE_RE = re.compile(r"\s+")
+
+
+### Whitespace minification at template compile time
+#
+# The extension rewrites the literal text of a template as Jinja compiles
+# it, so each template is minified once when it's loaded rather than on
+# every render. Runs of whitespace collapse to a single space, which
+# browsers render the same, except inside <pre>, <textarea>, <script> and
+# <style>. Values substituted into a template are never touched.
+class MinifyExtension(Extension):
+
+    def filter_stream(self, stream):
+        """
+        filter_stream: minify the data tokens of a template
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            stream (object): jinja2 TokenStream of the template
+        Returns:
+            generator of the rewritten tokens
+        """
+        preserving = False
+        for token in stream:
+            if token.type != "data":
+                yield token
+                continue
+
+            text, preserving = minify(token.value, preserving)
+            count("template_bytes", len(token.value))
+            count("minified_template_bytes", len(text))
+            if text:
+                yield Token(token.lineno, "data", text)
+
+
+def minify(text, preserving = False):
+    """
+    minify: collapse insignificant whitespace in HTML
+    Args:
+        text (str): HTML text
+        preserving (bool): True if text starts inside a <pre>, <textarea>,
+                           <script> or <style> element
+    Returns:
+        tuple of (minified text, True if text ends inside one of them)
+    """
+    parts = []
+    start = 0
+    for match in PRESERVE_RE.finditer(text):
+        segment = text[start:match.start()]
+        parts.append(segment if preserving else SPACE_RE.sub(" ", segment))
+        parts.append(match.group(0))
+        preserving = not match.group(1)
+        start = match.end()
+
+    segment = text[start:]
+    parts.append(segment if preserving else SPACE_RE.sub(" ", segment))
+    return "".join(parts), preserving
+
+
+### Response compression
+def compress(request, response):
+    """
+    compress: gzip a response body if the client accepts it; App Engine's
+              front end compresses responses itself, so this only applies
+              when running standalone
+    Args:
+        request (object): webapp2 request
+        response (object): webapp2 response, changed in place
+    Returns:
+        no return value
+    """
+    content_type = response.headers.get("Content-Type", "")
+    if (compat.ON_APP_ENGINE or response.status_int != 200 or
+            "Content-Encoding" in response.headers or
+            not content_type.startswith(COMPRESSIBLE_TYPES)):
+        return
+
+    body = response.body
+    if len(body) < MIN_COMPRESS:
+        return
+
+    # shared caches must keep the compressed and plain copies apart
+    vary = response.headers.get("Vary")
+    response.headers["Vary"] = (vary + ", " if vary else "") + "Accept-Encoding"
+    if "gzip" not in request.headers.get("Accept-Encoding", ""):
+        return
+
+    buf = io.BytesIO()
+    f = gzip.GzipFile(fileobj = buf, mode = "wb",
+                      compresslevel = COMPRESS_LEVEL)
+    f.write(body)
+    f.close()
+    response.body = buf.getvalue()
+    response.headers["Content-Encoding"] = "gzip"
+    count("compressed_responses")
+    count("uncompressed_bytes", len(body))
+    count("compressed_bytes", len(response.body))
+
+
+### Byte counters
+stats = collections.Counter()
+stats_lock = threading.Lock()
+
+
+def count(name, amount = 1):
+    """
+    count: add to an output size counter
+    Args:
+        name (str): name of the counter
+        amount (int): amount to add
+    Returns:
+        no return value
+    """
+    with stats_lock:
+        stats[name] += amount
+
+
+def get_stats():
+    """
+    get_stats: the output size counters of this instance, for monitoring;
+               template_bytes and minified_template_bytes are the literal
+               template text before and after minification, rendered_bytes
+               the pages rendered, and uncompressed_bytes and
+               compressed_bytes the bodies before and after gzip
+    Returns:
+        dict of counter name to value
+    """
+    with stats_lock:
+        return dict(stats)
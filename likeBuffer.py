@@ -0,0 +1,287 @@
+import json
+import time
+
+### My modules
+import blogData
+import entityCache
+import postDocument
+import rankings
+import stalePages
+
+from google.appengine.api import memcache
+from google.appengine.api import namespace_manager
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from google.appengine.runtime import apiproxy_errors
+
+QUEUE_NAME = "likes"
+LEASE_SECONDS = 60
+FLUSH_BATCH = 500
+CAS_RETRIES = 10
+
+
+### Write-behind like buffer
+#
+# A like click is journaled as a task on the "likes" pull queue and its effect
+# on the count is kept in memcache, so the request never writes to the
+# datastore. The flush task leases the journal in batches and, in one
+# transaction per post, writes the Likes entities and updates like_count.
+# The journal is durable, so an evicted memcache entry only makes counts lag
+# until the next flush; if the journal itself is unavailable the click is
+# written through. The journal is shared by every blog, so each click
+# records its namespace and is applied in it.
+def pending_key(post_id):
+    """
+    pending_key: memcache key of the buffered likes for a post
+    Args:
+        post_id (int): ID of the post
+    Returns:
+        the memcache key string
+    """
+    return "likebuf:%s" % post_id
+
+
+def update_pending(post_id, change):
+    """
+    update_pending: atomically apply a change to a post's buffered likes
+    Args:
+        post_id (int): ID of the post
+        change (function): takes the pending dict and returns the updated dict
+    Returns:
+        True if the change was stored, False if memcache kept losing the race
+    """
+    client = memcache.Client()
+    key = pending_key(post_id)
+    for i in range(CAS_RETRIES):
+        pending = client.gets(key)
+        if pending is None:
+            if client.add(key, change({})):
+                return True
+        elif client.cas(key, change(pending)):
+            return True
+    return False
+
+
+def discard(post_id):
+    """
+    discard: drop the buffered likes of a post, e.g. when it is deleted
+    Args:
+        post_id (int): ID of the post
+    Returns:
+        no return value
+    """
+    memcache.delete(pending_key(post_id))
+
+
+def stored_count(post):
+    """
+    stored_count: the flushed like count of a post
+    Args:
+        post (object): post object to count likes for
+    Returns:
+        like_count, or a count of the Likes entities for posts written before it existed
+    """
+    if post.like_count is not None:
+        return post.like_count
+
+    like, l_count = blogData.Likes.by_post(post.key().id(),
+                                           stalePages.read_config())
+    return l_count
+
+
+def pending_delta(post_id):
+    """
+    pending_delta: the change to a post's like count from clicks not yet flushed
+    Args:
+        post_id (int): ID of the post
+    Returns:
+        the change as an int
+    """
+    key = pending_key(post_id)
+    pending = stalePages.read_cache([key]).get(key) or {}
+    return sum(entry["delta"] for entry in pending.values())
+
+
+def pending_deltas(post_ids):
+    """
+    pending_deltas: pending_delta() of several posts with one memcache read
+    Args:
+        post_ids (list): IDs of the posts
+    Returns:
+        dict of post ID to the change as an int
+    """
+    found = stalePages.read_cache([pending_key(i) for i in post_ids])
+    return dict((i, sum(entry["delta"]
+                        for entry in (found.get(pending_key(i)) or {}).values()))
+                for i in post_ids)
+
+
+def count(post):
+    """
+    count: the like count of a post including clicks not yet flushed
+    Args:
+        post (object): post object to count likes for
+    Returns:
+        the number of likes as an int
+    """
+    return max(stored_count(post) + pending_delta(post.key().id()), 0)
+
+
+def counts(posts):
+    """
+    counts: count() of several posts with one memcache read
+    Args:
+        posts (list): post objects to count likes for
+    Returns:
+        list of the numbers of likes
+    """
+    deltas = pending_deltas([post.key().id() for post in posts])
+    return [max(stored_count(post) + deltas[post.key().id()], 0)
+            for post in posts]
+
+
+def toggle(post, username):
+    """
+    toggle: buffer a like click, liking the post or removing the user's like
+    Args:
+        post (object): post object being liked
+        username (str): username of the user clicking like
+    Returns:
+        tuple of (True if the post is now liked by the user, new like count)
+    """
+    post_id = post.key().id()
+
+    entry = (memcache.get(pending_key(post_id)) or {}).get(username)
+    if entry:
+        liked = not entry["liked"]
+    else:
+        liked = not blogData.Likes.by_user_and_post(post_id, username)
+
+    event = dict(post_id = post_id, username = username, liked = liked,
+                 ts = time.time(),
+                 namespace = namespace_manager.get_namespace())
+    try:
+        taskqueue.Queue(QUEUE_NAME).add(
+            taskqueue.Task(payload = json.dumps(event), method = "PULL",
+                           tag = str(post_id)))
+    except (taskqueue.Error, apiproxy_errors.Error):
+        apply_events(post_id, [event])
+        return liked, count(post)
+
+    def change(pending):
+        old = pending.get(username)
+        delta = old["delta"] if old else 0
+        pending[username] = dict(liked = liked, ts = event["ts"],
+                                 delta = delta + (1 if liked else -1))
+        return pending
+
+    update_pending(post_id, change)
+    return liked, count(post)
+
+
+def apply_events(post_id, events):
+    """
+    apply_events: write the final like state of each user to the datastore
+    Args:
+        post_id (int): ID of the post the events are for
+        events (list): latest like event per user for this post
+    Returns:
+        no return value
+    """
+    key = blogData.post_key(post_id)
+    document_key = blogData.PostDocument.key_for(key)
+    like_keys = [blogData.Likes.key_for(post_id, event["username"])
+                 for event in events]
+
+    def txn():
+        # the post, its likes, its counter and its document share one
+        # entity group
+        post, document = db.get([key, document_key])
+        if not post:
+            return None
+
+        base = stored_count(post)
+        to_put = []
+        to_delete = []
+        deltas = {}
+        for event, existing in zip(events, db.get(like_keys)):
+            username = event["username"]
+            deltas[username] = 0
+            if event["liked"] and not existing:
+                to_put.append(blogData.Likes.create(post_id, username))
+                deltas[username] = 1
+            elif not event["liked"] and existing:
+                to_delete.append(existing)
+                deltas[username] = -1
+
+        post.like_count = base + sum(deltas.values())
+        if document:
+            document.change(postDocument.set_likes, post.like_count)
+            to_put.append(document)
+        db.put(to_put + [post])
+        db.delete(to_delete)
+        return deltas, post
+
+    result = db.run_in_transaction(txn)
+    if result is None:
+        return discard(post_id)
+
+    deltas, post = result
+    entityCache.invalidate(key, document_key)
+    rankings.mark("likes", post_id)
+
+    def settle(pending):
+        for event in events:
+            entry = pending.get(event["username"])
+            if not entry:
+                continue
+            if entry["ts"] <= event["ts"]:
+                del pending[event["username"]]
+            else:
+                entry["delta"] -= deltas[event["username"]]
+        return pending
+
+    update_pending(post_id, settle)
+
+
+def flush(batch_size = FLUSH_BATCH):
+    """
+    flush: drain the like journal into the datastore
+    Args:
+        batch_size (int): number of journaled clicks to lease at a time
+    Returns:
+        the number of clicks flushed
+    """
+    queue = taskqueue.Queue(QUEUE_NAME)
+    flushed = 0
+    while True:
+        tasks = queue.lease_tasks(LEASE_SECONDS, batch_size)
+        if not tasks:
+            break
+
+        # only the last click of each user on each post matters
+        latest = {}
+        for task in tasks:
+            event = json.loads(task.payload)
+            k = (event.get("namespace", ""), event["post_id"],
+                 event["username"])
+            if k not in latest or latest[k]["ts"] <= event["ts"]:
+                latest[k] = event
+
+        by_post = {}
+        for (namespace, post_id, username), event in latest.items():
+            by_post.setdefault((namespace, post_id), []).append(event)
+
+        previous = namespace_manager.get_namespace()
+        try:
+            for (namespace, post_id), events in by_post.items():
+                namespace_manager.set_namespace(namespace)
+                apply_events(post_id, events)
+        finally:
+            namespace_manager.set_namespace(previous)
+
+        queue.delete_tasks(tasks)
+        flushed += len(tasks)
+        if len(tasks) < batch_size:
+            break
+    return flushed
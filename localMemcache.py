@@ -0,0 +1,299 @@
+import pickle
+import threading
+import time
+
+
+### In-process stand-in for google.appengine.api.memcache
+#
+# Used by compat.py when the blog runs outside App Engine. It implements the
+# subset of the memcache API this app uses, keeps pickled copies so callers
+# never share mutable values, and is shared by all threads of the process.
+# It also stands in for namespace_manager: keys are kept apart by the
+# namespace set on the calling thread.
+class Client(object):
+
+    def __init__(self):
+        """
+        __init__: create a client of the process wide cache
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        self.cas_ids = {}
+
+
+    def _live(self, key):
+        """
+        _live: get the stored entry of a key if it hasn't expired; call with the lock held
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            key (str): the cache key
+        Returns:
+            tuple of (expires, cas id, pickled value), or None
+        """
+        key = (get_namespace(), key)
+        entry = entries.get(key)
+        if entry and entry[0] and entry[0] < time.time():
+            del entries[key]
+            return None
+        return entry
+
+
+    def _store(self, key, value, expires):
+        """
+        _store: store a value; call with the lock held
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            key (str): the cache key
+            value (varies): value to store
+            expires (int): seconds until the value expires, 0 for never
+        Returns:
+            True
+        """
+        global next_cas_id
+        next_cas_id += 1
+        deadline = time.time() + expires if expires else 0
+        entries[(get_namespace(), key)] = (deadline, next_cas_id, pickle.dumps(value, -1))
+        return True
+
+
+    def get(self, key):
+        """
+        get: get a value
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            key (str): the cache key
+        Returns:
+            the value, or None if missing
+        """
+        with lock:
+            entry = self._live(key)
+            return pickle.loads(entry[2]) if entry else None
+
+
+    def get_multi(self, keys, for_cas = False):
+        """
+        get_multi: get several values
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            keys (list): the cache keys
+            for_cas (bool): remember the versions of the values for cas
+        Returns:
+            dict of the keys found to their values
+        """
+        with lock:
+            found = {}
+            for key in keys:
+                entry = self._live(key)
+                if entry:
+                    if for_cas:
+                        self.cas_ids[key] = entry[1]
+                    found[key] = pickle.loads(entry[2])
+            return found
+
+
+    def gets(self, key):
+        """
+        gets: get a value and remember its version for cas
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            key (str): the cache key
+        Returns:
+            the value, or None if missing
+        """
+        with lock:
+            entry = self._live(key)
+            if not entry:
+                return None
+            self.cas_ids[key] = entry[1]
+            return pickle.loads(entry[2])
+
+
+    def set(self, key, value, time = 0):
+        """
+        set: store a value
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            key (str): the cache key
+            value (varies): value to store
+            time (int): seconds until the value expires, 0 for never
+        Returns:
+            True
+        """
+        with lock:
+            return self._store(key, value, time)
+
+
+    def add(self, key, value, time = 0):
+        """
+        add: store a value only if the key is not already set
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            key (str): the cache key
+            value (varies): value to store
+            time (int): seconds until the value expires, 0 for never
+        Returns:
+            True if stored, False if the key was set
+        """
+        with lock:
+            if self._live(key):
+                return False
+            return self._store(key, value, time)
+
+
+    def set_multi(self, mapping, time = 0):
+        """
+        set_multi: store several values
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            mapping (dict): cache keys to values
+            time (int): seconds until the values expire, 0 for never
+        Returns:
+            list of the keys not stored, always empty
+        """
+        with lock:
+            for key, value in mapping.items():
+                self._store(key, value, time)
+            return []
+
+
+    def add_multi(self, mapping, time = 0):
+        """
+        add_multi: store several values, each only if its key is not already set
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            mapping (dict): cache keys to values
+            time (int): seconds until the values expire, 0 for never
+        Returns:
+            list of the keys not stored because they were set
+        """
+        with lock:
+            return [key for key, value in mapping.items()
+                    if not self.add(key, value, time)]
+
+
+    def cas(self, key, value, time = 0):
+        """
+        cas: store a value only if it hasn't changed since gets
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            key (str): the cache key
+            value (varies): value to store
+            time (int): seconds until the value expires, 0 for never
+        Returns:
+            True if stored, False if the value changed
+        """
+        with lock:
+            entry = self._live(key)
+            if not entry or entry[1] != self.cas_ids.pop(key, None):
+                return False
+            return self._store(key, value, time)
+
+
+    def cas_multi(self, mapping, time = 0):
+        """
+        cas_multi: store several values, each only if it hasn't changed since
+                   it was read for cas
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            mapping (dict): cache keys to values
+            time (int): seconds until the values expire, 0 for never
+        Returns:
+            list of the keys not stored because their values changed
+        """
+        with lock:
+            return [key for key, value in mapping.items()
+                    if not self.cas(key, value, time)]
+
+
+    def incr(self, key, delta = 1, initial_value = None):
+        """
+        incr: atomically add to an integer value
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            key (str): the cache key
+            delta (int): amount to add
+            initial_value (int): value to start from if the key is missing
+        Returns:
+            the new value, or None if missing and no initial_value
+        """
+        with lock:
+            entry = self._live(key)
+            if entry:
+                value = pickle.loads(entry[2]) + delta
+                expires = entry[0] - time.time() if entry[0] else 0
+            elif initial_value is not None:
+                value = initial_value + delta
+                expires = 0
+            else:
+                return None
+            self._store(key, value, expires)
+            return value
+
+
+    def delete(self, key):
+        """
+        delete: remove a value
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            key (str): the cache key
+        Returns:
+            True
+        """
+        with lock:
+            entries.pop((get_namespace(), key), None)
+            return True
+
+
+    def delete_multi(self, keys):
+        """
+        delete_multi: remove several values
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            keys (list): the cache keys
+        Returns:
+            True
+        """
+        with lock:
+            for key in keys:
+                entries.pop((get_namespace(), key), None)
+            return True
+
+
+entries = {}
+next_cas_id = 0
+lock = threading.RLock()
+namespace = threading.local()
+
+
+def get_namespace():
+    """
+    get_namespace: the namespace of the calling thread, like namespace_manager
+    Returns:
+        the namespace string, "" by default
+    """
+    return getattr(namespace, "name", "")
+
+
+def set_namespace(name):
+    """
+    set_namespace: set the namespace of the calling thread, like namespace_manager
+    Args:
+        name (str): the namespace, "" for the default one
+    Returns:
+        no return value
+    """
+    namespace.name = name or ""
+
+# module level functions, like google.appengine.api.memcache
+_client = Client()
+get = _client.get
+get_multi = _client.get_multi
+set = _client.set
+set_multi = _client.set_multi
+add = _client.add
+add_multi = _client.add_multi
+incr = _client.incr
+delete = _client.delete
+delete_multi = _client.delete_multi
@@ -1,4 +1,5 @@
 ﻿import os
+import logging
 import webapp2
 import jinja2
 import hashlib
@@ -6,18 +7,50 @@ import hmac
 import random
 import string
 import re
+import json
+import math
+import calendar
+import collections
 
 ### My modules
-import blogData
+import fragmentCache
+import htmlOutput
+import profiler
+import rateLimit
+import stalePages
+import storage
+import tenants
+import usernameFilter
 import validate
 
 from string import letters
 from functools import wraps
-from google.appengine.ext import db
 
 template_dir = os.path.join(os.path.dirname(__file__), "templates")
 jinja_env = jinja2.Environment(loader = jinja2.FileSystemLoader(template_dir),
-                               autoescape = True, trim_blocks = True)
+                               autoescape = True, trim_blocks = True,
+                               extensions = [htmlOutput.MinifyExtension])
+
+# how long shared caches may keep pages served to anonymous viewers
+PUBLIC_MAX_AGE = 60
+# how long the rendered front page and post summaries are reused; writes
+# expire them sooner
+FRONT_PAGE_TTL = 30
+SUMMARY_TTL = 300
+# serve permalinks and front page items from each post's read document
+# (postDocument.py) instead of the post, comment and like lookups; set
+# BLOG_POST_DOCUMENTS to "on" in app.yaml to turn it on
+POST_DOCUMENTS = os.environ.get("BLOG_POST_DOCUMENTS", "off") == "on"
+
+# written by build_static.py, maps static file names to fingerprinted ones
+manifest_path = os.path.join(os.path.dirname(__file__), "asset_manifest.json")
+try:
+    with open(manifest_path) as f:
+        asset_manifest = json.load(f)
+except IOError:
+    logging.warning("no %s, linking the unminified static files; run "
+                    "build_static.py before deploying", manifest_path)
+    asset_manifest = {}
 
 
 ### Decorators
@@ -31,9 +64,7 @@ def post_exists(function):
     """
     @wraps(function)
     def wrapper(self, post_id):
-        key = db.Key.from_path("Post", int(post_id),
-                               parent = blogData.blog_key())
-        post = db.get(key)
+        post = storage.get_backend().get_post(post_id)
         if post:
             return function(self, post_id, post)
         else:
@@ -51,10 +82,8 @@ def comment_exists(function):
         either the function with comment id and comment object, or redirects to 404 page
     """
     @wraps(function)
-    def wrapper(self, c_id):
-        key = db.Key.from_path("Comments", int(c_id),
-                                parent = blogData.blog_key())
-        comment = db.get(key)
+    def wrapper(self, post_id, c_id):
+        comment = storage.get_backend().get_comment(post_id, c_id)
         if comment:
             return function(self, c_id, comment)
         else:
@@ -63,6 +92,81 @@ def comment_exists(function):
     return wrapper
 
 
+def rate_limited(bucket):
+    """
+    rate_limited: decorator to limit how often a client can call a handler
+    Args:
+        bucket (str): name of the token bucket in rateLimit.LIMITS
+    Returns:
+        decorator that runs the function, or responds 429 with Retry-After
+        when the client's IP or logged in user is out of tokens
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(self, *a, **kw):
+            identities = ["ip:%s" % self.request.remote_addr]
+            if self.user:
+                identities.append("user:%s" % self.user.id)
+
+            retry = rateLimit.take(bucket, identities)
+            if retry:
+                retry = int(math.ceil(retry))
+                self.response.set_status(429, "Too Many Requests")
+                self.response.headers["Retry-After"] = str(retry)
+                return self.write("Too many requests, please try again in "
+                                  "%d seconds." % retry)
+            return function(self, *a, **kw)
+        return wrapper
+    return decorator
+
+
+def serves_stale(function):
+    """
+    serves_stale: decorator that serves the last good copy of a public page
+                  when rendering it runs out of stalePages.LATENCY_BUDGET
+                  or raises
+    Args:
+        function (function): the wrapped function
+    Returns:
+        the response of the function, or of the last good copy marked with
+        the stalePages.DEGRADED_HEADER
+    """
+    @wraps(function)
+    def wrapper(self, *a):
+        url = self.request.path_qs
+        stale = None if stalePages.is_refresh(self.request) else stalePages.get(url)
+
+        if stale is None:
+            function(self, *a)
+            stalePages.save(url, self.response)
+            return
+
+        # the reads of the render get deadlines from the budget, see
+        # stalePages.py
+        stalePages.start_budget()
+        try:
+            function(self, *a)
+            stalePages.save(url, self.response)
+            return
+        except stalePages.TIMEOUTS:
+            reason = "stale-timeout"
+        except Exception:
+            logging.exception("rendering %s failed", url)
+            reason = "stale-if-error"
+        finally:
+            stalePages.end_budget()
+
+        body, content_type = stale
+        stalePages.refresh(tenants.url(url))
+        self.response.clear()
+        self.response.set_status(200)
+        self.response.headers["Content-Type"] = content_type
+        self.response.headers["Cache-Control"] = "no-cache"
+        self.response.headers[stalePages.DEGRADED_HEADER] = reason
+        self.write(body)
+    return wrapper
+
+
 ### blog functions
 def render_str(template, **params):
     """
@@ -78,37 +182,108 @@ def render_str(template, **params):
     return t.render(params)
 
 
-def summary_details(post_id, author, username):
+def post_summaries(posts):
+    """
+    post_summaries: generates the comments and likes sections of posts; the
+                    output is the same for every viewer, viewer.js fills in
+                    the per-user links
+    Args:
+        posts (list): post objects of the posts being used
+    Returns:
+        list of rendered templates of the post details sections, from the
+        cache if fresh; the cached ones are read together, and the rest are
+        rendered with one query each for their comments
+    """
+    store = storage.get_backend()
+    by_key = collections.OrderedDict((fragmentCache.summary_key(post.id), post)
+                                     for post in posts)
+
+    def compute(keys):
+        missing = [by_key[key] for key in keys]
+        t = jinja_env.get_template("postsummary.html")
+        sections = {}
+        for key, post, l_count in zip(keys, missing, store.like_counts(missing)):
+            comment, c_count = store.comments_by_post(post.id)
+            sections[key] = t.render(post_id = post.id, c_count = c_count,
+                                     comments = comment, author = post.author,
+                                     l_count = l_count)
+        return sections
+
+    sections = fragmentCache.get_or_compute_multi(list(by_key), compute,
+                                                  SUMMARY_TTL)
+    return [sections[key] for key in by_key]
+
+
+def summary_details(post):
     """
     summary_details: generates the comments and likes section of a post
     Args:
-        post_id (int): ID of the post being used
-        author (str): the author of the post
-        username (str): the user viewing the post
+        post (object): post object of the post being used
     Returns:
-        rendered template of the post details section
+        rendered template of the post details section, from the cache if fresh
     """
-    comment, c_count = blogData.Comments.by_post(post_id)
+    return post_summaries([post])[0]
 
-    if not comment:
-        c_count = 0
-
-    like, l_count = blogData.Likes.by_post(post_id)
+jinja_env.filters["summary_details"] = summary_details
 
-    if not like:
-        l_count = 0
 
+def document_details(doc):
+    """
+    document_details: generates a post and its comments and likes section
+                      from the post's read document
+    Args:
+        doc (dict): the document, see postDocument.py
+    Returns:
+        rendered post and post details section
+    """
     t = jinja_env.get_template("postsummary.html")
-    return t.render(post_id = post_id, c_count = c_count, comments = comment,
-                    author = author, username = username, l_count = l_count,
-                    likes = like)
+    return doc["html"] + t.render(post_id = doc["id"],
+                                  c_count = doc["comment_count"],
+                                  comments = doc["comments"],
+                                  author = doc["author"],
+                                  l_count = doc["like_count"],
+                                  more_comments = (doc["comment_count"] >
+                                                   len(doc["comments"])))
 
-jinja_env.filters["summary_details"] = summary_details
+jinja_env.filters["document_details"] = document_details
+
+
+def asset_url(name):
+    """
+    asset_url: get the URL of a file under static/
+    Args:
+        name (str): name of the file, e.g. "main.css"
+    Returns:
+        URL of the minified, fingerprinted copy if build_static.py has been run,
+        otherwise of the original file
+    """
+    return "/static/%s" % asset_manifest.get(name, name)
+
+jinja_env.globals["asset_url"] = asset_url
+jinja_env.globals["url"] = tenants.url
+jinja_env.globals["month_names"] = calendar.month_name
 
 
 ### page handlers
 class Handler(webapp2.RequestHandler):
 
+    def redirect(self, uri, *a, **kw):
+        """
+        redirect: redirects within the current blog, adding its path prefix
+                  to site paths
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            uri (str): where to redirect to
+            *a (varies): arguments to be passed in to webapp2 redirect function
+            **kw (varies): arguments to be passed in to webapp2 redirect function
+        Returns:
+            the webapp2 redirect response
+        """
+        if uri.startswith("/"):
+            uri = tenants.url(uri)
+        return webapp2.RequestHandler.redirect(self, uri, *a, **kw)
+
+
     def write(self, *a, **kw):
         """
         write: wrapper for write functionality
@@ -139,7 +314,41 @@ class Handler(webapp2.RequestHandler):
         Returns:
             rendered template file passed through render_str
         """
-        self.write(self.render_str(template, **kw))
+        body = self.render_str(template, **kw)
+        htmlOutput.count("rendered_bytes", len(body))
+        self.write(body)
+
+
+    def write_json(self, obj, status = 200):
+        """
+        write_json: writes an object to the response as JSON
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            obj (dict): the object to be serialized
+            status (int): HTTP status code of the response
+        Returns:
+            no return value
+        """
+        self.response.set_status(status)
+        self.response.headers["Content-Type"] = "application/json; charset=utf-8"
+        self.write(json.dumps(obj))
+
+
+    def set_cache_headers(self):
+        """
+        set_cache_headers: lets shared caches store a page for anonymous
+                           viewers; only use on pages whose body is the same
+                           for every user
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        if self.user:
+            self.response.headers["Cache-Control"] = "private, max-age=0"
+        else:
+            self.response.headers["Cache-Control"] = ("public, max-age=%d" %
+                                                      PUBLIC_MAX_AGE)
 
 
     def set_secure_cookie(self, name, val):
@@ -152,9 +361,11 @@ class Handler(webapp2.RequestHandler):
         Returns:
             no return value
         """
-        cookie_val = validate.make_secure_val(val)
-        self.response.headers.add_header("Set-Cookie", "%s=%s; Path=/" %
-                                         (name, cookie_val))
+        # cookies are scoped to the blog's path prefix, and signed with its name
+        cookie_val = validate.make_secure_val(tenants.scoped(val))
+        path = tenants.url("") or "/"
+        self.response.headers.add_header("Set-Cookie", "%s=%s; Path=%s" %
+                                         (name, cookie_val, path))
 
     def read_secure_cookie(self, name):
         """
@@ -163,10 +374,11 @@ class Handler(webapp2.RequestHandler):
             self (self pointer): pointer to class object, does not need to be passed in
             name (str): name of the cookie to read
         Returns:
-            True or False if the cookie is valid
+            the cookie's value if it is valid and was set by this blog, or None
         """
         cookie_val = self.request.cookies.get(name)
-        return cookie_val and validate.check_secure_val(cookie_val)
+        return tenants.unscoped(cookie_val and
+                                validate.check_secure_val(cookie_val))
 
 
     def login(self, user):
@@ -178,7 +390,7 @@ class Handler(webapp2.RequestHandler):
         Returns:
             no return value
         """
-        self.set_secure_cookie("user_id", str(user.key().id()))
+        self.set_secure_cookie("user_id", str(user.id))
 
 
     def logout(self):
@@ -189,7 +401,9 @@ class Handler(webapp2.RequestHandler):
         Returns:
             no return value
         """
-        self.response.headers.add_header("Set-Cookie", "user_id=; Path=/")
+        path = tenants.url("") or "/"
+        self.response.headers.add_header("Set-Cookie", "user_id=; Path=%s" %
+                                         path)
 
 
     def user_logged_in(self):
@@ -235,6 +449,29 @@ class Handler(webapp2.RequestHandler):
         return author == username
 
 
+    def dispatch(self):
+        """
+        dispatch: runs the handler method, compresses its response, then
+                  stores the request's profile if it was profiled
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            the response returned by the handler method, if any
+        """
+        try:
+            rv = webapp2.RequestHandler.dispatch(self)
+            htmlOutput.compress(self.request, rv or self.response)
+            return rv
+        finally:
+            if self.profile:
+                try:
+                    profiler.finish(self.profile, self.response)
+                except Exception:
+                    # a lost profile must not fail the request
+                    logging.exception("couldn't store the profile of %s",
+                                      self.request.path)
+
+
     def initialize(self, *a, **kw):
         """
         initialize: initializes the page
@@ -246,8 +483,9 @@ class Handler(webapp2.RequestHandler):
             no return value
         """
         webapp2.RequestHandler.initialize(self, *a, **kw)
+        self.profile = profiler.start(self.request)
         uid = self.read_secure_cookie("user_id")
-        self.user = uid and blogData.User.by_id(int(uid))
+        self.user = uid and storage.get_backend().user_by_id(int(uid))
 
 
 class Signup(Handler):
@@ -263,6 +501,7 @@ class Signup(Handler):
         self.render("signup.html")
 
 
+    @rate_limited("signup")
     def post(self):
         """
         post: renders page when post method used
@@ -318,20 +557,47 @@ class SignUpPage(Signup):
             no return value
         """
         # make sure the user doesn't already exist
-        u = blogData.User.by_name(self.username)
+        store = storage.get_backend()
+        u = store.user_by_name(self.username)
         if u:
             msg = "That user already exists"
             params = dict(username = self.username, email = self.email)
             self.render("signup.html", error_username = msg, **params)
         else:
-            u = blogData.User.register(self.username, self.password,
+            u = store.register_user(self.username, self.password,
                 self.email)
-            u.put()
+            try:
+                usernameFilter.add(u.name)
+            except Exception:
+                # the user is registered either way; signup looks names up
+                # in storage, and the daily rebuild puts the filter right
+                logging.exception("couldn't add %s to the username filter",
+                                  u.name)
 
             self.login(u)
             self.redirect("/welcome")
 
 
+class SignUpCheckPage(Handler):
+
+    @rate_limited("check")
+    def get(self):
+        """
+        get: returns as JSON whether a username is valid and still free, for
+             the live check on the signup form
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        username = self.request.get("username")
+        valid = bool(validate.valid_username(username))
+        available = valid and not usernameFilter.is_taken(username)
+        self.response.headers["Cache-Control"] = "private, no-store"
+        self.write_json({"username": username, "valid": valid,
+                         "available": available})
+
+
 class WelcomePage(Handler):
 
 
@@ -360,6 +626,7 @@ class LoginPage(Handler):
         self.render("login.html")
 
 
+    @rate_limited("login")
     def post(self):
         """
         post: renders page when post method used
@@ -371,7 +638,7 @@ class LoginPage(Handler):
         username = self.request.get("username")
         password = self.request.get("password")
 
-        u = blogData.User.login(username, password)
+        u = storage.get_backend().login(username, password)
         if u:
             self.login(u)
             self.redirect("/welcome")
@@ -395,6 +662,7 @@ class LogoutPage(Handler):
 
 
 class BlogFrontPage(Handler):
+    @serves_stale
     def get(self):
         """
         get: renders page when get method used
@@ -403,16 +671,26 @@ class BlogFrontPage(Handler):
         Returns:
             no return value
         """
+        def compute():
+            store = storage.get_backend()
+            posts = store.recent_posts()
+            months = store.archive_counts()
+            if not POST_DOCUMENTS:
+                return self.render_str("frontpage.html", months = months,
+                                       posts = zip(posts,
+                                                   post_summaries(posts)))
 
-        if not self.user:
-            username = ""
-        else:
-            username = self.user.name
+            docs = store.post_documents([p.id for p in posts])
+            return self.render_str("frontpage.html",
+                                   docs = [doc for doc in docs if doc],
+                                   months = months)
 
-        posts = blogData.Post.all().order("-created")
-        self.render("frontpage.html", posts = posts, username = username)
+        self.set_cache_headers()
+        self.write(fragmentCache.get_or_compute(fragmentCache.FRONT_PAGE_KEY,
+                                                compute, FRONT_PAGE_TTL))
 
 
+    @rate_limited("like")
     def post(self):
         """
         post: renders page when post method used
@@ -422,40 +700,84 @@ class BlogFrontPage(Handler):
             no return value
         """
 
-        posts = blogData.Post.all().order("-created")
-
         if not self.user:
-            usernmae = ""
-        else:
-            username = self.request.get("username")
+            return self.redirect("/login")
 
+        username = self.user.name
         post_id = self.request.get("post_id")
+        # a missing or mangled ID is a missing post, not a server error
+        if not post_id.isdigit():
+            self.error(404)
+            return self.redirect("/404/%s" % post_id)
 
-        key = db.Key.from_path("Post", int(post_id),
-              parent=blogData.blog_key())
-        post = db.get(key)
+        store = storage.get_backend()
+        post = store.get_post(post_id)
 
-        if post:
-            if self.request.get("Like"):
-                like = blogData.Likes.by_user_and_post(post_id, username)
+        if post and self.request.get("Like") and not self.user_owns_post(post):
+            store.toggle_like(post, username)
+            fragmentCache.expire(fragmentCache.summary_key(post_id))
+
+        self.redirect("/blog")
+
+
+class LikePage(Handler):
+
+    @rate_limited("like")
+    @post_exists
+    def post(self, post_id, post):
+        """
+        post: toggles the current user's like on a post and returns the new count as JSON
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post_id (int): ID of the post being liked
+            post (object): post object of the post being liked
+        Returns:
+            no return value
+        """
+        if not self.user:
+            return self.write_json({"error": "login required"}, status = 401)
+
+        store = storage.get_backend()
+        if self.user_owns_post(post):
+            return self.write_json({"error": "you can't like your own post",
+                                    "count": store.like_count(post)},
+                                   status = 403)
 
-            if user_owns_post(post):
-                self.redirect("/blog")
-            elif like:
-                like.delete()
-                self.redirect("/blog")
-            else:
-                like = blogData.Likes(post_id = post_id, username = username)
-                like.put()
-                self.redirect("/blog")
+        liked, l_count = store.toggle_like(post, self.user.name)
+        fragmentCache.expire(fragmentCache.summary_key(post_id))
+        self.write_json({"post_id": int(post_id), "liked": liked,
+                         "count": l_count})
 
 
 class PostPage(Handler):
 
+    @serves_stale
+    def get(self, post_id):
+        """
+        get: renders page when get method used, from the post's read document
+             unless every comment is asked for with ?comments=all
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post_id (int): ID of the post to be displayed
+        Returns:
+            no return value
+        """
+        if not POST_DOCUMENTS or self.request.get("comments") == "all":
+            return self.render_post(post_id)
+
+        doc = storage.get_backend().post_document(post_id)
+        if not doc:
+            self.error(404)
+            return self.redirect("/404/%s" % post_id)
+
+        self.set_cache_headers()
+        self.render("permalink.html", doc = doc)
+
+
     @post_exists
-    def get(self, post_id, post):
+    def render_post(self, post_id, post):
         """
-        get: renders page when get method used
+        render_post: renders the page from the post and all its comments
         Args:
             self (self pointer): pointer to class object, does not need to be passed in
             post_id (int): ID of the post to be displayed
@@ -463,12 +785,81 @@ class PostPage(Handler):
         Returns:
             no return value
         """
-        if not self.user:
-            username = ""
-        else:
-            username = self.user.name
+        self.set_cache_headers()
+        self.render("permalink.html", post = post)
+
+
+class TopPage(Handler):
+
+    def get(self):
+        """
+        get: renders the most liked or most discussed posts
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        metric = self.request.get("by", "likes")
+        window = self.request.get("window", "all")
+        if metric not in storage.METRICS or window not in storage.WINDOWS:
+            return self.redirect("/blog/top")
+
+        ranked = storage.get_backend().top_posts(metric, window)
+        self.set_cache_headers()
+        self.render("top.html", ranked = ranked, metric = metric,
+                    window = window, windows = sorted(storage.WINDOWS))
+
+
+class ArchivePage(Handler):
+
+    def get(self, year, month):
+        """
+        get: renders a page of the posts created in a month, continuing from
+             the ?cursor= of the previous page
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            year (str): the year
+            month (str): the month, 1 to 12
+        Returns:
+            no return value
+        """
+        year, month = int(year), int(month)
+        # month_range() needs the month after this one to exist too
+        if not 1 <= year < 9999 or not 1 <= month <= 12:
+            self.error(404)
+            return self.render("404.html",
+                               error_id = "archive/%d/%d" % (year, month))
+
+        store = storage.get_backend()
+        cursor = self.request.get("cursor") or None
+        try:
+            posts, cursor = store.posts_in_month(year, month, cursor)
+        except ValueError:
+            if not cursor:
+                raise
+            # a bad cursor starts the month over
+            return self.redirect("/blog/archive/%d/%d" % (year, month))
 
-        self.render("permalink.html", post = post, username = username)
+        self.set_cache_headers()
+        self.render("archive.html", posts = posts, cursor = cursor,
+                    year = year, month = month,
+                    months = store.archive_counts())
+
+
+class ViewerPage(Handler):
+
+    def get(self):
+        """
+        get: returns the logged in user as JSON, for viewer.js to personalize
+             the publicly cached pages
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        username = self.user.name if self.user else ""
+        self.response.headers["Cache-Control"] = "private, no-store"
+        self.write_json({"username": username})
 
 
 class NewPostPage(Handler):
@@ -499,10 +890,9 @@ class NewPostPage(Handler):
         content = self.request.get("content")
 
         if title and content:
-            post = blogData.Post(parent = blogData.blog_key(), title = title,
-                     content = content, author = author)
-            post.put()
-            self.redirect("/blog/%s" % str(post.key().id()))
+            post = storage.get_backend().add_post(title, content, author)
+            fragmentCache.expire(fragmentCache.FRONT_PAGE_KEY)
+            self.redirect("/blog/%s" % str(post.id))
         else:
             error = "title and content, please!"
             self.render("newpost.html", title=title, content=content,
@@ -553,10 +943,9 @@ class EditPostPage(Handler):
             return self.redirect("/blog")
 
         if title and content:
-            post.title = title
-            post.content = content
-            post.put()
-            self.redirect("/blog/%s" % str(post.key().id()))
+            post = storage.get_backend().edit_post(post, title, content)
+            fragmentCache.expire(fragmentCache.FRONT_PAGE_KEY)
+            self.redirect("/blog/%s" % str(post.id))
         else:
             error = "title and content, please!"
             self.render("editpost.html", title = title, content = content,
@@ -602,19 +991,12 @@ class DeletePostPage(Handler):
         if not self.user_owns_post(post):
             return self.redirect("/blog")
 
-        post.delete()
-
-        comments, c_count = blogData.Comments.by_post(post_id)
-
-        if comments:
-            for comment in comments:
-                comment.delete()
-
-        likes, l_count = blogData.Likes.by_post(post_id)
-
-        if likes:
-            for like in likes:
-                like.delete()
+        # removes the post together with its comments and likes
+        storage.get_backend().delete_post(post)
+        fragmentCache.expire(fragmentCache.FRONT_PAGE_KEY)
+        # the last good copies still show the post
+        stalePages.discard("/blog", "/blog/%s" % post_id,
+                           "/blog/%s?comments=all" % post_id)
 
         self.redirect("/blog")
 
@@ -637,6 +1019,7 @@ class AddCommentPage(Handler):
         self.render("addcomment.html", post_id = post_id, author = author)
 
 
+    @rate_limited("comment")
     @post_exists
     def post(self, post_id, post):
         """
@@ -653,9 +1036,9 @@ class AddCommentPage(Handler):
         content = self.request.get("content")
 
         if content:
-            comment = blogData.Comments(parent = blogData.blog_key(), post_id = post_id,
-                     content = content, author = author)
-            comment.put()
+            comment, post = storage.get_backend().add_comment(post, content,
+                                                              author)
+            fragmentCache.expire(fragmentCache.summary_key(post_id))
             self.redirect("/blog/%s" % str(post_id))
         else:
             error = "comment cannot be blank!"
@@ -706,8 +1089,8 @@ class EditCommentPage(Handler):
             return self.redirect("/blog")
 
         if content:
-            comment.content = content
-            comment.put()
+            comment = storage.get_backend().edit_comment(comment, content)
+            fragmentCache.expire(fragmentCache.summary_key(comment.post_id))
             post_id = comment.post_id
             self.redirect("/blog/%s" % str(post_id))
         else:
@@ -756,7 +1139,8 @@ class DeleteCommentPage(Handler):
         if not self.user_owns_comment(comment):
             return self.redirect("/blog")
 
-        comment.delete()
+        post = storage.get_backend().delete_comment(comment)
+        fragmentCache.expire(fragmentCache.summary_key(post.id))
         self.redirect("/blog")
 
 
@@ -787,18 +1171,23 @@ class MainPage(Handler):
         self.write("Hello, Udacity!")
 
 
-app = webapp2.WSGIApplication([("/",MainPage),
+app = tenants.TenantApp(webapp2.WSGIApplication([("/",MainPage),
                                ("/signup",SignUpPage),
+                               ("/signup/check",SignUpCheckPage),
                                ("/welcome",WelcomePage),
                                ("/login",LoginPage),
                                ("/logout",LogoutPage),
                                ("/blog",BlogFrontPage),
+                               ("/blog/viewer",ViewerPage),
+                               ("/blog/top",TopPage),
+                               ("/blog/archive/([0-9]{4})/([0-9]{1,2})",ArchivePage),
                                ("/blog/([0-9]+)",PostPage),
+                               ("/blog/([0-9]+)/like",LikePage),
                                ("/blog/newpost",NewPostPage),
                                ("/blog/editpost/([0-9]+)",EditPostPage),
                                ("/blog/deletepost/([0-9]+)",DeletePostPage),
                                ("/blog/addcomment/([0-9]+)",AddCommentPage),
-                               ("/blog/editcomment/([0-9]+)",EditCommentPage),
-                               ("/blog/deletecomment/([0-9]+)",DeleteCommentPage),
+                               ("/blog/([0-9]+)/editcomment/([0-9]+)",EditCommentPage),
+                               ("/blog/([0-9]+)/deletecomment/([0-9]+)",DeleteCommentPage),
                                ("/404/([0-9]+)",NotFoundErrorPage)
-                               ], debug=True)
+                               ], debug=True))
@@ -0,0 +1,198 @@
+import logging
+
+### My modules
+import blogData
+import tenants
+
+from google.appengine.api import datastore
+from google.appengine.api import datastore_errors
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+BATCH_SIZE = 20
+# entities rewritten per reindex() task, and the kinds it rewrites in order
+REINDEX_BATCH_SIZE = 100
+REINDEX_MODELS = (blogData.User, blogData.Post, blogData.Comments,
+                  blogData.Likes, blogData.Purge)
+
+
+### Data migrations
+def copy_entity(entity, **kw):
+    """
+    copy_entity: make a copy of an entity with the same property values
+    Args:
+        entity (object): database object to copy
+        **kw (varies): constructor arguments for the copy, e.g. key or parent
+    Returns:
+        database object of the copy, not yet stored
+    """
+    props = dict((name, getattr(entity, name))
+                 for name in entity.properties())
+    props.update(kw)
+    return entity.__class__(**props)
+
+
+def by_old_post_id(model, post_id, ancestor = None):
+    """
+    by_old_post_id: get the comments or likes of a post stored before posts
+                    had their own entity groups
+    Args:
+        model (class): blogData.Comments or blogData.Likes
+        post_id (int): ID of the post
+        ancestor (object): database Key the entities are stored under, or None
+    Returns:
+        list of database objects
+    """
+    # post_id is no longer indexed, so db refuses to filter on it; the old
+    # entities keep their index rows, since reindex() leaves them alone
+    query = datastore.Query(model.kind(), {"post_id =": str(post_id)})
+    if ancestor:
+        query.Ancestor(ancestor)
+    return [model.from_entity(entity) for entity in query.Run()]
+
+
+def move_post(old_post):
+    """
+    move_post: move a post and its comments and likes into their own entity
+               group; safe to run again for a post whose move was interrupted
+    Args:
+        old_post (object): post object stored under blog_key()
+    Returns:
+        True if the post was moved, False if its ID is taken by another post
+    """
+    post_id = old_post.key().id()
+    new_key = blogData.post_key(post_id)
+
+    # keep the same ID so existing permalinks still work
+    reserved = db.allocate_id_range(new_key, post_id, post_id)
+    if reserved == db.KEY_RANGE_COLLISION:
+        existing = db.get(new_key)
+        # a collision with this post's own copy is a retried move
+        if not (existing and existing.author == old_post.author and
+                existing.created == old_post.created):
+            logging.error("not moving post %d: another post has its ID",
+                          post_id)
+            return False
+    elif reserved == db.KEY_RANGE_CONTENTION:
+        # no post has the ID; the allocator gave it out, to this post
+        logging.warning("post %d: its ID was allocated before", post_id)
+    new_post = copy_entity(old_post, key = new_key)
+
+    old_comments = by_old_post_id(blogData.Comments, post_id,
+                                  blogData.blog_key())
+    old_likes = by_old_post_id(blogData.Likes, post_id)
+    old_likes = [l for l in old_likes if l.key().parent() is None]
+
+    # comments keep their IDs, so a retry overwrites the copies it made
+    comments = [copy_entity(c, key = db.Key.from_path(
+                    "Comments", c.key().id(), parent = new_key))
+                for c in old_comments]
+    likes = [blogData.Likes.create(post_id, l.username) for l in old_likes]
+    if new_post.like_count is None:
+        new_post.like_count = len(likes)
+
+    db.put([new_post] + comments + likes)
+    db.delete([old_post] + old_comments + old_likes)
+    return True
+
+
+def migrate_entity_groups(cursor = None):
+    """
+    migrate_entity_groups: move every post stored under blog_key() into its own
+                           entity group, re-deferring itself until none are left
+    Args:
+        cursor (str): where the previous batch ended, past the posts it
+                      couldn't move, or None
+    Returns:
+        no return value
+    """
+    query = blogData.Post.all().ancestor(blogData.blog_key()) \
+                    .with_cursor(cursor)
+    old_posts = query.fetch(BATCH_SIZE)
+    moved = len([p for p in old_posts if move_post(p)])
+
+    logging.info("moved %d posts into their own entity groups, skipped %d",
+                 moved, len(old_posts) - moved)
+    if len(old_posts) == BATCH_SIZE:
+        deferred.defer(migrate_entity_groups, query.cursor())
+
+
+### Dropping unused index rows
+#
+# Marking a property indexed = False only changes entities written after;
+# older ones keep their index rows, and keep paying to update them, until
+# they are stored again. reindex() stores every entity of REINDEX_MODELS
+# again, in a chain of deferred batches. It rewrites the raw entities rather
+# than the models, so every value, including auto_now ones like
+# last_modified, stays as it was.
+def unindexed(model):
+    """
+    unindexed: the properties of a model that aren't indexed
+    Args:
+        model (class): database model class
+    Returns:
+        list of property names
+    """
+    return [name for name, prop in model.properties().items()
+            if not prop.indexed]
+
+
+def is_old_child(key):
+    """
+    is_old_child: check if a comment or like still waits for
+                  migrate_entity_groups(), which finds it by its post_id index
+    Args:
+        key (object): database Key of the entity
+    Returns:
+        True if the entity isn't stored under a post
+    """
+    return (key.kind() in (blogData.Comments.kind(), blogData.Likes.kind())
+            and (not key.parent() or key.parent().kind() != "Post"))
+
+
+def rewrite(key, names):
+    """
+    rewrite: store an entity again with only the model's indexed properties
+             indexed
+    Args:
+        key (object): database Key of the entity
+        names (list): the model's unindexed property names
+    Returns:
+        no return value
+    """
+    def txn():
+        try:
+            entity = datastore.Get(key)
+        except datastore_errors.EntityNotFoundError:
+            return
+        entity.set_unindexed_properties(names)
+        datastore.Put(entity)
+    db.run_in_transaction(txn)
+
+
+def reindex(model_index = 0, cursor = None):
+    """
+    reindex: rewrite one batch of a kind's entities and defer the next, moving
+             on through REINDEX_MODELS until every kind is done
+    Args:
+        model_index (int): position of the kind in REINDEX_MODELS
+        cursor (str): where the previous batch ended, or None
+    Returns:
+        no return value
+    """
+    model = REINDEX_MODELS[model_index]
+    query = model.all(keys_only = True).with_cursor(cursor)
+    keys = query.fetch(REINDEX_BATCH_SIZE)
+    names = unindexed(model)
+    for key in keys:
+        if not is_old_child(key):
+            rewrite(key, names)
+
+    logging.info("reindexed %d %s entities", len(keys), model.kind())
+    if len(keys) == REINDEX_BATCH_SIZE:
+        next_batch = (model_index, query.cursor())
+    elif model_index + 1 < len(REINDEX_MODELS):
+        next_batch = (model_index + 1, None)
+    else:
+        return
+    deferred.defer(tenants.call, tenants.current()[0], reindex, *next_batch)
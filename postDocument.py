@@ -0,0 +1,165 @@
+import datetime
+import json
+
+# bump when the layout of a document or post.html changes; documents of an
+# older version are rebuilt when they're read
+VERSION = 1
+# newest comments kept in a document
+RECENT_COMMENTS = 5
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+### Denormalized read documents
+#
+# A post's document holds everything its permalink and front page item
+# show: the title, the rendered body, the like and comment counts and the
+# newest RECENT_COMMENTS comments, so the page is served from one lookup
+# instead of the post plus comment and like queries. The functions below
+# only change the document; the storage backend decides where it's kept
+# and runs them in the same transaction as the write they mirror.
+def build(post, comments, like_count):
+    """
+    build: the document of a post
+    Args:
+        post (object): post object, with a render method
+        comments (list): every comment of the post
+        like_count (int): the post's stored like count
+    Returns:
+        the document dict
+    """
+    comments = sorted(comments, key = lambda c: c.created)
+    return {"version": VERSION,
+            "id": post.id,
+            "title": post.title,
+            "author": post.author,
+            "created": post.created,
+            "html": post.render(""),
+            "like_count": like_count,
+            "comment_count": len(comments),
+            "comments": [comment_entry(c) for c in comments[-RECENT_COMMENTS:]]}
+
+
+def comment_entry(comment):
+    """
+    comment_entry: a comment as stored in a document
+    Args:
+        comment (object): comment object
+    Returns:
+        dict with the attributes postsummary.html uses
+    """
+    return {"id": comment.id,
+            "author": comment.author,
+            "content": comment.content,
+            "created": comment.created}
+
+
+def edit_post(doc, post):
+    """
+    edit_post: update a document after its post was edited
+    Args:
+        doc (dict): the document, changed in place
+        post (object): the edited post object
+    Returns:
+        no return value
+    """
+    doc["title"] = post.title
+    doc["html"] = post.render("")
+
+
+def set_likes(doc, like_count):
+    """
+    set_likes: update a document's like count after buffered likes were written
+    Args:
+        doc (dict): the document, changed in place
+        like_count (int): the post's new stored like count
+    Returns:
+        no return value
+    """
+    doc["like_count"] = like_count
+
+
+def add_comment(doc, comment):
+    """
+    add_comment: add a new comment to a document, dropping the oldest one
+                 when it's full
+    Args:
+        doc (dict): the document, changed in place
+        comment (object): the new comment object
+    Returns:
+        no return value
+    """
+    doc["comments"] = (doc["comments"] +
+                       [comment_entry(comment)])[-RECENT_COMMENTS:]
+    doc["comment_count"] += 1
+
+
+def edit_comment(doc, comment):
+    """
+    edit_comment: update an edited comment if the document holds it
+    Args:
+        doc (dict): the document, changed in place
+        comment (object): the edited comment object
+    Returns:
+        True if the document changed
+    """
+    for entry in doc["comments"]:
+        if entry["id"] == comment.id:
+            entry["content"] = comment.content
+            return True
+    return False
+
+
+def holds_comment(doc, comment_id):
+    """
+    holds_comment: check if a comment is among a document's newest comments;
+                   deleting one of those needs the document to be rebuilt to
+                   take in the next older comment
+    Args:
+        doc (dict): the document
+        comment_id (int): ID of the comment
+    Returns:
+        True if the document holds the comment
+    """
+    return any(entry["id"] == comment_id for entry in doc["comments"])
+
+
+def remove_older_comment(doc):
+    """
+    remove_older_comment: count a deleted comment that the document doesn't hold
+    Args:
+        doc (dict): the document, changed in place
+    Returns:
+        no return value
+    """
+    doc["comment_count"] = max(doc["comment_count"] - 1, len(doc["comments"]))
+
+
+def dumps(doc):
+    """
+    dumps: serialize a document for storage
+    Args:
+        doc (dict): the document
+    Returns:
+        JSON string
+    """
+    def default(value):
+        if isinstance(value, datetime.datetime):
+            return value.strftime(TIME_FORMAT)
+        raise TypeError(repr(value))
+    return json.dumps(doc, default = default)
+
+
+def loads(data):
+    """
+    loads: rebuild a document serialized by dumps
+    Args:
+        data (str): JSON string
+    Returns:
+        the document dict, with its dates as datetimes
+    """
+    doc = json.loads(data)
+    for item in [doc] + doc.get("comments", []):
+        if item.get("created"):
+            item["created"] = datetime.datetime.strptime(item["created"],
+                                                         TIME_FORMAT)
+    return doc
@@ -0,0 +1,379 @@
+import binascii
+import hashlib
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+### My modules
+import storage
+
+from collections import Counter
+from compat import memcache
+
+# seconds between samples of the request thread's stack
+INTERVAL = 0.005
+# fraction of all requests sampled into the per-route aggregates, 0 to turn
+# the aggregate mode off; PROFILE_SAMPLE_RATE in app.yaml overrides it
+SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0.01"))
+# the signed flag that profiles a single request, as a query parameter or
+# a header
+FLAG_PARAM = "profile"
+FLAG_HEADER = "X-Blog-Profile"
+ID_HEADER = "X-Blog-Profile-Id"
+ENVIRON_KEY = "blog.profile"
+# how long a signed flag works, and the blob holding the key it's signed with
+FLAG_SECONDS = 3600
+SECRET_BLOB = "profile-secret"
+# how long profiles are kept, how many single request profiles are listed,
+# and how many distinct stacks and bytes of stack text a stored profile
+# keeps, well below memcache's 1MB value limit
+KEEP_SECONDS = 24 * 3600
+RECENT_SIZE = 20
+MAX_STACKS = 2000
+MAX_STACK_BYTES = 500000
+RECENT_KEY = "profile:recent"
+ROUTES_KEY = "profile:routes"
+CAS_RETRIES = 5
+
+
+### Sampling profiler
+#
+# A Profile runs a thread that wakes every INTERVAL seconds, reads the
+# current frame of the request thread with sys._current_frames() and
+# counts the stack in collapsed form ("file:function;file:function"), the
+# input format of flame graph tools. The request thread is never traced, so
+# the cost is a stack walk per sample rather than a hook on every call.
+class Profile(object):
+
+    def __init__(self, url, route, requested):
+        """
+        __init__: create a profile of the calling thread
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            url (str): path and query string of the request
+            route (str): name of the handler that serves the request
+            requested (bool): True if asked for with the signed flag, False if
+                              sampled for the route aggregate
+        Returns:
+            no return value
+        """
+        self.url = url
+        self.route = route
+        self.requested = requested
+        self.thread = threading.current_thread().ident
+        self.stacks = Counter()
+        self.samples = 0
+        self.duration = 0
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target = self.run)
+        self.sampler.daemon = True
+
+
+    def start(self):
+        """
+        start: start sampling
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        self.started = time.time()
+        self.sampler.start()
+
+
+    def run(self):
+        """
+        run: body of the sampler thread
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        while not self.stopped.wait(INTERVAL):
+            frames = sys._current_frames()
+            frame = frames.get(self.thread)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+                self.samples += 1
+
+
+    def stop(self):
+        """
+        stop: stop sampling and wait for the sampler thread
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        self.stopped.set()
+        self.sampler.join()
+        self.duration = time.time() - self.started
+
+
+def collapse(frame):
+    """
+    collapse: the collapsed stack of a frame, outermost call first
+    Args:
+        frame (object): the innermost frame
+    Returns:
+        string of "file:function" entries separated by ";"
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("%s:%s" % (os.path.basename(code.co_filename),
+                                code.co_name))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def trim(stacks):
+    """
+    trim: the most sampled stacks that fit in a stored profile
+    Args:
+        stacks (dict): collapsed stack to number of samples
+    Returns:
+        dict of at most MAX_STACKS stacks and MAX_STACK_BYTES of stack text
+    """
+    kept = {}
+    size = 0
+    for stack, count in Counter(stacks).most_common(MAX_STACKS):
+        size += len(stack) + 16
+        if size > MAX_STACK_BYTES:
+            break
+        kept[stack] = count
+    return kept
+
+
+def format_stacks(stacks):
+    """
+    format_stacks: collapsed stacks as text, one "stack count" per line
+    Args:
+        stacks (dict): collapsed stack to number of samples
+    Returns:
+        string to feed to flamegraph.pl or speedscope
+    """
+    return "".join("%s %d\n" % (stack, count)
+                   for stack, count in Counter(stacks).most_common())
+
+
+### Turning profiling on for a request
+#
+# Only admins get a flag, from /tasks/profile. It's signed with a random key
+# made on first use and kept in storage, not with anything in the source,
+# and it expires after FLAG_SECONDS.
+def secret():
+    """
+    secret: the key profile flags are signed with, created on first use
+    Returns:
+        the key as a hex string
+    """
+    store = storage.get_backend()
+    return (store.get_blob(SECRET_BLOB) or
+            store.update_blob(SECRET_BLOB, lambda blob: blob or
+                              binascii.hexlify(os.urandom(32))))
+
+
+def signature(path, expires):
+    """
+    signature: HMAC of a path and expiry time
+    Args:
+        path (str): path of the page, without the query string
+        expires (int): when the flag stops working, in seconds since the epoch
+    Returns:
+        hex digest string
+    """
+    message = "profile:%s:%d" % (path, expires)
+    return hmac.new(secret(), message.encode("utf-8"),
+                    hashlib.sha256).hexdigest()
+
+
+def sign(path):
+    """
+    sign: the value of the profile flag for a path
+    Args:
+        path (str): path of the page to profile, without the query string
+    Returns:
+        string of the expiry time and the signature
+    """
+    expires = int(time.time()) + FLAG_SECONDS
+    return "%d.%s" % (expires, signature(path, expires))
+
+
+def valid_flag(flag, path):
+    """
+    valid_flag: check a profile flag made by sign()
+    Args:
+        flag (str): the flag sent with the request
+        path (str): path of the request
+    Returns:
+        True if the flag is for the path and hasn't expired
+    """
+    expires, dot, sig = (flag or "").partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(str(sig), str(signature(path, int(expires))))
+
+
+def start(request):
+    """
+    start: start profiling a request if it carries a valid signed flag, or if
+           it's picked for the route aggregate
+    Args:
+        request (object): webapp2 request
+    Returns:
+        the running Profile, or None
+    """
+    if ENVIRON_KEY in request.environ:
+        # a handler created for a request that is already being profiled
+        return None
+
+    flag = request.get(FLAG_PARAM) or request.headers.get(FLAG_HEADER)
+    requested = bool(flag) and valid_flag(flag, request.path)
+    if not requested and random.random() >= SAMPLE_RATE:
+        return None
+
+    # routes are named after their handler class, e.g. "PostPage"
+    route = request.route and getattr(request.route.handler, "__name__", None)
+    route = route or request.path
+    profile = Profile(request.path_qs, route, requested)
+    request.environ[ENVIRON_KEY] = profile
+    profile.start()
+    return profile
+
+
+def finish(profile, response):
+    """
+    finish: stop a profile and store it
+    Args:
+        profile (object): the Profile returned by start()
+        response (object): webapp2 response, gets the profile ID header when
+                           the profile was requested
+    Returns:
+        no return value
+    """
+    profile.stop()
+    if profile.requested:
+        profile_id = uuid.uuid4().hex
+        memcache.set(request_key(profile_id),
+                     {"url": profile.url,
+                      "route": profile.route,
+                      "duration": profile.duration,
+                      "samples": profile.samples,
+                      "stacks": trim(profile.stacks)},
+                     time = KEEP_SECONDS)
+        update(RECENT_KEY, lambda recent: ([(profile_id, profile.url,
+                                             int(profile.duration * 1000))]
+                                           + recent)[:RECENT_SIZE], [])
+        response.headers[ID_HEADER] = profile_id
+    else:
+        update(route_key(profile.route),
+               lambda total: merge(total, profile), None)
+        if profile.route not in routes():
+            update(ROUTES_KEY,
+                   lambda names: sorted(set(names) | set([profile.route])), [])
+
+
+def merge(total, profile):
+    """
+    merge: add a profile to a route aggregate
+    Args:
+        total (dict): the stored aggregate, or None
+        profile (object): the finished Profile
+    Returns:
+        the new aggregate dict
+    """
+    total = total or {"requests": 0, "duration": 0, "stacks": {}}
+    stacks = Counter(total["stacks"])
+    stacks.update(profile.stacks)
+    return {"requests": total["requests"] + 1,
+            "duration": total["duration"] + profile.duration,
+            "stacks": trim(stacks)}
+
+
+### Stored profiles
+def request_key(profile_id):
+    """
+    request_key: memcache key of a single request's profile
+    Args:
+        profile_id (str): ID from the X-Blog-Profile-Id header
+    Returns:
+        the memcache key string
+    """
+    return "profile:request:%s" % profile_id
+
+
+def route_key(route):
+    """
+    route_key: memcache key of a route's aggregate profile
+    Args:
+        route (str): handler name, e.g. "PostPage"
+    Returns:
+        the memcache key string
+    """
+    return "profile:route:%s" % route
+
+
+def update(key, function, initial):
+    """
+    update: change a stored value with compare-and-set
+    Args:
+        key (str): memcache key of the value
+        function (function): takes the current value and returns the new one
+        initial (varies): the current value when nothing is stored
+    Returns:
+        no return value
+    """
+    client = memcache.Client()
+    for i in range(CAS_RETRIES):
+        value = client.gets(key)
+        if value is None:
+            if client.add(key, function(initial), time = KEEP_SECONDS):
+                return
+        elif client.cas(key, function(value), time = KEEP_SECONDS):
+            return
+
+
+def recent():
+    """
+    recent: the latest single request profiles
+    Returns:
+        list of (profile ID, url, milliseconds), newest first
+    """
+    return memcache.get(RECENT_KEY) or []
+
+
+def routes():
+    """
+    routes: the routes that have an aggregate profile
+    Returns:
+        list of handler names
+    """
+    return memcache.get(ROUTES_KEY) or []
+
+
+def get_request(profile_id):
+    """
+    get_request: a single request's profile
+    Args:
+        profile_id (str): ID from the X-Blog-Profile-Id header
+    Returns:
+        dict with url, route, duration, samples and stacks, or None
+    """
+    return memcache.get(request_key(profile_id))
+
+
+def get_route(route):
+    """
+    get_route: a route's aggregate profile
+    Args:
+        route (str): handler name, e.g. "PostPage"
+    Returns:
+        dict with requests, duration and stacks, or None
+    """
+    return memcache.get(route_key(route))
+
@@ -0,0 +1,254 @@
+import datetime
+import logging
+import time
+
+### My modules
+import blogData
+import entityCache
+import fragmentCache
+import likeBuffer
+import rankings
+import stalePages
+import storage
+import tenants
+
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+# keys fetched per task in each phase; a post is deleted with everything
+# under it, so its batches are smaller
+BATCH_SIZES = {
+    "posts": 20,
+    "comments": 200,
+    "likes": 200,
+}
+PHASES = ("posts", "comments", "likes")
+
+
+### Removing everything a user wrote
+#
+# start() deletes the account, so it can't add anything more, and queues
+# the first of a chain of deferred tasks. Each task reads one batch of keys
+# with a keys_only query on the author or username property, continuing
+# from the previous batch's cursor, removes them through the same paths
+# the handlers use so counters, rankings, read documents and caches stay
+# right, and queues the next batch. The phases run in order: the user's
+# posts with everything on them, then the user's comments on other posts,
+# then their likes. Progress is kept in a Purge entity keyed by username.
+def queries(name):
+    """
+    queries: the keys_only queries of each phase
+    Args:
+        name (str): username being removed
+    Returns:
+        dict of phase to db.Query
+    """
+    return {
+        "posts": blogData.Post.all(keys_only = True).filter("author =", name),
+        "comments": blogData.Comments.all(keys_only = True)
+                            .filter("author =", name),
+        "likes": blogData.Likes.all(keys_only = True)
+                         .filter("username =", name),
+    }
+
+
+def defer(function, *args):
+    """
+    defer: run a function in a task, as the current blog
+    Args:
+        function (function): the function
+        *args (varies): its arguments
+    Returns:
+        no return value
+    """
+    deferred.defer(tenants.call, tenants.current()[0], function, *args)
+
+
+def start(name):
+    """
+    start: delete a user's account and start removing their content, unless
+           a removal for the user is already running
+    Args:
+        name (str): username
+    Returns:
+        no return value
+    """
+    def txn():
+        purge = blogData.Purge.get_by_key_name(name)
+        if purge and not purge.finished:
+            return False
+        blogData.Purge(key_name = name, phase = PHASES[0]).put()
+        return True
+
+    # two admins starting the same removal must not both queue a chain
+    if not db.run_in_transaction(txn):
+        return
+
+    user = storage.get_backend().user_by_name(name)
+    if user:
+        db.delete(user)
+        entityCache.invalidate(user.key())
+    defer(step, name, PHASES[0], None)
+
+
+def step(name, phase, cursor):
+    """
+    step: remove one batch of a phase and queue the next
+    Args:
+        name (str): username
+        phase (str): one of PHASES
+        cursor (str): where the previous batch ended, or None
+    Returns:
+        no return value
+    """
+    query = queries(name)[phase]
+    keys = query.with_cursor(cursor).fetch(BATCH_SIZES[phase])
+    removed = REMOVERS[phase](name, keys)
+    record(name, phase, removed)
+    logging.info("removed %d %s of %s", removed, phase, name)
+
+    if len(keys) == BATCH_SIZES[phase]:
+        defer(step, name, phase, query.cursor())
+    elif phase != PHASES[-1]:
+        next_phase = PHASES[PHASES.index(phase) + 1]
+        record(name, next_phase, 0)
+        defer(step, name, next_phase, None)
+    else:
+        record(name, phase, 0, finished = True)
+
+
+def remove_posts(name, keys):
+    """
+    remove_posts: delete posts with their comments, likes and documents
+    Args:
+        name (str): username
+        keys (list): database Keys of the user's posts
+    Returns:
+        the number of posts deleted
+    """
+    store = storage.get_backend()
+    posts = [post for post in db.get(keys) if post]
+    for post in posts:
+        store.delete_post(post)
+    drop_pages([post.id for post in posts])
+    return len(posts)
+
+
+def remove_comments(name, keys):
+    """
+    remove_comments: delete comments, one transaction per post so each post's
+                     comment count and document change with its comments
+    Args:
+        name (str): username
+        keys (list): database Keys of the user's comments
+    Returns:
+        the number of comments deleted
+    """
+    by_post = {}
+    for key in keys:
+        by_post.setdefault(key.parent(), []).append(key)
+
+    removed = 0
+    for post_key, comment_keys in by_post.items():
+        post = post_key.kind() == "Post" and db.get(post_key)
+        if not post:
+            # comments left under the old blog parent or a deleted post
+            found = [c.key() for c in db.get(comment_keys) if c]
+            db.delete(found)
+            removed += len(found)
+            continue
+
+        before = post.stored_comment_count()
+        post = post.remove_comments(comment_keys)
+        removed += before - post.comment_count
+        entityCache.invalidate(post.key(),
+                               blogData.PostDocument.key_for(post.key()),
+                               *comment_keys)
+        rankings.mark("comments", post.id)
+    drop_pages([key.id() for key in by_post if key.kind() == "Post"])
+    return removed
+
+
+def remove_likes(name, keys):
+    """
+    remove_likes: take back likes, through the like buffer's flush so the
+                  posts' like counts and documents are updated with them
+    Args:
+        name (str): username
+        keys (list): database Keys of the user's likes
+    Returns:
+        the number of likes removed
+    """
+    # clicks still in the journal would otherwise be written after these
+    likeBuffer.flush()
+    post_ids = set(key.parent().id() for key in keys
+                   if key.parent() and key.parent().kind() == "Post")
+    event = dict(username = name, liked = False, ts = time.time())
+    for post_id in post_ids:
+        likeBuffer.apply_events(post_id, [dict(event, post_id = post_id)])
+    db.delete([key for key in keys
+               if not key.parent() or key.parent().kind() != "Post"])
+    drop_pages(post_ids)
+    return len(keys)
+
+
+REMOVERS = {
+    "posts": remove_posts,
+    "comments": remove_comments,
+    "likes": remove_likes,
+}
+
+
+def drop_pages(post_ids):
+    """
+    drop_pages: remove cached renders that may show removed content
+    Args:
+        post_ids (list): IDs of the changed posts
+    Returns:
+        no return value
+    """
+    fragmentCache.drop(fragmentCache.FRONT_PAGE_KEY,
+                       *[fragmentCache.summary_key(i) for i in post_ids])
+    stalePages.discard("/blog", *["/blog/%s" % i for i in post_ids])
+
+
+def record(name, phase, removed, finished = False):
+    """
+    record: add a batch to a removal's progress
+    Args:
+        name (str): username
+        phase (str): the phase the batch belongs to
+        removed (int): number of entities the batch removed
+        finished (bool): True when the last batch is done
+    Returns:
+        no return value
+    """
+    def txn():
+        purge = blogData.Purge.get_by_key_name(name)
+        purge.phase = phase
+        setattr(purge, phase, getattr(purge, phase) + removed)
+        if finished:
+            purge.finished = datetime.datetime.utcnow()
+        purge.put()
+    db.run_in_transaction(txn)
+
+
+def status(name):
+    """
+    status: the progress of a user's removal
+    Args:
+        name (str): username
+    Returns:
+        dict of the phase, the counts removed so far and the start and end
+        times, or None if no removal was started
+    """
+    purge = blogData.Purge.get_by_key_name(name)
+    if not purge:
+        return None
+    return {"username": name,
+            "phase": "done" if purge.finished else purge.phase,
+            "posts": purge.posts,
+            "comments": purge.comments,
+            "likes": purge.likes,
+            "started": str(purge.started),
+            "finished": purge.finished and str(purge.finished)}
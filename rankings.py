@@ -0,0 +1,233 @@
+import calendar
+import json
+import logging
+import time
+
+### My modules
+import blogData
+import likeBuffer
+import storage
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.runtime import apiproxy_errors
+
+TOP_SIZE = 100
+MARKED_KEY = "rankings:marked"
+CAS_RETRIES = 10
+
+# metric: how to read the stored count from a post
+METRICS = {
+    "likes": lambda post: likeBuffer.stored_count(post),
+    "comments": lambda post: post.stored_comment_count(),
+}
+
+# window name: only posts created within this many days, None for all time
+WINDOWS = storage.WINDOWS
+
+
+### Precomputed rankings
+#
+# Each (metric, window) pair has a Ranking entity holding the top TOP_SIZE
+# posts as a sorted JSON list of [post_id, count, created], so serving a
+# ranking is a single get and never counts likes or comments. Writes don't
+# touch the rankings: the like flush, the comment handlers and deletes only
+# mark() the post in memcache, and the flush cron calls apply_marked(),
+# which updates each Ranking once with every marked post. A Ranking is one
+# entity group shared by the whole blog, so updating it per comment or like
+# would cap the blog at about one such write a second. Marks lost to memcache
+# eviction, and posts that fall back into a windowed ranking when others
+# expire, are picked up by the rebuild cron.
+def ranking_key(metric, window):
+    """
+    ranking_key: key of the Ranking entity for a metric and window
+    Args:
+        metric (str): a key of METRICS
+        window (str): a key of WINDOWS
+    Returns:
+        database Key of the Ranking
+    """
+    return db.Key.from_path("Ranking", "%s:%s" % (metric, window))
+
+
+def created_ts(post):
+    """
+    created_ts: creation time of a post as seconds since the epoch
+    Args:
+        post (object): post object
+    Returns:
+        the creation time as an int
+    """
+    return calendar.timegm(post.created.utctimetuple())
+
+
+def in_window(created, window):
+    """
+    in_window: check if a post created at a time belongs in a window
+    Args:
+        created (int): creation time in seconds since the epoch
+        window (str): a key of WINDOWS
+    Returns:
+        True if the post is recent enough for the window
+    """
+    days = WINDOWS[window]
+    return days is None or created >= time.time() - days * 86400
+
+
+def load(ranking):
+    """
+    load: the entries of a Ranking entity
+    Args:
+        ranking (object): Ranking object, or None if it was never stored
+    Returns:
+        list of [post_id, count, created]
+    """
+    if not ranking:
+        return []
+    return json.loads(ranking.entries)
+
+
+def mark(metric, post_id):
+    """
+    mark: note that a post's count changed, for the next apply_marked()
+    Args:
+        metric (str): a key of METRICS
+        post_id (int): ID of the post
+    Returns:
+        no return value
+    """
+    post_id = int(post_id)
+    client = memcache.Client()
+    for i in range(CAS_RETRIES):
+        marked = client.gets(MARKED_KEY)
+        if marked is None:
+            if client.add(MARKED_KEY, {metric: [post_id]}):
+                return
+            continue
+        if post_id in marked.get(metric, []):
+            return
+        marked.setdefault(metric, []).append(post_id)
+        if client.cas(MARKED_KEY, marked):
+            return
+    logging.warning("couldn't mark post %s for the %s rankings", post_id,
+                    metric)
+
+
+def take_marked():
+    """
+    take_marked: read and clear the marked posts
+    Returns:
+        dict of metric to list of post IDs
+    """
+    client = memcache.Client()
+    for i in range(CAS_RETRIES):
+        marked = client.gets(MARKED_KEY)
+        if not marked:
+            return {}
+        if client.cas(MARKED_KEY, {}):
+            return marked
+    return {}
+
+
+def place(key, window, changes):
+    """
+    place: set the counts of posts in a ranking, run in a transaction
+    Args:
+        key (Key): key of the Ranking
+        window (str): a key of WINDOWS
+        changes (list): [post_id, count, created] of each changed post, with a
+                        count of 0 for a post to take out
+    Returns:
+        no return value
+    """
+    ranking = db.get(key)
+    changed = set(c[0] for c in changes)
+    entries = [e for e in load(ranking)
+               if e[0] not in changed and in_window(e[2], window)]
+    entries.extend(c for c in changes if c[1] > 0)
+    entries.sort(key = lambda e: -e[1])
+
+    ranking = ranking or blogData.Ranking(key = key)
+    ranking.entries = json.dumps(entries[:TOP_SIZE])
+    ranking.put()
+
+
+def apply_marked():
+    """
+    apply_marked: update the rankings with the counts of the marked posts, in
+                  one transaction per ranking; run from the flush cron
+    Returns:
+        the number of posts applied
+    """
+    applied = 0
+    for metric, post_ids in take_marked().items():
+        try:
+            posts = db.get([blogData.post_key(i) for i in post_ids])
+            changes = [[post_id, METRICS[metric](post), created_ts(post)]
+                       if post else [post_id, 0, None]
+                       for post_id, post in zip(post_ids, posts)]
+            for window in WINDOWS:
+                listed = [c for c in changes
+                          if not c[1] or in_window(c[2], window)]
+                if listed:
+                    db.run_in_transaction(place, ranking_key(metric, window),
+                                          window, listed)
+            applied += len(post_ids)
+        except (db.Error, apiproxy_errors.Error):
+            # the hourly rebuild puts the counts right
+            logging.exception("couldn't update the %s rankings", metric)
+    return applied
+
+
+def remove(post_id):
+    """
+    remove: take a deleted post out of every ranking at the next apply_marked()
+    Args:
+        post_id (int): ID of the deleted post
+    Returns:
+        no return value
+    """
+    for metric in METRICS:
+        mark(metric, post_id)
+
+
+def top(metric, window = "all", limit = 20):
+    """
+    top: the highest ranked posts for a metric
+    Args:
+        metric (str): a key of METRICS
+        window (str): a key of WINDOWS
+        limit (int): maximum number of posts to return
+    Returns:
+        list of (post object, count) tuples, highest count first
+    """
+    entries = [e for e in load(db.get(ranking_key(metric, window)))
+               if in_window(e[2], window)][:limit]
+    posts = db.get([blogData.post_key(e[0]) for e in entries])
+    return [(post, e[1]) for post, e in zip(posts, entries) if post]
+
+
+def rebuild():
+    """
+    rebuild: recompute every ranking from the posts' stored counters, for
+             seeding rankings of existing posts
+    Returns:
+        no return value
+    """
+    entries = dict((metric, []) for metric in METRICS)
+    for post in blogData.Post.all():
+        for metric, stored in METRICS.items():
+            count = stored(post)
+            if count > 0:
+                entries[metric].append([post.key().id(), count,
+                                        created_ts(post)])
+
+    rankings = []
+    for metric, metric_entries in entries.items():
+        metric_entries.sort(key = lambda e: -e[1])
+        for window in WINDOWS:
+            listed = [e for e in metric_entries if in_window(e[2], window)]
+            rankings.append(blogData.Ranking(
+                key = ranking_key(metric, window),
+                entries = json.dumps(listed[:TOP_SIZE])))
+    db.put(rankings)
@@ -0,0 +1,109 @@
+import os
+import time
+
+### My modules
+from compat import memcache
+
+CAS_RETRIES = 5
+
+# bucket name: (capacity, seconds to refill one token)
+# override with an env_variables entry in app.yaml, e.g.
+# RATELIMIT_COMMENT: "10,30" for 10 comments then one every 30 seconds
+LIMITS = {
+    "comment": (5, 30.0),
+    "like": (30, 1.0),
+    "signup": (3, 60.0),
+    "login": (10, 6.0),
+    "check": (20, 0.5),
+}
+
+
+### Token buckets
+def limit_for(bucket):
+    """
+    limit_for: get the configured limit of a bucket
+    Args:
+        bucket (str): name of the bucket, a key of LIMITS
+    Returns:
+        tuple of (capacity, seconds to refill one token)
+    """
+    override = os.environ.get("RATELIMIT_%s" % bucket.upper())
+    if override:
+        capacity, period = override.split(",")
+        return int(capacity), float(period)
+    return LIMITS[bucket]
+
+
+def take(bucket, identities):
+    """
+    take: take a token from the bucket of every identity of a client, or from
+          none of them, so a request refused by one bucket costs the others
+          nothing
+    Args:
+        bucket (str): name of the bucket, a key of LIMITS
+        identities (list): the client's identities, e.g. ["ip:1.2.3.4", "user:5"]
+    Returns:
+        0 if the tokens were taken, otherwise the seconds until every bucket
+        has one
+    """
+    capacity, period = limit_for(bucket)
+    keys = ["ratelimit:%s:%s" % (bucket, identity) for identity in identities]
+    # an entry that has expired would have refilled completely anyway
+    ttl = int(capacity * period) + 1
+
+    client = memcache.Client()
+    for i in range(CAS_RETRIES):
+        now = time.time()
+        states = client.get_multi(keys, for_cas = True)
+        changed, new = {}, {}
+        retry = 0
+        for key in keys:
+            if key not in states:
+                new[key] = (capacity - 1, now)
+                continue
+            tokens, last = states[key]
+            tokens = min(capacity, tokens + (now - last) / period)
+            retry = max(retry, (1 - tokens) * period)
+            changed[key] = (tokens - 1, now)
+        if retry > 0:
+            return retry
+
+        failed = []
+        if changed:
+            failed += client.cas_multi(changed, time = ttl)
+        if new:
+            failed += client.add_multi(new, time = ttl)
+        if not failed:
+            return 0
+        # another request changed a bucket since the read: give back the
+        # tokens that were taken and read them all again
+        for key in keys:
+            if key not in failed:
+                refund(client, key, capacity, period, ttl)
+
+    # memcache is contended or unavailable, let the request through
+    return 0
+
+
+def refund(client, key, capacity, period, ttl):
+    """
+    refund: give a token back to a bucket
+    Args:
+        client (object): memcache client
+        key (str): memcache key of the bucket
+        capacity (int): tokens the bucket holds when full
+        period (float): seconds to refill one token
+        ttl (int): seconds the bucket is kept in memcache
+    Returns:
+        no return value
+    """
+    for i in range(CAS_RETRIES):
+        now = time.time()
+        state = client.gets(key)
+        if state is None:
+            # gone from memcache, so the bucket is full again
+            return
+        tokens, last = state
+        tokens = min(capacity, tokens + (now - last) / period + 1)
+        if client.cas(key, (tokens, now), time = ttl):
+            return
@@ -0,0 +1,393 @@
+import collections
+import os
+import sys
+import urlparse
+
+# measure the datastore backend without the sampled profiler
+os.environ["BLOG_STORAGE"] = "datastore"
+os.environ["PROFILE_SAMPLE_RATE"] = "0"
+
+try:
+    # puts the SDK's bundled webapp2 and jinja2 on the path
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+except ImportError:
+    pass
+
+import webapp2
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import testbed
+
+### My modules
+import entityCache
+import likeBuffer
+import main
+import storage
+import usernameFilter
+import validate
+
+# blog sizes the routes are measured at; a route whose RPCs grow between
+# them does per-post work
+SMALL_BLOG = 5
+LARGE_BLOG = 20
+COMMENTS_PER_POST = 2
+SERVICES = ("datastore_v3", "memcache")
+# the SDK splits a datastore get into RPCs of this many entity groups, sent
+# in parallel
+GET_GROUPS_PER_RPC = 10
+# every route is measured rendering posts with summary_details, the
+# default, and from their read documents (BLOG_POST_DOCUMENTS set to "on")
+MODES = (("summaries", False), ("documents", True))
+
+# (method, path, user, cold, per post, warm)
+#   path: {post} and {comment} are replaced by seeded IDs, {spare} and
+#         {spare_comment} by those of another post for the deletes, {year}
+#         and {month} by the month the blog was seeded in; a POST sends its
+#         query string as the form body
+#   user: who is logged in, None for an anonymous request
+#   cold: (datastore, memcache) RPCs allowed with empty caches
+#   per post: extra (datastore, memcache) RPCs allowed per post on the blog
+#             with empty caches
+#   warm: (datastore, memcache) RPCs allowed when the same request is repeated
+BUDGETS = [
+    ("GET", "/", None, (0, 0), (0, 0), (0, 0)),
+    ("GET", "/signup", None, (0, 0), (0, 0), (0, 0)),
+    ("GET", "/signup/check?username=reader", None, (2, 4), (0, 0), (1, 3)),
+    ("GET", "/signup/check?username=nobody", None, (1, 4), (0, 0), (0, 3)),
+    ("GET", "/welcome", "reader", (1, 4), (0, 0), (0, 0)),
+    ("GET", "/login", None, (0, 0), (0, 0), (0, 0)),
+    ("GET", "/logout", "reader", (1, 4), (0, 0), (0, 0)),
+    # the summary of every post on the front page reads its comments
+    ("GET", "/blog", None, (2, 15), (1, 0), (0, 3)),
+    ("GET", "/blog/viewer", "reader", (1, 4), (0, 0), (0, 0)),
+    ("GET", "/blog/top", None, (2, 0), (0, 0), (2, 0)),
+    ("GET", "/blog/top?by=comments&window=week", None, (2, 0), (0, 0), (2, 0)),
+    ("GET", "/blog/archive/{year}/{month}", None, (2, 4), (0, 0), (1, 0)),
+    ("GET", "/blog/{post}", None, (2, 11), (0, 0), (0, 3)),
+    ("GET", "/blog/newpost", "author", (1, 4), (0, 0), (0, 0)),
+    ("GET", "/blog/editpost/{post}", "author", (2, 8), (0, 0), (0, 0)),
+    ("GET", "/blog/deletepost/{post}", "author", (2, 8), (0, 0), (0, 0)),
+    ("GET", "/blog/addcomment/{post}", "reader", (2, 8), (0, 0), (0, 0)),
+    ("GET", "/blog/{post}/editcomment/{comment}", "reader", (2, 8), (0, 0),
+     (0, 0)),
+    ("GET", "/blog/{post}/deletecomment/{comment}", "reader", (2, 8), (0, 0),
+     (0, 0)),
+    ("GET", "/404/{post}", None, (0, 0), (0, 0), (0, 0)),
+    ("POST", "/blog/{post}/like", "reader", (3, 15), (0, 0), (0, 7)),
+    ("POST", "/signup?username=newuser&password=secret&verify=secret", None,
+     (6, 4), (0, 0), (1, 2)),
+    ("POST", "/login?username=reader&password=secret", None, (1, 2), (0, 0),
+     (1, 2)),
+    ("POST", "/blog?post_id={post}&Like=1", "reader", (3, 15), (0, 0), (0, 7)),
+    ("POST", "/blog/newpost?title=New&content=Text", "author", (6, 7), (0, 0),
+     (5, 3)),
+    ("POST", "/blog/editpost/{post}?title=Edited&content=Text", "author",
+     (6, 12), (0, 0), (5, 6)),
+    ("POST", "/blog/addcomment/{post}?content=Text", "reader", (6, 16), (0, 0),
+     (5, 9)),
+    ("POST", "/blog/{post}/editcomment/{comment}?content=Edited", "reader",
+     (6, 12), (0, 0), (5, 6)),
+    # the deletes run last, on a post no other budget reads
+    ("POST", "/blog/{spare}/deletecomment/{spare_comment}", "reader", (9, 15),
+     (0, 0), (1, 1)),
+    ("POST", "/blog/deletepost/{spare}", "author", (11, 22), (0, 0), (1, 1)),
+]
+# the budgets of routes whose RPCs differ when posts are rendered from their
+# read documents: (method, path) to (cold, per post, warm)
+DOCUMENT_BUDGETS = {
+    # one get for the documents of every post on the front page
+    ("GET", "/blog"): ((3, 15), (1.0 / GET_GROUPS_PER_RPC, 0), (0, 3)),
+    ("GET", "/blog/{post}"): ((1, 7), (0, 0), (0, 3)),
+    # the comment writes also update the post's document
+    ("POST", "/blog/addcomment/{post}?content=Text"): ((7, 16), (0, 0), (6, 9)),
+    ("POST", "/blog/{spare}/deletecomment/{spare_comment}"): ((10, 15), (0, 0),
+                                                             (1, 1)),
+    ("POST", "/blog/deletepost/{spare}"): ((11, 23), (0, 0), (1, 1)),
+}
+
+
+### Datastore and memcache RPC budgets
+#
+# Runs every route of main.app against the SDK's local datastore and
+# memcache stubs with a seeded blog, and counts the RPCs each request
+# makes: once with empty caches and once repeated. It fails when a route
+# is over its budget, when its RPCs grow with the number of posts beyond
+# what its budget allows per post, or when a route has no budget. Run it
+# with the App Engine SDK on PYTHONPATH:
+#
+#     python rpcBudget.py            check the budgets
+#     python rpcBudget.py --report   only print the counts
+counts = collections.Counter()
+
+
+def count_rpc(service, call, request, response):
+    """
+    count_rpc: apiproxy hook counting each RPC by service
+    Args:
+        service (str): name of the API, e.g. "datastore_v3"
+        call (str): name of the method
+        request (object): request protocol buffer
+        response (object): response protocol buffer
+    Returns:
+        no return value
+    """
+    counts[service] += 1
+
+
+def start_stubs():
+    """
+    start_stubs: activate fresh datastore, memcache and task queue stubs with
+                 RPC counting
+    Returns:
+        the active Testbed
+    """
+    bed = testbed.Testbed()
+    bed.activate()
+    # queries see every write at once, so the seeded blog is complete
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability = 1)
+    bed.init_datastore_v3_stub(consistency_policy = policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path = os.path.dirname(os.path.abspath(__file__)))
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append("rpcBudget", count_rpc)
+    return bed
+
+
+def clear_caches():
+    """
+    clear_caches: empty memcache and this process's caches
+    Returns:
+        no return value
+    """
+    memcache.flush_all()
+    entityCache.local_caches.clear()
+    usernameFilter.local.clear()
+
+
+def seed(posts, documents):
+    """
+    seed: store a blog with an author, a reader, and commented and liked posts
+    Args:
+        posts (int): number of posts
+        documents (bool): True to build the posts' read documents
+    Returns:
+        dict of users by name, the IDs of the first and last posts and their
+        first comments, and the year and month the first was created
+    """
+    store = storage.get_backend()
+    users = dict((name, store.register_user(name, "secret"))
+                 for name in ("author", "reader"))
+
+    seeded = []
+    for i in range(posts):
+        post = store.add_post("Post %d" % i, "Content of post %d" % i, "author")
+        for j in range(COMMENTS_PER_POST):
+            comment, post = store.add_comment(post, "Comment %d" % j, "reader")
+        store.toggle_like(post, "reader")
+        seeded.append(post)
+    first = seeded[0]
+
+    likeBuffer.flush()
+    usernameFilter.rebuild()
+    if documents:
+        # a live blog's documents were built by earlier reads
+        store.post_documents([post.id for post in seeded])
+    spare = seeded[-1]
+
+    def first_comment(post):
+        comments, c_count = store.comments_by_post(post.id)
+        return min(comments, key = lambda c: c.created).id
+
+    return {"users": users, "post": first.id, "comment": first_comment(first),
+            "spare": spare.id, "spare_comment": first_comment(spare),
+            "year": first.created.year, "month": first.created.month}
+
+
+def send(method, path, user, blog):
+    """
+    send: run one request through main.app
+    Args:
+        method (str): HTTP method
+        path (str): path and query string, with the placeholders of BUDGETS
+        user (str): name of the logged in user, or None
+        blog (dict): what seed() returned
+    Returns:
+        tuple of (datastore RPCs, memcache RPCs) the request made
+    """
+    url = path.format(**blog)
+    form = None
+    if method == "POST" and "?" in url:
+        url, query = url.split("?", 1)
+        form = dict(urlparse.parse_qsl(query))
+    request = webapp2.Request.blank(url, POST = form,
+                                    environ = {"REMOTE_ADDR": "10.0.0.1"})
+    request.method = method
+    if user:
+        uid = str(blog["users"][user].id)
+        request.headers["Cookie"] = "user_id=%s" % validate.make_secure_val(uid)
+
+    counts.clear()
+    request.get_response(main.app)
+    return tuple(counts[service] for service in SERVICES)
+
+
+def measure(posts, documents):
+    """
+    measure: count every budgeted route's RPCs on a freshly seeded blog
+    Args:
+        posts (int): number of posts to seed
+        documents (bool): True to render posts from their read documents
+    Returns:
+        dict of budget entry to (cold counts, warm counts)
+    """
+    main.POST_DOCUMENTS = documents
+    bed = start_stubs()
+    try:
+        blog = seed(posts, documents)
+        results = {}
+        for budget in BUDGETS:
+            method, path, user = budget[:3]
+            clear_caches()
+            cold = send(method, path, user, blog)
+            warm = send(method, path, user, blog)
+            results[budget] = (cold, warm)
+        return results
+    finally:
+        bed.deactivate()
+
+
+def limits(budget, mode):
+    """
+    limits: the budget of a route in a mode
+    Args:
+        budget (tuple): entry of BUDGETS
+        mode (str): name of the mode in MODES
+    Returns:
+        tuple of (cold, per post, warm) budgets
+    """
+    method, path = budget[:2]
+    if mode == "documents" and (method, path) in DOCUMENT_BUDGETS:
+        return DOCUMENT_BUDGETS[(method, path)]
+    return budget[3:]
+
+
+def over(counted, allowed):
+    """
+    over: check counts against a budget
+    Args:
+        counted (tuple): (datastore, memcache) RPCs made
+        allowed (tuple): (datastore, memcache) RPCs allowed
+    Returns:
+        True if either count is over
+    """
+    return any(c > a for c, a in zip(counted, allowed))
+
+
+def check(mode, small, large):
+    """
+    check: compare the measured RPCs of a mode with the budgets
+    Args:
+        mode (str): name of the mode in MODES
+        small (dict): measure(SMALL_BLOG) in the mode
+        large (dict): measure(LARGE_BLOG) in the mode
+    Returns:
+        list of failure messages
+    """
+    failures = []
+    for budget in BUDGETS:
+        cold, per_post, warm = limits(budget, mode)
+        name = "%s %s (%s)" % (budget[0], budget[1], mode)
+        for posts, results in ((SMALL_BLOG, small), (LARGE_BLOG, large)):
+            measured_cold, measured_warm = results[budget]
+            allowed = tuple(c + p * posts for c, p in zip(cold, per_post))
+            if over(measured_cold, allowed):
+                failures.append("%s: %s RPCs with empty caches and %d posts, "
+                                "budget %s" % (name, measured_cold, posts,
+                                               allowed))
+            if over(measured_warm, warm):
+                failures.append("%s: %s RPCs repeated with %d posts, budget %s"
+                                % (name, measured_warm, posts, warm))
+
+        growth = LARGE_BLOG - SMALL_BLOG
+        grown_cold = tuple(l - s for l, s in zip(large[budget][0],
+                                                 small[budget][0]))
+        allowed = tuple(p * growth for p in per_post)
+        if over(grown_cold, allowed):
+            failures.append("%s: %s more RPCs with empty caches for %d more "
+                            "posts" % (name, grown_cold, growth))
+        if over(large[budget][1], small[budget][1]):
+            failures.append("%s: repeated requests make more RPCs with %d "
+                            "posts than with %d" % (name, LARGE_BLOG,
+                                                    SMALL_BLOG))
+    return failures
+
+
+def unbudgeted():
+    """
+    unbudgeted: routes and methods of main.app that no budget exercises
+    Returns:
+        list of "METHOD route" strings
+    """
+    placeholders = dict(post = 1, comment = 2, spare = 3, spare_comment = 4,
+                        year = 2000, month = 1)
+    budgeted = [(b[0], b[1].split("?")[0].format(**placeholders))
+                for b in BUDGETS]
+    missing = []
+    for route in main.app.router.match_routes:
+        for method in ("GET", "POST"):
+            if not hasattr(route.handler, method.lower()):
+                continue
+            if not any(m == method and route.regex.match(path)
+                       for m, path in budgeted):
+                missing.append("%s %s" % (method, route.template))
+    return missing
+
+
+def report(mode, small, large):
+    """
+    report: print the measured RPCs of every route in a mode
+    Args:
+        mode (str): name of the mode in MODES
+        small (dict): measure(SMALL_BLOG) in the mode
+        large (dict): measure(LARGE_BLOG) in the mode
+    Returns:
+        no return value
+    """
+    print("%-48s %-22s %-22s" % ("(datastore, memcache) RPCs, %s" % mode,
+                                 "%d posts cold/warm" % SMALL_BLOG,
+                                 "%d posts cold/warm" % LARGE_BLOG))
+    for budget in BUDGETS:
+        print("%-48s %-22s %-22s" % (
+            "%s %s" % budget[:2],
+            "%s %s" % small[budget], "%s %s" % large[budget]))
+
+
+def run(argv):
+    """
+    run: measure, print, and check the budgets in every mode
+    Args:
+        argv (list): command line arguments
+    Returns:
+        exit status, 1 if a check failed
+    """
+    failures = []
+    for mode, documents in MODES:
+        small = measure(SMALL_BLOG, documents)
+        large = measure(LARGE_BLOG, documents)
+        report(mode, small, large)
+        failures.extend(check(mode, small, large))
+    if "--report" in argv:
+        return 0
+
+    failures.extend("%s: no RPC budget" % route for route in unbudgeted())
+    for failure in failures:
+        print("FAIL %s" % failure)
+    print("%d routes in %d modes, %d failures" % (len(BUDGETS), len(MODES),
+                                                  len(failures)))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run(sys.argv[1:]))
@@ -0,0 +1,754 @@
+import atexit
+import contextlib
+import datetime
+import sqlite3
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+### My modules
+import blogViews
+import storage
+import validate
+
+POOL_SIZE = 8
+# most write transactions committed together
+WRITE_BATCH = 100
+# archive cursors are the creation time and ID of a page's last post
+CURSOR_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    pw_hash TEXT NOT NULL,
+    email TEXT
+);
+
+CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    author TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created TIMESTAMP NOT NULL,
+    last_modified TIMESTAMP NOT NULL,
+    like_count INTEGER NOT NULL DEFAULT 0,
+    comment_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS posts_created ON posts (created);
+CREATE INDEX IF NOT EXISTS posts_like_count ON posts (like_count, created);
+CREATE INDEX IF NOT EXISTS posts_comment_count ON posts (comment_count, created);
+
+CREATE TABLE IF NOT EXISTS comments (
+    id INTEGER PRIMARY KEY,
+    post_id INTEGER NOT NULL REFERENCES posts (id) ON DELETE CASCADE,
+    content TEXT NOT NULL,
+    author TEXT NOT NULL,
+    created TIMESTAMP NOT NULL,
+    last_modified TIMESTAMP NOT NULL
+);
+CREATE INDEX IF NOT EXISTS comments_post ON comments (post_id, created);
+
+CREATE TABLE IF NOT EXISTS likes (
+    post_id INTEGER NOT NULL REFERENCES posts (id) ON DELETE CASCADE,
+    username TEXT NOT NULL,
+    PRIMARY KEY (post_id, username)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS month_counts (
+    month TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS blobs (
+    name TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+"""
+
+
+### Records returned by the SQLite backend, with the attributes the
+### templates and handlers use on datastore entities
+class Record(object):
+
+    def __init__(self, row):
+        """
+        __init__: copy the columns of a row into attributes
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            row (sqlite3.Row): the row
+        Returns:
+            no return value
+        """
+        for name in row.keys():
+            setattr(self, name, row[name])
+
+
+class UserRecord(Record):
+    pass
+
+
+class PostRecord(blogViews.PostView, Record):
+    pass
+
+
+class CommentRecord(blogViews.CommentView, Record):
+    pass
+
+
+### Group commit of the write transactions
+#
+# Every write goes through one connection owned by a writer thread. Requests
+# hand it their transaction as a function and wait; the thread takes every
+# transaction waiting, up to WRITE_BATCH, runs each in its own savepoint so
+# one that fails is rolled back alone, and commits them all at once. Under
+# load many requests share one commit and one write lock instead of taking
+# turns at them, and only a single connection of each process writes.
+class Write(object):
+
+    def __init__(self, function):
+        """
+        __init__: a write transaction waiting for the writer thread
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            function (function): takes the connection and makes the writes
+        Returns:
+            no return value
+        """
+        self.function = function
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class GroupCommitter(object):
+
+    def __init__(self, conn):
+        """
+        __init__: start the writer thread
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            conn (object): sqlite3 connection used for every write
+        Returns:
+            no return value
+        """
+        # transactions are begun and ended by commit() itself
+        conn.isolation_level = None
+        self.conn = conn
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+
+    def stop(self):
+        """
+        stop: let the writer thread commit what is waiting and end, before
+              the interpreter shuts down under it
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        self.pending.put(None)
+        self.thread.join()
+
+
+    def write(self, function):
+        """
+        write: run a write transaction in the next batch and wait until it is
+               committed
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            function (function): takes the connection and makes the writes
+        Returns:
+            what the function returned; raises what it raised, or the error
+            that stopped its batch from being committed
+        """
+        write = Write(function)
+        self.pending.put(write)
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+
+    def run(self):
+        """
+        run: body of the writer thread, committing the waiting writes in batches
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        while True:
+            batch = [self.pending.get()]
+            while batch[-1] is not None and len(batch) < WRITE_BATCH:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is None
+            if stopping:
+                batch.pop()
+            if batch:
+                self.commit(batch)
+            if stopping:
+                return
+
+
+    def commit(self, batch):
+        """
+        commit: run a batch of writes in one transaction
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            batch (list): Write objects
+        Returns:
+            no return value
+        """
+        conn = self.conn
+        try:
+            # take the write lock before anything is read, so the writes of
+            # other processes apply before or after the whole batch
+            conn.execute("BEGIN IMMEDIATE")
+            for write in batch:
+                conn.execute("SAVEPOINT write")
+                try:
+                    write.result = write.function(conn)
+                except Exception as e:
+                    write.error = e
+                    conn.execute("ROLLBACK TO write")
+                conn.execute("RELEASE write")
+            conn.execute("COMMIT")
+        except Exception as e:
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                # the batch never began, or sqlite already rolled it back
+                pass
+            for write in batch:
+                if write.error is None:
+                    write.error = e
+        finally:
+            for write in batch:
+                write.done.set()
+
+
+### SQLite backend
+class SQLiteStorage(storage.Storage):
+
+    def __init__(self, path, pool_size = POOL_SIZE):
+        """
+        __init__: open a pool of connections to the database, creating the tables
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            path (str): path of the database file
+            pool_size (int): number of connections kept open
+        Returns:
+            no return value
+        """
+        self.pool = queue.Queue()
+        for i in range(pool_size):
+            self.pool.put(self.connect(path))
+
+        with self.connection() as conn:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.executescript(SCHEMA)
+
+        self.writer = GroupCommitter(self.connect(path))
+
+        def txn(conn):
+            # seeds the archive counts of a database made before they existed
+            if not conn.execute("SELECT 1 FROM month_counts").fetchone():
+                conn.execute("INSERT INTO month_counts (month, count) "
+                             "SELECT substr(created, 1, 7), count(*) "
+                             "FROM posts GROUP BY 1")
+        self.run_in_transaction(txn)
+
+
+    def connect(self, path):
+        """
+        connect: open one connection of the pool
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            path (str): path of the database file
+        Returns:
+            the sqlite3 connection
+        """
+        conn = sqlite3.connect(path, timeout = 30,
+                               detect_types = sqlite3.PARSE_DECLTYPES,
+                               check_same_thread = False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        connection: borrow a connection from the pool
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            context manager yielding the connection
+        """
+        conn = self.pool.get()
+        try:
+            yield conn
+        finally:
+            self.pool.put(conn)
+
+
+    def run_in_transaction(self, function):
+        """
+        run_in_transaction: run related writes as a single transaction, committed
+                            in a batch with the writes of other requests
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            function (function): takes the connection and makes the writes
+        Returns:
+            what the function returned
+        """
+        return self.writer.write(function)
+
+
+    def fetch_one(self, cls, sql, *args):
+        """
+        fetch_one: run a query and wrap the first row
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            cls (class): Record class to wrap the row in
+            sql (str): the query
+            *args (varies): query parameters
+        Returns:
+            the record, or None
+        """
+        with self.connection() as conn:
+            row = conn.execute(sql, args).fetchone()
+        return cls(row) if row else None
+
+
+    def fetch_all(self, cls, sql, *args):
+        """
+        fetch_all: run a query and wrap every row
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            cls (class): Record class to wrap the rows in
+            sql (str): the query
+            *args (varies): query parameters
+        Returns:
+            list of records
+        """
+        with self.connection() as conn:
+            rows = conn.execute(sql, args).fetchall()
+        return [cls(row) for row in rows]
+
+
+    def user_by_id(self, uid):
+        """
+        user_by_id: get a user by ID
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            uid (int): UID of the user to look up
+        Returns:
+            user record, or None
+        """
+        return self.fetch_one(UserRecord, "SELECT * FROM users WHERE id = ?",
+                              int(uid))
+
+
+    def user_by_name(self, name):
+        """
+        user_by_name: get a user by name
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            name (str): name of the user to look up
+        Returns:
+            user record, or None
+        """
+        return self.fetch_one(UserRecord, "SELECT * FROM users WHERE name = ?",
+                              name)
+
+
+    def register_user(self, name, pw, email = None):
+        """
+        register_user: store a new user
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            name (str): name of the user to add
+            pw (str): password of the user to add, unencrypted
+            email (str): optional email address of user
+        Returns:
+            the new user record
+        """
+        pw_hash = validate.make_pw_hash(name, pw)
+        def txn(conn):
+            return conn.execute("INSERT INTO users (name, pw_hash, email) "
+                                "VALUES (?, ?, ?)",
+                                (name, pw_hash, email)).lastrowid
+        return self.user_by_id(self.run_in_transaction(txn))
+
+
+    def usernames(self):
+        """
+        usernames: iterate over every username
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            list of usernames
+        """
+        with self.connection() as conn:
+            return [row[0] for row in conn.execute("SELECT name FROM users")]
+
+
+    def get_post(self, post_id):
+        """
+        get_post: get a post by ID
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post_id (int): ID of the post
+        Returns:
+            post record, or None
+        """
+        return self.fetch_one(PostRecord, "SELECT * FROM posts WHERE id = ?",
+                              int(post_id))
+
+
+    def recent_posts(self):
+        """
+        recent_posts: all posts, newest first
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            list of post records
+        """
+        return self.fetch_all(PostRecord,
+                              "SELECT * FROM posts ORDER BY created DESC")
+
+
+    def add_post(self, title, content, author):
+        """
+        add_post: store a new post
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            title (str): title of the post
+            content (str): content of the post
+            author (str): username of the author
+        Returns:
+            the new post record
+        """
+        now = datetime.datetime.utcnow()
+        def txn(conn):
+            cursor = conn.execute("INSERT INTO posts (title, content, author, "
+                                  "created, last_modified) "
+                                  "VALUES (?, ?, ?, ?, ?)",
+                                  (title, content, author, now, now))
+            self.count_month(conn, now, 1)
+            return cursor.lastrowid
+        return self.get_post(self.run_in_transaction(txn))
+
+
+    def edit_post(self, post, title, content):
+        """
+        edit_post: change the title and content of a post
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post (object): post record to change
+            title (str): the new title
+            content (str): the new content
+        Returns:
+            the updated post record
+        """
+        def txn(conn):
+            conn.execute("UPDATE posts SET title = ?, content = ?, "
+                         "last_modified = ? WHERE id = ?",
+                         (title, content, datetime.datetime.utcnow(), post.id))
+        self.run_in_transaction(txn)
+        return self.get_post(post.id)
+
+
+    def delete_post(self, post):
+        """
+        delete_post: delete a post together with its comments and likes
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post (object): post record to delete
+        Returns:
+            no return value
+        """
+        # comments and likes go with it through ON DELETE CASCADE
+        def txn(conn):
+            # a post deleted twice only leaves its month once
+            if conn.execute("DELETE FROM posts WHERE id = ?",
+                            (post.id,)).rowcount == 1:
+                self.count_month(conn, post.created, -1)
+        self.run_in_transaction(txn)
+
+
+    def count_month(self, conn, created, delta):
+        """
+        count_month: add to the archive count of a post's month, in the
+                     transaction that adds or deletes the post
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            conn (object): connection of the transaction
+            created (datetime): creation time of the post
+            delta (int): 1 for a new post, -1 for a deleted one
+        Returns:
+            no return value
+        """
+        month = storage.month_of(created)
+        conn.execute("INSERT OR IGNORE INTO month_counts (month, count) "
+                     "VALUES (?, 0)", (month,))
+        conn.execute("UPDATE month_counts SET count = count + ? "
+                     "WHERE month = ?", (delta, month))
+        conn.execute("DELETE FROM month_counts WHERE count <= 0")
+
+
+    def get_comment(self, post_id, c_id):
+        """
+        get_comment: get a comment of a post
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post_id (int): ID of the post the comment belongs to
+            c_id (int): ID of the comment
+        Returns:
+            comment record, or None
+        """
+        return self.fetch_one(CommentRecord, "SELECT * FROM comments "
+                              "WHERE id = ? AND post_id = ?",
+                              int(c_id), int(post_id))
+
+
+    def comments_by_post(self, post_id):
+        """
+        comments_by_post: get the comments of a post, oldest first
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post_id (int): ID of the post
+        Returns:
+            list of comment records, and the count of comments
+        """
+        comments = self.fetch_all(CommentRecord, "SELECT * FROM comments "
+                                  "WHERE post_id = ? ORDER BY created",
+                                  int(post_id))
+        return comments, len(comments)
+
+
+    def add_comment(self, post, content, author):
+        """
+        add_comment: store a comment and update the post's comment count together
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post (object): post record being commented on
+            content (str): text of the comment
+            author (str): username of the commenter
+        Returns:
+            tuple of the new comment record and the updated post record
+        """
+        now = datetime.datetime.utcnow()
+        def txn(conn):
+            cursor = conn.execute("INSERT INTO comments (post_id, content, "
+                                  "author, created, last_modified) "
+                                  "VALUES (?, ?, ?, ?, ?)",
+                                  (post.id, content, author, now, now))
+            conn.execute("UPDATE posts SET comment_count = comment_count + 1 "
+                         "WHERE id = ?", (post.id,))
+            return cursor.lastrowid
+        return (self.get_comment(post.id, self.run_in_transaction(txn)),
+                self.get_post(post.id))
+
+
+    def edit_comment(self, comment, content):
+        """
+        edit_comment: change the content of a comment
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            comment (object): comment record to change
+            content (str): the new content
+        Returns:
+            the updated comment record
+        """
+        def txn(conn):
+            conn.execute("UPDATE comments SET content = ?, last_modified = ? "
+                         "WHERE id = ?",
+                         (content, datetime.datetime.utcnow(), comment.id))
+        self.run_in_transaction(txn)
+        return self.get_comment(comment.post_id, comment.id)
+
+
+    def delete_comment(self, comment):
+        """
+        delete_comment: delete a comment and update the post's comment count together
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            comment (object): comment record to delete
+        Returns:
+            the updated post record
+        """
+        def txn(conn):
+            # a retried or concurrent delete must not count the comment out twice
+            if conn.execute("DELETE FROM comments WHERE id = ?",
+                            (comment.id,)).rowcount == 1:
+                conn.execute("UPDATE posts SET comment_count = comment_count - 1 "
+                             "WHERE id = ?", (comment.post_id,))
+        self.run_in_transaction(txn)
+        return self.get_post(comment.post_id)
+
+
+    def like_count(self, post):
+        """
+        like_count: the number of likes of a post
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post (object): post record
+        Returns:
+            the number of likes as an int
+        """
+        return post.like_count
+
+
+    def toggle_like(self, post, username):
+        """
+        toggle_like: like a post, or remove the user's like, updating the count in the same transaction
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post (object): post record being liked
+            username (str): username of the user clicking like
+        Returns:
+            tuple of (True if the post is now liked by the user, new like count)
+        """
+        def txn(conn):
+            removed = conn.execute("DELETE FROM likes WHERE post_id = ? "
+                                   "AND username = ?",
+                                   (post.id, username)).rowcount
+            if not removed:
+                conn.execute("INSERT INTO likes (post_id, username) "
+                             "VALUES (?, ?)", (post.id, username))
+            conn.execute("UPDATE posts SET like_count = like_count + ? "
+                         "WHERE id = ?", (-1 if removed else 1, post.id))
+            count = conn.execute("SELECT like_count FROM posts WHERE id = ?",
+                                 (post.id,)).fetchone()[0]
+            return not removed, count
+        return self.run_in_transaction(txn)
+
+
+    def top_posts(self, metric, window = "all", limit = 20):
+        """
+        top_posts: the highest ranked posts, read through the count indexes
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            metric (str): one of storage.METRICS
+            window (str): a key of storage.WINDOWS
+            limit (int): maximum number of posts to return
+        Returns:
+            list of (post record, count) tuples, highest count first
+        """
+        column = {"likes": "like_count", "comments": "comment_count"}[metric]
+        days = storage.WINDOWS[window]
+        since = datetime.datetime(1970, 1, 1)
+        if days is not None:
+            since = datetime.datetime.utcnow() - datetime.timedelta(days = days)
+
+        posts = self.fetch_all(PostRecord, "SELECT * FROM posts "
+                               "WHERE %s > 0 AND created >= ? "
+                               "ORDER BY %s DESC LIMIT ?" % (column, column),
+                               since, limit)
+        return [(post, getattr(post, column)) for post in posts]
+
+
+    def posts_in_month(self, year, month, cursor = None,
+                       limit = storage.ARCHIVE_PAGE_SIZE):
+        """
+        posts_in_month: a page of the posts created in a month, newest first,
+                        read through the created index from where the
+                        previous page ended
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            year (int): the year
+            month (int): the month, 1 to 12
+            cursor (str): cursor returned with the previous page, or None
+            limit (int): maximum number of posts to return
+        Returns:
+            tuple of (list of post records, cursor of the next page or None);
+            raises ValueError if the cursor is not valid
+        """
+        start, end = storage.month_range(year, month)
+        last_created, last_id = end, 0
+        if cursor:
+            created, post_id = cursor.split("_")
+            last_created = datetime.datetime.strptime(created, CURSOR_FORMAT)
+            last_id = int(post_id)
+
+        # one extra row tells if there is a next page
+        posts = self.fetch_all(PostRecord, "SELECT * FROM posts "
+                               "WHERE created >= ? AND created < ? "
+                               "AND (created < ? OR (created = ? AND id < ?)) "
+                               "ORDER BY created DESC, id DESC LIMIT ?",
+                               start, end, last_created, last_created, last_id,
+                               limit + 1)
+        if len(posts) <= limit:
+            return posts, None
+        last = posts[limit - 1]
+        return posts[:limit], "%s_%d" % (last.created.strftime(CURSOR_FORMAT),
+                                         last.id)
+
+
+    def archive_counts(self):
+        """
+        archive_counts: the months that have posts, from the month_counts
+                        table kept by add_post and delete_post
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            list of (year, month, number of posts), newest first
+        """
+        with self.connection() as conn:
+            rows = conn.execute("SELECT month, count FROM month_counts "
+                                "ORDER BY month DESC").fetchall()
+        return [(int(month[:4]), int(month[5:]), count)
+                for month, count in rows]
+
+
+    def get_blob(self, name):
+        """
+        get_blob: the bytes stored under a name
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            name (str): name of the blob
+        Returns:
+            the bytes, or None
+        """
+        with self.connection() as conn:
+            row = conn.execute("SELECT data FROM blobs WHERE name = ?",
+                               (name,)).fetchone()
+        return bytes(row[0]) if row else None
+
+
+    def update_blob(self, name, function):
+        """
+        update_blob: replace the bytes stored under a name in a transaction
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            name (str): name of the blob
+            function (function): takes the stored bytes, or None, and returns
+                                 the bytes to store
+        Returns:
+            the bytes stored
+        """
+        # the batch holds the write lock from its start, so concurrent
+        # updates apply one after the other
+        def txn(conn):
+            row = conn.execute("SELECT data FROM blobs WHERE name = ?",
+                               (name,)).fetchone()
+            data = function(bytes(row[0]) if row else None)
+            if data is not None:
+                conn.execute("INSERT OR REPLACE INTO blobs (name, data) "
+                             "VALUES (?, ?)", (name, sqlite3.Binary(data)))
+            return data
+        return self.run_in_transaction(txn)
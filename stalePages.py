@@ -0,0 +1,199 @@
+import hashlib
+import logging
+import threading
+import time
+
+### My modules
+import tenants
+
+from compat import ON_APP_ENGINE
+from compat import apiproxy_errors
+from compat import db
+from compat import memcache
+from compat import taskqueue
+
+# seconds the reads of a page may take before the last good copy is served
+# instead
+LATENCY_BUDGET = 1.0
+# how long the last good copy of a page is kept
+KEEP_SECONDS = 86400
+# refresh tasks for the same page are merged within this many seconds
+REFRESH_INTERVAL = 30
+DEGRADED_HEADER = "X-Blog-Degraded"
+
+
+### Last good copies of rendered pages
+#
+# Every successful render of a public page is kept in memcache. When a
+# render runs out of its LATENCY_BUDGET or fails, the last good copy is
+# served instead, marked with the DEGRADED_HEADER, and a push task renders
+# the page again without a budget to replace it. The budget is enforced on
+# the reads of the render: the datastore and memcache reads on the page's
+# path ask read_config() and read_cache() for RPCs whose deadline is the
+# time left, and any read after the budget is spent raises BudgetExceeded.
+# App Engine holds a response until every thread its request started has
+# finished, so the render can't be left running in the background.
+class BudgetExceeded(Exception):
+    """
+    BudgetExceeded: raised by a read made after the latency budget of the
+                    render ran out
+    """
+
+
+# errors of a read that ran out of the latency budget
+TIMEOUTS = (BudgetExceeded,)
+if db is not None:
+    TIMEOUTS += (db.Timeout, apiproxy_errors.DeadlineExceededError)
+
+budget = threading.local()
+
+
+def start_budget():
+    """
+    start_budget: give the reads of this thread LATENCY_BUDGET seconds from now
+    Returns:
+        no return value
+    """
+    budget.ends = time.time() + LATENCY_BUDGET
+
+
+def end_budget():
+    """
+    end_budget: let the reads of this thread take as long as they need again
+    Returns:
+        no return value
+    """
+    budget.ends = None
+
+
+def time_left():
+    """
+    time_left: seconds left of this thread's latency budget
+    Returns:
+        the seconds as a float, or None if there is no budget; raises
+        BudgetExceeded if it is spent
+    """
+    ends = getattr(budget, "ends", None)
+    if ends is None:
+        return None
+    left = ends - time.time()
+    if left <= 0:
+        raise BudgetExceeded()
+    return left
+
+
+def read_config():
+    """
+    read_config: datastore configuration for a read on a page's path
+    Returns:
+        a db configuration whose deadline is the time left of the budget, or
+        None to use the default deadline
+    """
+    left = time_left()
+    if left is None or db is None:
+        return None
+    return db.create_config(deadline = left)
+
+
+def read_cache(keys):
+    """
+    read_cache: memcache.get_multi for a read on a page's path; a read that
+                runs past the time left of the budget finds nothing
+    Args:
+        keys (list): memcache keys
+    Returns:
+        dict of the keys found to their values
+    """
+    left = time_left()
+    if left is None or not ON_APP_ENGINE:
+        # localMemcache is in process and has no RPCs to give a deadline
+        return memcache.get_multi(keys)
+    rpc = memcache.create_rpc(deadline = left)
+    return memcache.Client().get_multi_async(keys, rpc = rpc).get_result()
+
+
+def page_key(url):
+    """
+    page_key: memcache key of the last good copy of a page
+    Args:
+        url (str): path and query string of the page
+    Returns:
+        the memcache key string
+    """
+    return "lastgood:%s" % url
+
+
+def get(url):
+    """
+    get: the last good copy of a page
+    Args:
+        url (str): path and query string of the page
+    Returns:
+        tuple of (body, content type), or None if there is no copy
+    """
+    return memcache.get(page_key(url))
+
+
+def save(url, response):
+    """
+    save: keep a successful response as the last good copy of a page
+    Args:
+        url (str): path and query string of the page
+        response (object): webapp2 response of the render
+    Returns:
+        no return value
+    """
+    if response.status_int == 200:
+        memcache.set(page_key(url),
+                     (response.body, response.headers.get("Content-Type")),
+                     time = KEEP_SECONDS)
+
+
+def discard(*urls):
+    """
+    discard: drop the last good copies of pages, e.g. when content on them
+             was removed
+    Args:
+        *urls (str): paths and query strings of the pages
+    Returns:
+        no return value
+    """
+    memcache.delete_multi([page_key(url) for url in urls])
+
+
+def is_refresh(request):
+    """
+    is_refresh: check if a request is a refresh task; App Engine strips this
+                header from requests that don't come from the task queue
+    Args:
+        request (object): webapp2 request
+    Returns:
+        True if the request was sent by refresh()
+    """
+    return "X-AppEngine-QueueName" in request.headers
+
+
+def refresh(url):
+    """
+    refresh: queue a render of a page to replace its last good copy
+    Args:
+        url (str): path and query string of the page
+    Returns:
+        no return value
+    """
+    if taskqueue is None:
+        # no task queue outside App Engine; the next render that finishes
+        # within the budget saves the page anyway
+        return
+
+    slot = int(time.time() / REFRESH_INTERVAL)
+    # task names are shared by every blog, and blogs told apart by hostname
+    # have the same paths
+    blog = "%s:%s" % (tenants.current()[0], url)
+    name = "refresh-%s-%d" % (hashlib.sha1(blog).hexdigest(), slot)
+    try:
+        taskqueue.add(url = url, method = "GET", name = name)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+    except taskqueue.Error:
+        logging.exception("could not queue a refresh of %s", url)
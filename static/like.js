@@ -0,0 +1,64 @@
+// Upgrades the like forms in postsummary.html to toggle in place, so a
+// click posts to /blog/<id>/like and updates the count without a reload.
+(function () {
+    "use strict";
+
+    // path prefix of the blog, set on <body> by base.html
+    var root = document.body.getAttribute("data-root") || "";
+
+    // plain form post, for when the XHR fails; form.submit() doesn't send
+    // the clicked button, and the handler only toggles when "Like" is set
+    function submitForm(form) {
+        var like = document.createElement("input");
+        like.type = "hidden";
+        like.name = "Like";
+        like.value = "1";
+        form.appendChild(like);
+        form.submit();
+    }
+
+    function toggleLike(form) {
+        var count = form.querySelector(".like-count");
+        var error = form.querySelector(".like-error");
+        var request = new XMLHttpRequest();
+
+        request.open("POST", form.getAttribute("data-like-url"));
+        request.setRequestHeader("X-Requested-With", "XMLHttpRequest");
+        request.onload = function () {
+            var data;
+            if (request.status === 429) {
+                error.textContent = "Slow down, try again in " +
+                    request.getResponseHeader("Retry-After") + "s";
+                return;
+            }
+
+            try {
+                data = JSON.parse(request.responseText);
+            } catch (e) {
+                return submitForm(form);
+            }
+
+            if (request.status === 401) {
+                window.location = root + "/login";
+                return;
+            }
+
+            if (data.count !== undefined) {
+                count.textContent = data.count;
+            }
+            error.textContent = data.error || "";
+        };
+        request.onerror = function () {
+            submitForm(form);
+        };
+        request.send();
+    }
+
+    var forms = document.querySelectorAll("form.like-form");
+    for (var i = 0; i < forms.length; i++) {
+        forms[i].addEventListener("submit", function (event) {
+            event.preventDefault();
+            toggleLike(this);
+        });
+    }
+})();
@@ -0,0 +1,56 @@
+// Checks the username on the signup form as it's typed, against
+// /signup/check, so a taken name shows up before the form is posted.
+(function () {
+    "use strict";
+
+    // path prefix of the blog, set on <body> by base.html
+    var root = document.body.getAttribute("data-root") || "";
+
+    var input = document.querySelector("input[name=username]");
+    var status = document.querySelector(".username-status");
+    var timer = null;
+
+    if (!input || !status) {
+        return;
+    }
+
+    function check() {
+        var username = input.value;
+        var request = new XMLHttpRequest();
+
+        if (!username) {
+            status.textContent = "";
+            return;
+        }
+
+        request.open("GET", root + "/signup/check?username=" +
+                     encodeURIComponent(username));
+        request.onload = function () {
+            var data;
+            if (request.status !== 200 || input.value !== username) {
+                return;
+            }
+
+            try {
+                data = JSON.parse(request.responseText);
+            } catch (e) {
+                return;
+            }
+
+            status.classList.toggle("available", data.available);
+            if (!data.valid) {
+                status.textContent = "That's not a valid username.";
+            } else if (data.available) {
+                status.textContent = "That username is available.";
+            } else {
+                status.textContent = "That user already exists";
+            }
+        };
+        request.send();
+    }
+
+    input.addEventListener("input", function () {
+        clearTimeout(timer);
+        timer = setTimeout(check, 300);
+    });
+})();
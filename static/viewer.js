@@ -0,0 +1,60 @@
+// Page bodies are the same for every visitor so they can be cached publicly.
+// This fills in the per-user parts (login area, edit links, like buttons)
+// from the small /blog/viewer JSON call.
+(function () {
+    "use strict";
+
+    // path prefix of the blog, set on <body> by base.html
+    var root = document.body.getAttribute("data-root") || "";
+
+    function each(selector, fn) {
+        var elements = document.querySelectorAll(selector);
+        for (var i = 0; i < elements.length; i++) {
+            fn(elements[i]);
+        }
+    }
+
+    function show(element, visible) {
+        if (visible) {
+            element.classList.remove("hidden");
+        } else {
+            element.classList.add("hidden");
+        }
+    }
+
+    function personalize(username) {
+        var loggedIn = username !== "";
+
+        each(".viewer-only", function (element) {
+            show(element, loggedIn);
+        });
+        each(".anonymous-only", function (element) {
+            show(element, !loggedIn);
+        });
+        each(".author-only", function (element) {
+            show(element, loggedIn &&
+                 element.getAttribute("data-author") === username);
+        });
+        each(".viewer-name", function (element) {
+            element.textContent = username;
+        });
+        if (loggedIn) {
+            each(".like-button", function (element) {
+                element.classList.remove("disabled");
+            });
+        }
+    }
+
+    if (!document.querySelector(".viewer-only, .anonymous-only, .author-only")) {
+        return;
+    }
+
+    var request = new XMLHttpRequest();
+    request.open("GET", root + "/blog/viewer");
+    request.onload = function () {
+        if (request.status === 200) {
+            personalize(JSON.parse(request.responseText).username);
+        }
+    };
+    request.send();
+})();
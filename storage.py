@@ -0,0 +1,307 @@
+import datetime
+import os
+import threading
+
+### My modules
+import postDocument
+import tenants
+import validate
+
+# ranking metrics and windows served by /blog/top; a window only includes
+# posts created within that many days, None for all time
+METRICS = ("likes", "comments")
+WINDOWS = {
+    "all": None,
+    "month": 30,
+    "week": 7,
+}
+# posts per page of a monthly archive
+ARCHIVE_PAGE_SIZE = 20
+
+
+### Storage interface
+#
+# Every read and write the handlers in main.py make goes through a Storage
+# backend, so the blog isn't tied to the App Engine datastore. The backend
+# is picked with the BLOG_STORAGE environment variable: "datastore" (the
+# default) or "sqlite", whose database file is BLOG_SQLITE_PATH.
+class Storage(object):
+
+    def user_by_id(self, uid):
+        """
+        user_by_id: unimplemented stub function, get a user by ID
+        """
+        raise NotImplementedError
+
+
+    def user_by_name(self, name):
+        """
+        user_by_name: unimplemented stub function, get a user by name
+        """
+        raise NotImplementedError
+
+
+    def register_user(self, name, pw, email = None):
+        """
+        register_user: unimplemented stub function, store a new user
+        """
+        raise NotImplementedError
+
+
+    def usernames(self):
+        """
+        usernames: unimplemented stub function, iterate over every username
+        """
+        raise NotImplementedError
+
+
+    def login(self, name, pw):
+        """
+        login: log in a user
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            name (str): name of the user logging in
+            pw (str): unencrypted password of the user logging in
+        Returns:
+            the user object if the password matches
+        """
+        u = self.user_by_name(name)
+        if u and validate.valid_pw(name, pw, u.pw_hash):
+            return u
+
+
+    def get_post(self, post_id):
+        """
+        get_post: unimplemented stub function, get a post by ID or None
+        """
+        raise NotImplementedError
+
+
+    def recent_posts(self):
+        """
+        recent_posts: unimplemented stub function, all posts newest first
+        """
+        raise NotImplementedError
+
+
+    def add_post(self, title, content, author):
+        """
+        add_post: unimplemented stub function, store a new post and return it
+        """
+        raise NotImplementedError
+
+
+    def edit_post(self, post, title, content):
+        """
+        edit_post: unimplemented stub function, change a post and return it
+        """
+        raise NotImplementedError
+
+
+    def delete_post(self, post):
+        """
+        delete_post: unimplemented stub function, delete a post with its comments and likes
+        """
+        raise NotImplementedError
+
+
+    def post_document(self, post_id):
+        """
+        post_document: the read document of a post, see postDocument.py;
+                       backends that keep documents stored override this,
+                       this one builds it from the post, comments and likes
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post_id (int): ID of the post
+        Returns:
+            the document dict, or None if there is no such post
+        """
+        post = self.get_post(post_id)
+        if not post:
+            return None
+        comments, c_count = self.comments_by_post(post_id)
+        return postDocument.build(post, list(comments), self.like_count(post))
+
+
+    def post_documents(self, post_ids):
+        """
+        post_documents: the read documents of several posts, e.g. for the
+                        front page; backends override this to fetch them in
+                        one batch
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            post_ids (list): IDs of the posts
+        Returns:
+            list of document dicts, None for a post that doesn't exist
+        """
+        return [self.post_document(post_id) for post_id in post_ids]
+
+
+    def get_comment(self, post_id, c_id):
+        """
+        get_comment: unimplemented stub function, get a comment of a post or None
+        """
+        raise NotImplementedError
+
+
+    def comments_by_post(self, post_id):
+        """
+        comments_by_post: unimplemented stub function, the comments of a post and their count
+        """
+        raise NotImplementedError
+
+
+    def add_comment(self, post, content, author):
+        """
+        add_comment: unimplemented stub function, store a comment and return it with the updated post
+        """
+        raise NotImplementedError
+
+
+    def edit_comment(self, comment, content):
+        """
+        edit_comment: unimplemented stub function, change a comment and return it
+        """
+        raise NotImplementedError
+
+
+    def delete_comment(self, comment):
+        """
+        delete_comment: unimplemented stub function, delete a comment and return the updated post
+        """
+        raise NotImplementedError
+
+
+    def like_count(self, post):
+        """
+        like_count: unimplemented stub function, the number of likes of a post
+        """
+        raise NotImplementedError
+
+
+    def like_counts(self, posts):
+        """
+        like_counts: the like counts of several posts; backends that can read
+                     them together override this
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            posts (list): post objects
+        Returns:
+            list of the numbers of likes
+        """
+        return [self.like_count(post) for post in posts]
+
+
+    def toggle_like(self, post, username):
+        """
+        toggle_like: unimplemented stub function, like or unlike a post, returns (liked, count)
+        """
+        raise NotImplementedError
+
+
+    def top_posts(self, metric, window = "all", limit = 20):
+        """
+        top_posts: unimplemented stub function, list of (post, count) with the highest metric
+        """
+        raise NotImplementedError
+
+
+    def posts_in_month(self, year, month, cursor = None,
+                       limit = ARCHIVE_PAGE_SIZE):
+        """
+        posts_in_month: unimplemented stub function, a page of a month's posts newest first and the next page's cursor or None
+        """
+        raise NotImplementedError
+
+
+    def archive_counts(self):
+        """
+        archive_counts: unimplemented stub function, list of (year, month, post count) newest first, kept by add_post and delete_post
+        """
+        raise NotImplementedError
+
+
+    def get_blob(self, name):
+        """
+        get_blob: unimplemented stub function, the bytes stored under a name or None
+        """
+        raise NotImplementedError
+
+
+    def update_blob(self, name, function):
+        """
+        update_blob: unimplemented stub function, replace the bytes stored under
+                     a name with function(old bytes or None) in a transaction,
+                     returns the new bytes
+        """
+        raise NotImplementedError
+
+
+def month_range(year, month):
+    """
+    month_range: the creation times of the posts in a month
+    Args:
+        year (int): the year
+        month (int): the month, 1 to 12
+    Returns:
+        tuple of (first datetime of the month, first datetime of the next)
+    """
+    start = datetime.datetime(year, month, 1)
+    if month == 12:
+        return start, datetime.datetime(year + 1, 1, 1)
+    return start, datetime.datetime(year, month + 1, 1)
+
+
+def month_of(created):
+    """
+    month_of: the archive month of a creation time
+    Args:
+        created (datetime): creation time of a post
+    Returns:
+        "YYYY-MM" string, the key of the month's count
+    """
+    return created.strftime("%Y-%m")
+
+
+backends = {}
+backends_lock = threading.Lock()
+
+
+def sqlite_path(name):
+    """
+    sqlite_path: the SQLite database file of a blog
+    Args:
+        name (str): blog name, tenants.DEFAULT for the default blog
+    Returns:
+        BLOG_SQLITE_PATH for the default blog, with "-name" added before the
+        extension for the others
+    """
+    path = os.environ.get("BLOG_SQLITE_PATH", "blog.db")
+    if not name:
+        return path
+    if name not in tenants.names():
+        raise ValueError("unknown blog %r" % name)
+    root, ext = os.path.splitext(path)
+    return "%s-%s%s" % (root, name, ext)
+
+
+def get_backend():
+    """
+    get_backend: the storage backend selected by BLOG_STORAGE for the current
+                 blog, created on first use
+    Returns:
+        the Storage object
+    """
+    name = tenants.current()[0]
+    with backends_lock:
+        if name not in backends:
+            if os.environ.get("BLOG_STORAGE", "datastore") == "sqlite":
+                # each blog has its own database file
+                import sqliteStorage
+                backends[name] = sqliteStorage.SQLiteStorage(sqlite_path(name))
+            else:
+                # the datastore namespace set by tenants keeps each blog's
+                # entities apart
+                import datastoreStorage
+                backends[name] = datastoreStorage.DatastoreStorage()
+        return backends[name]
@@ -0,0 +1,251 @@
+import uuid
+import webapp2
+
+### My modules
+import archive
+import entityCache
+import htmlOutput
+import likeBuffer
+import migrate
+import profiler
+import purge
+import rankings
+import tenants
+import usernameFilter
+
+from main import Handler
+from google.appengine.api import memcache
+from google.appengine.ext import deferred
+
+# tokens for starting a user's removal, and how long they last
+PURGE_TOKEN_PREFIX = "purgetoken:"
+PURGE_TOKEN_SECONDS = 600
+
+
+### Cron and admin tasks
+#
+# These only apply to the datastore backend, so they live apart from
+# main.py, which has no App Engine imports. app.yaml routes /tasks/ here
+# with login: admin.
+
+
+class FlushLikesTask(Handler):
+
+    def get(self):
+        """
+        get: writes buffered likes to the datastore, run by cron
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        flushed = likeBuffer.flush()
+        # the flush and the comment handlers only mark changed posts
+        ranked = sum(tenants.call(name, rankings.apply_marked)
+                     for name in tenants.names())
+        self.write("flushed %d likes, ranked %d posts" % (flushed, ranked))
+
+
+class RebuildRankingsTask(Handler):
+
+    def get(self):
+        """
+        get: recomputes the rankings from the stored post counters, of every
+             blog with ?all=1, as cron runs it
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        if self.request.get("all"):
+            blogs = tenants.names()
+        else:
+            blogs = [tenants.current()[0]]
+        for name in blogs:
+            deferred.defer(tenants.call, name, rankings.rebuild)
+        self.write("rankings rebuild started")
+
+
+class RebuildArchiveTask(Handler):
+
+    def get(self):
+        """
+        get: recounts the posts of every archive month
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        deferred.defer(tenants.call, tenants.current()[0], archive.rebuild)
+        self.write("archive rebuild started")
+
+
+class RebuildUsernamesTask(Handler):
+
+    def get(self):
+        """
+        get: rebuilds the username Bloom filter from the stored users, of
+             every blog with ?all=1, as cron runs it
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        if self.request.get("all"):
+            blogs = tenants.names()
+        else:
+            blogs = [tenants.current()[0]]
+        for name in blogs:
+            deferred.defer(tenants.call, name, usernameFilter.rebuild)
+        self.write("username filter rebuild started")
+
+
+class CacheStatsTask(Handler):
+
+    def get(self):
+        """
+        get: returns this instance's entity cache hit/miss counters as JSON
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        self.write_json(entityCache.get_stats())
+
+
+class OutputStatsTask(Handler):
+
+    def get(self):
+        """
+        get: returns this instance's template and response byte counters as JSON
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        self.write_json(htmlOutput.get_stats())
+
+
+class ProfileTask(Handler):
+
+    def get(self):
+        """
+        get: serves stored profiles; ?id= a single request's collapsed stacks,
+             ?route= a route's aggregate, ?url= redirects to the page with
+             the signed profile flag, otherwise lists what is stored as JSON
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        profile_id = self.request.get("id")
+        route = self.request.get("route")
+        url = self.request.get("url")
+
+        if url.startswith("/"):
+            path = url.split("?")[0]
+            separator = "&" if "?" in url else "?"
+            return self.redirect("%s%s%s=%s" % (url, separator,
+                                                profiler.FLAG_PARAM,
+                                                profiler.sign(path)))
+
+        if profile_id or route:
+            if profile_id:
+                profile = profiler.get_request(profile_id)
+            else:
+                profile = profiler.get_route(route)
+            if not profile:
+                self.error(404)
+                return self.write("no such profile")
+            self.response.headers["Content-Type"] = "text/plain"
+            return self.write(profiler.format_stacks(profile["stacks"]))
+
+        self.write_json({"recent": profiler.recent(),
+                         "routes": profiler.routes()})
+
+
+class PurgeUserTask(Handler):
+
+    def get(self):
+        """
+        get: reports the progress of removing a user and everything they
+             wrote as JSON, with a token for starting it by POST
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        username = self.request.get("username")
+        if not username:
+            return self.write_json({"error": "username required"}, status = 400)
+
+        # only a page of this site can read the token, so another site can't
+        # make an admin's browser start a removal
+        token = uuid.uuid4().hex
+        memcache.set(PURGE_TOKEN_PREFIX + token, username,
+                     time = PURGE_TOKEN_SECONDS)
+        status = purge.status(username) or {"username": username,
+                                            "phase": None}
+        self.write_json(dict(status, token = token))
+
+
+    def post(self):
+        """
+        post: deletes a user's account and starts removing everything they
+              wrote, given a token from get()
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        username = self.request.get("username")
+        token_key = PURGE_TOKEN_PREFIX + self.request.get("token")
+        if not username or memcache.get(token_key) != username:
+            return self.write_json({"error": "invalid or expired token"},
+                                   status = 403)
+
+        memcache.delete(token_key)
+        purge.start(username)
+        self.write_json(purge.status(username))
+
+
+class MigrateTask(Handler):
+
+    def get(self):
+        """
+        get: starts the move of existing posts into per-post entity groups
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        deferred.defer(migrate.migrate_entity_groups)
+        self.write("migration started")
+
+
+class ReindexTask(Handler):
+
+    def get(self):
+        """
+        get: starts rewriting stored entities so they drop the index rows of
+             properties that are no longer indexed
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            no return value
+        """
+        deferred.defer(tenants.call, tenants.current()[0], migrate.reindex)
+        self.write("reindex started")
+
+
+app = tenants.TenantApp(webapp2.WSGIApplication([("/tasks/flushlikes",FlushLikesTask),
+                               ("/tasks/migrate",MigrateTask),
+                               ("/tasks/reindex",ReindexTask),
+                               ("/tasks/cachestats",CacheStatsTask),
+                               ("/tasks/profile",ProfileTask),
+                               ("/tasks/outputstats",OutputStatsTask),
+                               ("/tasks/rebuildrankings",RebuildRankingsTask),
+                               ("/tasks/rebuildarchive",RebuildArchiveTask),
+                               ("/tasks/purgeuser",PurgeUserTask),
+                               ("/tasks/rebuildusernames",RebuildUsernamesTask)
+                               ], debug=True))
@@ -0,0 +1,222 @@
+import os
+import re
+import threading
+
+### My modules
+from compat import namespace_manager
+
+# the blog served when no tenant matches; it uses the empty namespace, so
+# data written before tenancy existed stays in it
+DEFAULT = ""
+NAME_RE = re.compile(r"^[0-9A-Za-z._-]{1,100}$")
+
+
+### Multiple blogs in one deployment
+#
+# BLOG_TENANTS (an env_variables entry in app.yaml) lists the extra blogs as
+# comma separated name=route pairs, where the route is a hostname or a path
+# prefix, e.g. "cooking=cooking.example.com,travel=/travel". TenantApp
+# picks the blog of each request and sets the datastore and memcache
+# namespace to its name, so every query, entity and cache entry of a blog
+# is kept apart from the others'. A path prefix is cut off PATH_INFO, so
+# handlers see the same paths in every blog; url() puts it back on links.
+def parse(spec):
+    """
+    parse: read a BLOG_TENANTS value
+    Args:
+        spec (str): comma separated name=route pairs
+    Returns:
+        tuple of (dict of hostname to name, dict of path prefix to name)
+    """
+    hosts = {}
+    prefixes = {}
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        name, route = [part.strip() for part in entry.split("=", 1)]
+        if not NAME_RE.match(name):
+            raise ValueError("invalid blog name %r in BLOG_TENANTS" % name)
+        if route.startswith("/"):
+            prefixes[route.rstrip("/")] = name
+        else:
+            hosts[route.lower()] = name
+    return hosts, prefixes
+
+
+hosts, prefixes = parse(os.environ.get("BLOG_TENANTS", ""))
+local = threading.local()
+
+
+def on_app_engine():
+    """
+    on_app_engine: check if the app is served by App Engine or its SDK rather
+                   than a plain WSGI server such as wsgi.py's
+    Returns:
+        True on App Engine
+    """
+    software = os.environ.get("SERVER_SOFTWARE", "")
+    return (software.startswith("Google App Engine/") or
+            software.startswith("Development/"))
+
+
+def resolve(environ):
+    """
+    resolve: find the blog a request is for, moving its path prefix out of
+             PATH_INFO
+    Args:
+        environ (dict): WSGI environment, changed in place
+    Returns:
+        tuple of (blog name, path prefix)
+    """
+    host = environ.get("HTTP_HOST", "").split(":")[0].lower()
+    if host in hosts:
+        return hosts[host], ""
+
+    path = environ.get("PATH_INFO", "")
+    for prefix, name in prefixes.items():
+        if path == prefix or path.startswith(prefix + "/"):
+            # webapp2 routes on SCRIPT_NAME + PATH_INFO, so the prefix is
+            # dropped rather than moved to SCRIPT_NAME
+            environ["PATH_INFO"] = path[len(prefix):] or "/"
+            return name, prefix
+
+    # task queue requests run in the namespace they were queued from. Only
+    # App Engine strips these headers from outside requests, so they count
+    # nowhere else, and only for a configured blog
+    namespace = environ.get("HTTP_X_APPENGINE_CURRENT_NAMESPACE")
+    if (on_app_engine() and environ.get("HTTP_X_APPENGINE_QUEUENAME") and
+            namespace in names()):
+        return namespace, ""
+    return DEFAULT, ""
+
+
+def names():
+    """
+    names: every blog of the deployment, for tasks that run for all of them
+    Returns:
+        list of blog names, DEFAULT first
+    """
+    return [DEFAULT] + sorted(set(hosts.values()) | set(prefixes.values()))
+
+
+def activate(name, prefix = ""):
+    """
+    activate: make a blog the current one of this thread
+    Args:
+        name (str): blog name, DEFAULT for the default blog
+        prefix (str): path prefix the blog is served under, if any
+    Returns:
+        no return value
+    """
+    local.name = name
+    local.prefix = prefix
+    namespace_manager.set_namespace(name)
+
+
+def current():
+    """
+    current: the blog of this thread
+    Returns:
+        tuple of (blog name, path prefix)
+    """
+    return getattr(local, "name", DEFAULT), getattr(local, "prefix", "")
+
+
+def call(name, function, *args):
+    """
+    call: run a function as one blog, e.g. from a deferred task, which App
+          Engine runs in the default namespace
+    Args:
+        name (str): blog name
+        function (function): what to run
+        *args: arguments of function
+    Returns:
+        what function returns
+    """
+    previous = current()
+    activate(name)
+    try:
+        return function(*args)
+    finally:
+        activate(*previous)
+
+
+def url(path):
+    """
+    url: a site path as seen by the client, with the blog's path prefix
+    Args:
+        path (str): path starting with "/"
+    Returns:
+        the path string
+    """
+    return current()[1] + path
+
+
+def scoped(val):
+    """
+    scoped: tie a cookie value to the current blog before it's signed, so a
+            cookie from one blog is worthless on another
+    Args:
+        val (str): the value
+    Returns:
+        the value, with "@name" appended outside the default blog
+    """
+    name = current()[0]
+    return "%s@%s" % (val, name) if name else val
+
+
+def unscoped(val):
+    """
+    unscoped: the value of a cookie made by scoped() for the current blog
+    Args:
+        val (str): the verified cookie value
+    Returns:
+        the value, or None if it belongs to another blog
+    """
+    value, at, name = (val or "").partition("@")
+    if value and name == current()[0]:
+        return value
+    return None
+
+
+class TenantApp(object):
+
+    def __init__(self, app):
+        """
+        __init__: wrap a WSGI application
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            app (object): the webapp2 application
+        Returns:
+            no return value
+        """
+        self.app = app
+
+
+    def __call__(self, environ, start_response):
+        """
+        __call__: serve a request as its blog
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            environ (dict): WSGI environment
+            start_response (function): WSGI start_response callable
+        Returns:
+            iterable of the response body
+        """
+        activate(*resolve(environ))
+        try:
+            return self.app(environ, start_response)
+        finally:
+            activate(DEFAULT)
+
+
+    @property
+    def router(self):
+        """
+        router: the router of the wrapped application
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            webapp2 Router
+        """
+        return self.app.router
@@ -0,0 +1,253 @@
+import hashlib
+import logging
+import math
+import struct
+import threading
+import time
+
+### My modules
+import storage
+import tenants
+
+from compat import memcache
+
+BLOB_NAME = "usernames"
+VERSION_KEY = "usernamefilter:version"
+# false positive rate the filter is sized for, and the fewest names it is
+# sized for; a rebuild sizes it for twice the current number of users
+FALSE_POSITIVE_RATE = 0.01
+MIN_CAPACITY = 1000
+# reload the stored filter at least this often, in case memcache lost the
+# version stamp
+MAX_AGE = 300
+HEADER = struct.Struct("!III")
+
+
+### Bloom filter of registered usernames
+#
+# A name that isn't in the filter has certainly never been registered, so
+# /signup/check answers "free" from memory; only a possible hit is looked up
+# in storage. Each instance keeps a copy of the filter stored in the
+# BLOB_NAME blob. Registrations set their bits in the stored copy
+# transactionally and bump a version stamp in memcache, which tells the
+# other instances to reload.
+class BloomFilter(object):
+
+    def __init__(self, size, hashes, bits = None, count = 0):
+        """
+        __init__: create a filter
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            size (int): number of bits
+            hashes (int): number of bits set per name
+            bits (bytearray): the bits of a stored filter, or None for an empty one
+            count (int): number of names added
+        Returns:
+            no return value
+        """
+        self.size = size
+        self.hashes = hashes
+        self.bits = bits if bits is not None else bytearray((size + 7) // 8)
+        self.count = count
+
+
+    @classmethod
+    def for_capacity(cls, capacity, rate = FALSE_POSITIVE_RATE):
+        """
+        for_capacity: create an empty filter sized for a number of names
+        Args:
+            cls (self pointer): pointer to class object, does not need to be passed in
+            capacity (int): number of names the filter should hold
+            rate (float): false positive rate at that number of names
+        Returns:
+            the BloomFilter
+        """
+        size = int(math.ceil(-capacity * math.log(rate) / math.log(2) ** 2))
+        hashes = max(1, int(round(size / float(capacity) * math.log(2))))
+        return cls(size, hashes)
+
+
+    @classmethod
+    def from_blob(cls, blob):
+        """
+        from_blob: load a filter written by to_blob
+        Args:
+            cls (self pointer): pointer to class object, does not need to be passed in
+            blob (str): the stored bytes
+        Returns:
+            the BloomFilter
+        """
+        size, hashes, count = HEADER.unpack(blob[:HEADER.size])
+        return cls(size, hashes, bytearray(blob[HEADER.size:]), count)
+
+
+    def to_blob(self):
+        """
+        to_blob: the filter as bytes for storage
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+        Returns:
+            str of the header and the bits
+        """
+        return HEADER.pack(self.size, self.hashes, self.count) + bytes(self.bits)
+
+
+    def positions(self, name):
+        """
+        positions: the bits a name sets, by double hashing one SHA-1 digest
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            name (str): the username
+        Returns:
+            list of bit positions
+        """
+        digest = hashlib.sha1(name.encode("utf-8")).digest()
+        h1, h2 = struct.unpack("!QQ", digest[:16])
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+
+    def add(self, name):
+        """
+        add: add a name to the filter
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            name (str): the username
+        Returns:
+            no return value
+        """
+        for bit in self.positions(name):
+            self.bits[bit // 8] |= 1 << (bit % 8)
+        self.count += 1
+
+
+    def __contains__(self, name):
+        """
+        __contains__: check if a name may have been added
+        Args:
+            self (self pointer): pointer to class object, does not need to be passed in
+            name (str): the username
+        Returns:
+            False if the name was certainly never added, True if it may have been
+        """
+        return all(self.bits[bit // 8] & (1 << (bit % 8))
+                   for bit in self.positions(name))
+
+
+# blog name: this instance's copy of its filter
+local = {}
+local_lock = threading.Lock()
+
+
+def local_copy():
+    """
+    local_copy: this instance's copy of the current blog's filter; call with
+                local_lock held
+    Returns:
+        dict of the filter, its version stamp and when it was loaded
+    """
+    name = tenants.current()[0]
+    if name not in local:
+        local[name] = {"filter": None, "version": None, "loaded": 0}
+    return local[name]
+
+
+def current():
+    """
+    current: this instance's copy of the filter, reloaded when another
+             instance has changed the stored one
+    Returns:
+        the BloomFilter
+    """
+    version = memcache.get(VERSION_KEY)
+    with local_lock:
+        copy = local_copy()
+        if (copy["filter"] is None or version != copy["version"] or
+                time.time() - copy["loaded"] > MAX_AGE):
+            blob = storage.get_backend().get_blob(BLOB_NAME)
+            if blob is None:
+                bloom = rebuild()
+            else:
+                bloom = BloomFilter.from_blob(blob)
+            copy.update(filter = bloom, version = memcache.get(VERSION_KEY),
+                        loaded = time.time())
+        return copy["filter"]
+
+
+def is_taken(name):
+    """
+    is_taken: check if a username is registered, reading storage only when
+              the filter can't rule it out
+    Args:
+        name (str): the username
+    Returns:
+        True if a user has the name
+    """
+    if name not in current():
+        return False
+    return storage.get_backend().user_by_name(name) is not None
+
+
+def add(name):
+    """
+    add: record a newly registered username in the stored filter and this
+         instance's copy
+    Args:
+        name (str): the username
+    Returns:
+        no return value
+    """
+    def set_bits(blob):
+        if not blob:
+            return blob
+        bloom = BloomFilter.from_blob(blob)
+        bloom.add(name)
+        return bloom.to_blob()
+
+    blob = storage.get_backend().update_blob(BLOB_NAME, set_bits)
+    if not blob:
+        # nothing stored yet; the new user is already in storage
+        bloom = rebuild()
+    else:
+        bloom = BloomFilter.from_blob(blob)
+        if bloom.count > capacity(bloom):
+            logging.info("username filter holds %d names, resizing",
+                         bloom.count)
+            bloom = rebuild()
+        else:
+            memcache.incr(VERSION_KEY, initial_value = 0)
+
+    with local_lock:
+        local_copy().update(filter = bloom,
+                            version = memcache.get(VERSION_KEY),
+                            loaded = time.time())
+
+
+def capacity(bloom):
+    """
+    capacity: the number of names a filter was sized for
+    Args:
+        bloom (object): the BloomFilter
+    Returns:
+        the capacity as an int
+    """
+    return int(bloom.size * math.log(2) ** 2 / -math.log(FALSE_POSITIVE_RATE))
+
+
+def rebuild():
+    """
+    rebuild: build the filter from every stored username, sized for twice as
+             many, and store it
+    Returns:
+        the new BloomFilter
+    """
+    store = storage.get_backend()
+    names = list(store.usernames())
+    bloom = BloomFilter.for_capacity(max(MIN_CAPACITY, 2 * len(names)))
+    for name in names:
+        bloom.add(name)
+
+    # a name registered while the names are read may be missed until the
+    # next rebuild; signup itself still checks storage
+    store.update_blob(BLOB_NAME, lambda blob: bloom.to_blob())
+    memcache.incr(VERSION_KEY, initial_value = 0)
+    return bloom
@@ -0,0 +1,230 @@
+import collections
+import os
+import sys
+import time
+
+# measure the datastore backend without the sampled profiler
+os.environ["BLOG_STORAGE"] = "datastore"
+os.environ["PROFILE_SAMPLE_RATE"] = "0"
+
+try:
+    # puts the SDK's bundled webapp2 and jinja2 on the path
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+except ImportError:
+    pass
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.datastore import datastore_index
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+### My modules
+import entityCache
+import likeBuffer
+import migrate
+import storage
+import usernameFilter
+
+root = os.path.dirname(os.path.abspath(__file__))
+# times each write is repeated
+ROUNDS = 50
+
+
+### Write cost of the indexed properties
+#
+# Runs the blog's writes against the SDK's local datastore stub twice: with
+# every property indexed except Text and Blob ones, as the models were
+# before, and with the models as they are. For each write it prints the
+# time per call and the index rows the stored entities have, counted from
+# the Put RPCs: one for the kind, two (ascending and descending) for each
+# indexed property value and one per ancestor for each composite index of
+# index.yaml the entity is in. Every one of those rows is written when an
+# entity is stored new, and kept up to date on each later put. The stub
+# keeps no real indexes, so its times only hint at the difference; the row
+# counts are what the datastore bills and waits on. Run it with the App
+# Engine SDK on PYTHONPATH:
+#
+#     python writeCost.py
+writes = collections.Counter()
+
+
+def composite_indexes():
+    """
+    composite_indexes: the indexes declared in index.yaml
+    Returns:
+        list of (kind, ancestor, property names)
+    """
+    with open(os.path.join(root, "index.yaml")) as f:
+        definitions = datastore_index.ParseIndexDefinitions(f)
+    return [(index.kind, index.ancestor, [p.name for p in index.properties])
+            for index in (definitions and definitions.indexes) or []]
+
+
+def index_rows(entity, composites):
+    """
+    index_rows: the index rows of a stored entity
+    Args:
+        entity (object): entity protocol buffer from a Put request
+        composites (list): composite_indexes()
+    Returns:
+        the number of rows
+    """
+    path = entity.key().path().element_list()
+    kind = path[-1].type()
+    indexed = [p.name() for p in entity.property_list()]
+    rows = 1 + 2 * len(indexed)
+    for index_kind, ancestor, names in composites:
+        if index_kind == kind and all(name in indexed for name in names):
+            rows += len(path) if ancestor else 1
+    return rows
+
+
+def count_puts(composites):
+    """
+    count_puts: make an apiproxy hook counting the entities and index rows
+                of each Put RPC
+    Args:
+        composites (list): composite_indexes()
+    Returns:
+        the hook function
+    """
+    def hook(service, call, request, response):
+        if service == "datastore_v3" and call == "Put":
+            for entity in request.entity_list():
+                writes["entities"] += 1
+                writes["index rows"] += index_rows(entity, composites)
+    return hook
+
+
+def start_stubs():
+    """
+    start_stubs: activate fresh datastore, memcache and task queue stubs with
+                 Put counting
+    Returns:
+        the active Testbed
+    """
+    bed = testbed.Testbed()
+    bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability = 1)
+    bed.init_datastore_v3_stub(consistency_policy = policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path = root)
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        "writeCost", count_puts(composite_indexes()))
+    return bed
+
+
+def index_everything():
+    """
+    index_everything: index every property that can be, as the models did
+                      before properties were unindexed
+    Returns:
+        dict of model class to its own unindexed property names, for restore()
+    """
+    saved = {}
+    for model in migrate.REINDEX_MODELS:
+        saved[model] = model._unindexed_properties
+        model._unindexed_properties = frozenset(
+            name for name, prop in model.properties().items()
+            if isinstance(prop, (db.TextProperty, db.BlobProperty)))
+    return saved
+
+
+def restore(saved):
+    """
+    restore: undo index_everything()
+    Args:
+        saved (dict): what index_everything() returned
+    Returns:
+        no return value
+    """
+    for model, names in saved.items():
+        model._unindexed_properties = names
+
+
+def writes_to_measure(store):
+    """
+    writes_to_measure: the blog's writes, each as a function of the round
+    Args:
+        store (object): the datastore backend
+    Returns:
+        list of (name, function taking the round number)
+    """
+    author = store.register_user("author", "secret", "author@example.com")
+    post = store.add_post("Post", "Content of the post", author.name)
+    comment, post = store.add_comment(post, "Comment", author.name)
+    post_id = post.id
+
+    def like(i):
+        store.toggle_like(store.get_post(post_id), "reader%d" % i)
+        likeBuffer.flush()
+
+    return [
+        ("register user", lambda i: store.register_user(
+            "user%d" % i, "secret", "user%d@example.com" % i)),
+        ("add post", lambda i: store.add_post(
+            "Post %d" % i, "Content of post %d" % i, author.name)),
+        ("edit post", lambda i: store.edit_post(
+            store.get_post(post_id), "Post", "Edit %d" % i)),
+        ("add comment", lambda i: store.add_comment(
+            store.get_post(post_id), "Comment %d" % i, author.name)),
+        ("edit comment", lambda i: store.edit_comment(
+            store.get_comment(post_id, comment.id), "Edit %d" % i)),
+        ("like", like),
+    ]
+
+
+def measure():
+    """
+    measure: time each write and count its index rows on fresh stubs
+    Returns:
+        dict of write name to (milliseconds per call, index rows per call)
+    """
+    bed = start_stubs()
+    # the stubs start empty, so nothing cached by an earlier run is valid
+    entityCache.local_caches.clear()
+    usernameFilter.local.clear()
+    try:
+        results = collections.OrderedDict()
+        for name, write in writes_to_measure(storage.get_backend()):
+            writes.clear()
+            started = time.time()
+            for i in range(ROUNDS):
+                write(i)
+            elapsed = time.time() - started
+            results[name] = (1000.0 * elapsed / ROUNDS,
+                             writes["index rows"] / float(ROUNDS))
+        return results
+    finally:
+        bed.deactivate()
+
+
+def run(argv):
+    """
+    run: measure the writes with every property indexed and as the models
+         are, and print both
+    Args:
+        argv (list): command line arguments
+    Returns:
+        exit status
+    """
+    saved = index_everything()
+    try:
+        before = measure()
+    finally:
+        restore(saved)
+    after = measure()
+
+    print("%-14s %-26s %-26s" % ("", "ms per write before/after",
+                                 "index rows before/after"))
+    for name in before:
+        print("%-14s %-26s %-26s" % (
+            name, "%.2f / %.2f" % (before[name][0], after[name][0]),
+            "%.1f / %.1f" % (before[name][1], after[name][1])))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run(sys.argv[1:]))
@@ -0,0 +1,60 @@
+import mimetypes
+import os
+import sys
+
+from wsgiref.simple_server import make_server
+
+# standalone mode keeps its data in SQLite unless told otherwise
+os.environ.setdefault("BLOG_STORAGE", "sqlite")
+
+### My modules
+from main import app
+
+root = os.path.dirname(os.path.abspath(__file__))
+static_dir = os.path.join(root, "static")
+
+
+### Standalone WSGI entry point
+#
+# Runs the blog without App Engine: any WSGI server can serve
+# "wsgi:application", or run this file for a development server on
+# http://localhost:8080. The static files app.yaml would serve are served
+# by the middleware below.
+def serve_static(environ, start_response):
+    """
+    serve_static: WSGI middleware serving /static and /favicon.ico from disk
+    Args:
+        environ (dict): WSGI environment
+        start_response (function): WSGI start_response callable
+    Returns:
+        iterable of the response body
+    """
+    path = environ.get("PATH_INFO", "")
+    if path != "/favicon.ico" and not path.startswith("/static/"):
+        return app(environ, start_response)
+
+    file_path = os.path.normpath(os.path.join(root, path.lstrip("/")))
+    allowed = (file_path == os.path.join(root, "favicon.ico") or
+               file_path.startswith(static_dir + os.sep))
+    if not allowed or not os.path.isfile(file_path):
+        start_response("404 Not Found", [("Content-Type", "text/plain")])
+        return ["not found"]
+
+    headers = [("Content-Type",
+                mimetypes.guess_type(file_path)[0] or "application/octet-stream")]
+    if path.startswith("/static/build/"):
+        headers.append(("Cache-Control", "public, max-age=31536000, immutable"))
+    with open(file_path, "rb") as f:
+        body = f.read()
+    headers.append(("Content-Length", str(len(body))))
+    start_response("200 OK", headers)
+    return [body]
+
+
+application = serve_static
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    print("serving on http://localhost:%d" % port)
+    make_server("", port, application).serve_forever()